@@ -1,7 +1,16 @@
+import hashlib
 import heapq
+import json
 import math
+import os
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Tuple, Dict, Optional
 
+import graph_store
+import metrics
+
 # Enhanced city graph with major cities in Andhra Pradesh
 CITY_GRAPH = {
     # Major Cities
@@ -275,8 +284,66 @@ CITY_GRAPH = {
     }
 }
 
-# Cache for frequently used routes
-_route_cache: Dict[Tuple[str, str], Tuple[List[str], List[Tuple[float, float]]]] = {}
+# The hand-written network above is the default. Larger networks are read
+# lazily, tile by tile, from a partitioned store on disk (see graph_store.py)
+BUILTIN_CITY_GRAPH = CITY_GRAPH
+GRAPH_DIR = os.environ.get('RIDESHARE_GRAPH_DIR')
+if GRAPH_DIR:
+    CITY_GRAPH = graph_store.PartitionedGraph(GRAPH_DIR)
+
+# Cache for frequently used routes, keyed by (start, goal, mode)
+_route_cache: Dict[Tuple[str, str, str], Tuple[List[str], List[Tuple[float, float]]]] = {}
+
+# Optional second-level cache shared by all worker processes (shared_state.SharedRouteCache)
+_shared_routes = None
+
+SEARCH_MODES = ('forward', 'bidirectional')
+
+# Budget of one uncached search (0 = unlimited); see find_path
+ROUTE_DEADLINE = float(os.environ.get('RIDESHARE_ROUTE_DEADLINE', '2'))
+ROUTE_MAX_EXPANSIONS = int(os.environ.get('RIDESHARE_ROUTE_MAX_EXPANSIONS', '0'))
+# Heuristic weight of the forward search, so it finds a first route early
+ROUTE_WEIGHT = float(os.environ.get('RIDESHARE_ROUTE_WEIGHT', '1.5'))
+
+# Reverse adjacency (city -> {predecessor: distance}) and heuristic scale,
+# built on first use by the bidirectional search
+_reverse_neighbors: Optional[Dict[str, Dict[str, float]]] = None
+_heuristic_scale: Optional[float] = None
+
+# Backward shortest-path trees for the most recently used destinations, in
+# LRU order. Each entry keeps its Dijkstra state ('dist', 'next_hop',
+# 'frontier', 'settled') so a tree grown only far enough for one query can be
+# resumed by the next, and a 'lock' held by whichever thread is growing it.
+ROUTE_TREES = int(os.environ.get('RIDESHARE_ROUTE_TREES', '64'))
+_tree_cache: 'OrderedDict[str, Dict]' = OrderedDict()
+_tree_cache_lock = threading.Lock()
+
+# Sorted city names, built on first use by get_all_cities
+_sorted_cities: Optional[List[str]] = None
+
+# Connected component label per city (in-memory graphs; tiled stores keep
+# them in their index), built by prepare_graph or on first use
+_component_labels: Optional[Dict[str, int]] = None
+
+class _SearchBudget:
+    """Time and expansion limit of one search; the clock is read every 64 expansions"""
+    __slots__ = ('expires', 'max_expansions')
+    
+    def __init__(self, seconds: float, max_expansions: int):
+        self.expires = time.perf_counter() + seconds if seconds > 0 else None
+        self.max_expansions = max_expansions if max_expansions > 0 else None
+    
+    def exhausted(self, expanded: int) -> bool:
+        if self.max_expansions is not None and expanded >= self.max_expansions:
+            return True
+        return self.expires is not None and expanded % 64 == 0 and time.perf_counter() >= self.expires
+    
+    def expired(self) -> bool:
+        return self.expires is not None and time.perf_counter() >= self.expires
+    
+    def remaining(self) -> float:
+        """Seconds left, -1 for no time limit (a lock acquire timeout)"""
+        return -1 if self.expires is None else max(0.0, self.expires - time.perf_counter())
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
@@ -306,16 +373,55 @@ def heuristic(city1: str, city2: str) -> float:
     coords2 = CITY_GRAPH[city2]['coords']
     return haversine_distance(coords1[0], coords1[1], coords2[0], coords2[1])
 
-def find_path(start: str, goal: str) -> Tuple[Optional[List[str]], Optional[List[Tuple[float, float]]]]:
+def find_path(start: str, goal: str, stats: Optional[Dict] = None,
+              mode: str = 'forward', deadline: Optional[float] = None,
+              max_expansions: Optional[int] = None,
+              fallback: bool = False) -> Tuple[Optional[List[str]], Optional[List[Tuple[float, float]]]]:
     """
     Optimized A* pathfinding algorithm with caching
     Returns: (path, coordinates) or (None, None) if no path found
+    mode='bidirectional' searches from both ends at once (see _bidirectional_search)
+    deadline (seconds) and max_expansions bound an uncached search; None
+    means RIDESHARE_ROUTE_DEADLINE / RIDESHARE_ROUTE_MAX_EXPANSIONS, 0 no
+    limit. When the budget runs out the best route found so far is returned,
+    or with fallback=True and no route yet the straight line [start, goal].
+    Such routes are not cached.
+    If a stats dict is passed it is filled with 'cache_hit', 'expanded',
+    'approximate' (the budget ran out) and 'estimated' (straight line returned)
     """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    
+    started = time.perf_counter()
+    search_stats = stats if stats is not None else {}
+    search_stats['cache_hit'] = False
+    search_stats['expanded'] = 0
+    search_stats['approximate'] = False
+    search_stats['estimated'] = False
+    budget = _SearchBudget(ROUTE_DEADLINE if deadline is None else deadline,
+                           ROUTE_MAX_EXPANSIONS if max_expansions is None else max_expansions)
+    try:
+        return _find_path(start, goal, search_stats, mode, budget, fallback)
+    finally:
+        metrics.record_find_path(time.perf_counter() - started,
+                                 search_stats['cache_hit'], search_stats['expanded'])
+
+def _find_path(start: str, goal: str, stats: Dict, mode: str, budget: _SearchBudget,
+               fallback: bool) -> Tuple[Optional[List[str]], Optional[List[Tuple[float, float]]]]:
     # Check cache first
-    cache_key = (start, goal)
+    cache_key = (start, goal, mode)
     if cache_key in _route_cache:
+        stats['cache_hit'] = True
         return _route_cache[cache_key]
     
+    if _shared_routes is not None:
+        shared_path = _shared_routes.get(cache_key)
+        if shared_path:
+            stats['cache_hit'] = True
+            result = (shared_path, [CITY_GRAPH[city]['coords'] for city in shared_path])
+            _route_cache[cache_key] = result
+            return result
+    
     # Validate inputs
     if start not in CITY_GRAPH or goal not in CITY_GRAPH:
         return None, None
@@ -326,31 +432,87 @@ def find_path(start: str, goal: str) -> Tuple[Optional[List[str]], Optional[List
         _route_cache[cache_key] = result
         return result
     
-    # A* algorithm with priority queue
-    frontier = []
-    heapq.heappush(frontier, (0, start))
+    # No road joins different components: answer without searching
+    if not same_component(start, goal):
+        metrics.inc('rideshare_find_path_cutoff_total', {'reason': 'unreachable'})
+        return None, None
+    
+    if mode == 'bidirectional':
+        path = _bidirectional_search(start, goal, stats, budget)
+    else:
+        path = _forward_search(start, goal, stats, budget)
+    
+    if stats['approximate']:
+        metrics.inc('rideshare_find_path_cutoff_total', {'reason': 'budget'})
+        if path is None:
+            if not fallback:
+                return None, None
+            stats['estimated'] = True
+            path = [start, goal]
+        # Not cached, so a search with time to finish replaces it later
+        return path, [CITY_GRAPH[city]['coords'] for city in path]
+    
+    if path is None:
+        return None, None
+    
+    # Get coordinates
+    coordinates = [CITY_GRAPH[city]['coords'] for city in path]
+    
+    # Cache the result
+    result = (path, coordinates)
+    _route_cache[cache_key] = result
+    if _shared_routes is not None:
+        _shared_routes.put(cache_key, path)
+    
+    return result
+
+def _forward_search(start: str, goal: str, stats: Dict, budget: _SearchBudget) -> Optional[List[str]]:
+    """
+    Anytime weighted A* from start towards goal. Cities are expanded in
+    order of g + ROUTE_WEIGHT * h, which reaches goal quickly. The search
+    then goes on, pruning every city whose admissible g + h cannot beat the
+    best route, until the frontier is empty (the route is the shortest) or
+    the budget runs out (the best route so far, stats['approximate']).
+    """
+    scale = _admissible_scale()
+    weight = max(1.0, ROUTE_WEIGHT)
+    frontier = [(0.0, start)]
     
     came_from: Dict[str, Optional[str]] = {start: None}
     cost_so_far: Dict[str, float] = {start: 0}
+    best = float('inf')
     
     while frontier:
-        _, current = heapq.heappop(frontier)
+        if budget.exhausted(stats['expanded']):
+            stats['approximate'] = True
+            break
+        
+        priority, current = heapq.heappop(frontier)
+        cost = cost_so_far[current]
+        estimate = scale * heuristic(current, goal)
+        # Skip entries superseded by a cheaper cost, and cities that cannot beat best
+        if priority > cost + weight * estimate + 1e-9 or cost + estimate >= best:
+            continue
+        stats['expanded'] += 1
         
         if current == goal:
-            break
+            best = cost
+            continue
         
         for neighbor, distance in CITY_GRAPH[current]['neighbors'].items():
-            new_cost = cost_so_far[current] + distance
-            
-            if neighbor not in cost_so_far or new_cost < cost_so_far[neighbor]:
-                cost_so_far[neighbor] = new_cost
-                priority = new_cost + heuristic(neighbor, goal)
-                heapq.heappush(frontier, (priority, neighbor))
-                came_from[neighbor] = current
+            new_cost = cost + distance
+            if new_cost >= cost_so_far.get(neighbor, float('inf')):
+                continue
+            neighbor_estimate = scale * heuristic(neighbor, goal)
+            if new_cost + neighbor_estimate >= best:
+                continue
+            cost_so_far[neighbor] = new_cost
+            came_from[neighbor] = current
+            heapq.heappush(frontier, (new_cost + weight * neighbor_estimate, neighbor))
     
     # Reconstruct path
-    if goal not in came_from:
-        return None, None
+    if best == float('inf'):
+        return None
     
     path = []
     current = goal
@@ -358,19 +520,382 @@ def find_path(start: str, goal: str) -> Tuple[Optional[List[str]], Optional[List
         path.append(current)
         current = came_from[current]
     path.reverse()
+    return path
+
+def _predecessors(city: str) -> Dict[str, float]:
+    """Cities with a road into city, needed because some roads are only listed one way"""
+    data = CITY_GRAPH[city]
+    if 'predecessors' in data:
+        return data['predecessors']
+    return _reverse_graph().get(city, {})
+
+def _reverse_graph() -> Dict[str, Dict[str, float]]:
+    """Predecessor lists for graphs that do not store them per city"""
+    global _reverse_neighbors
+    if _reverse_neighbors is None:
+        reverse: Dict[str, Dict[str, float]] = {city: {} for city in CITY_GRAPH}
+        for city, data in CITY_GRAPH.items():
+            for neighbor, distance in data['neighbors'].items():
+                reverse.setdefault(neighbor, {})[city] = distance
+        _reverse_neighbors = reverse
+    return _reverse_neighbors
+
+def _admissible_scale() -> float:
+    """
+    Largest factor k such that k * great-circle distance never exceeds a road
+    distance. The hand-entered road lengths are sometimes shorter than the
+    straight line, so the raw haversine heuristic can overestimate.
+    """
+    global _heuristic_scale
+    if _heuristic_scale is None and hasattr(CITY_GRAPH, 'heuristic_scale'):
+        _heuristic_scale = CITY_GRAPH.heuristic_scale
+    if _heuristic_scale is None:
+        scale = 1.0
+        for city, data in CITY_GRAPH.items():
+            for neighbor, distance in data['neighbors'].items():
+                straight = heuristic(city, neighbor)
+                if straight > 0:
+                    scale = min(scale, distance / straight)
+        _heuristic_scale = scale
+    return _heuristic_scale
+
+def _bidirectional_search(start: str, goal: str, stats: Dict, budget: _SearchBudget) -> Optional[List[str]]:
+    """
+    Bidirectional A* with average potentials: a forward search from start
+    and a backward search (over predecessor edges) from goal. Both sides use
+    p(v) = (h_goal(v) - h_start(v)) / 2 (negated for the backward side), so
+    they share one reduced graph and behave like bidirectional Dijkstra on
+    it. Whenever an edge joins the two trees the best meeting cost `best` is
+    updated; the search stops once top_forward + top_backward >= best, at
+    which point no unexplored path can be shorter, or when the budget runs
+    out, keeping the best meeting found so far.
+    """
+    scale = _admissible_scale()
     
-    # Get coordinates
-    coordinates = [CITY_GRAPH[city]['coords'] for city in path]
+    def potential(city):
+        return scale * (heuristic(city, goal) - heuristic(city, start)) / 2
     
-    # Cache the result
-    result = (path, coordinates)
-    _route_cache[cache_key] = result
+    # index 0 = forward, 1 = backward
+    frontiers = ([(potential(start), start)], [(-potential(goal), goal)])
+    costs: Tuple[Dict[str, float], Dict[str, float]] = ({start: 0}, {goal: 0})
+    parents: Tuple[Dict[str, Optional[str]], Dict[str, Optional[str]]] = ({start: None}, {goal: None})
+    closed = (set(), set())
+    edges = (lambda c: CITY_GRAPH[c]['neighbors'], _predecessors)
+    signs = (1, -1)
+    
+    best = float('inf')
+    meeting: Optional[str] = None
     
+    while frontiers[0] and frontiers[1]:
+        if frontiers[0][0][0] + frontiers[1][0][0] >= best:
+            break
+        if budget.exhausted(stats['expanded']):
+            stats['approximate'] = True
+            break
+        
+        # Expand the side with the smaller frontier to keep both balanced
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        other = 1 - side
+        _, current = heapq.heappop(frontiers[side])
+        if current in closed[side]:
+            continue
+        closed[side].add(current)
+        stats['expanded'] += 1
+        
+        for neighbor, distance in edges[side](current).items():
+            new_cost = costs[side][current] + distance
+            if neighbor in closed[side] or new_cost >= costs[side].get(neighbor, float('inf')):
+                continue
+            costs[side][neighbor] = new_cost
+            parents[side][neighbor] = current
+            heapq.heappush(frontiers[side], (new_cost + signs[side] * potential(neighbor), neighbor))
+            
+            if neighbor in costs[other] and new_cost + costs[other][neighbor] < best:
+                best = new_cost + costs[other][neighbor]
+                meeting = neighbor
+    
+    if meeting is None:
+        return None
+    
+    path = []
+    current = meeting
+    while current is not None:
+        path.append(current)
+        current = parents[0][current]
+    path.reverse()
+    current = parents[1][meeting]
+    while current is not None:
+        path.append(current)
+        current = parents[1][current]
+    return path
+
+def _get_tree(goal: str) -> Dict:
+    """The cached backward tree of goal, a new empty one if there is none"""
+    with _tree_cache_lock:
+        tree = _tree_cache.get(goal)
+        if tree is None:
+            tree = _tree_cache[goal] = {
+                'dist': {goal: 0},
+                'next_hop': {goal: None},
+                'frontier': [(0, goal)],
+                'settled': set(),
+                'lock': threading.Lock(),
+            }
+            while len(_tree_cache) > ROUTE_TREES:
+                _tree_cache.popitem(last=False)
+        else:
+            _tree_cache.move_to_end(goal)
+        return tree
+
+def _backward_tree(goal: str, stats: Dict, budget: _SearchBudget,
+                   targets: Optional[List[str]] = None) -> Dict:
+    """
+    Dijkstra from goal over predecessor edges, resuming the cached tree.
+    With targets the search may stop once all of them are settled; without,
+    it covers every city that can reach goal. When the budget runs out first
+    stats['approximate'] is set and the tree stays partial for the next call.
+    Returns the tree; dist/next_hop of settled cities never change again, so
+    they can be read after the lock is released.
+    """
+    tree = _get_tree(goal)
+    if not tree['lock'].acquire(timeout=budget.remaining()):
+        # Another thread is growing this tree for longer than our budget
+        stats['approximate'] = True
+        return tree
+    try:
+        dist, next_hop, frontier, settled = tree['dist'], tree['next_hop'], tree['frontier'], tree['settled']
+        pending = None if targets is None else {t for t in targets if t not in settled}
+        expanded = 0
+        
+        while frontier:
+            if pending is not None and not pending:
+                break
+            if budget.exhausted(expanded):
+                stats['approximate'] = True
+                break
+            cost, current = heapq.heappop(frontier)
+            if current in settled:
+                continue
+            settled.add(current)
+            if pending is not None:
+                pending.discard(current)
+            expanded += 1
+            for predecessor, distance in _predecessors(current).items():
+                new_cost = cost + distance
+                if new_cost < dist.get(predecessor, float('inf')):
+                    dist[predecessor] = new_cost
+                    next_hop[predecessor] = current
+                    heapq.heappush(frontier, (new_cost, predecessor))
+        
+        stats['expanded'] += expanded
+    finally:
+        tree['lock'].release()
+    return tree
+
+def _tree_path(source: str, goal: str, next_hop: Dict[str, Optional[str]]) -> List[str]:
+    """Route from source along the tree's next hops to goal"""
+    path = [source]
+    while path[-1] != goal:
+        path.append(next_hop[path[-1]])
+    return path
+
+def find_paths_to(sources: List[str], destination: str, stats: Optional[Dict] = None,
+                  deadline: Optional[float] = None,
+                  max_expansions: Optional[int] = None) -> Dict[str, Tuple[Optional[List[str]], Optional[float]]]:
+    """
+    Shortest paths from many sources to one destination with a single
+    backward Dijkstra from the destination (multi source, single destination).
+    deadline and max_expansions bound the search like in find_path.
+    Returns: {source: (path, distance)}, (None, None) for unknown or
+    unreachable sources, and for sources not reached before the budget ran
+    out (stats['approximate'])
+    """
+    search_stats = stats if stats is not None else {}
+    search_stats['expanded'] = 0
+    search_stats['approximate'] = False
+    
+    if destination not in CITY_GRAPH:
+        return {source: (None, None) for source in sources}
+    
+    budget = _SearchBudget(ROUTE_DEADLINE if deadline is None else deadline,
+                           ROUTE_MAX_EXPANSIONS if max_expansions is None else max_expansions)
+    known = [source for source in sources if source in CITY_GRAPH]
+    tree = _backward_tree(destination, search_stats, budget, targets=known)
+    dist, next_hop, settled = tree['dist'], tree['next_hop'], tree['settled']
+    
+    result = {}
+    for source in sources:
+        if source not in settled:
+            result[source] = (None, None)
+        else:
+            result[source] = (_tree_path(source, destination, next_hop), float(dist[source]))
     return result
 
+def _spur_search(spur: str, goal: str, banned_nodes: set, banned_edges: set,
+                 tree: Tuple[Dict[str, float], Dict[str, Optional[str]]], stats: Dict) -> Optional[List[str]]:
+    """
+    Shortest spur -> goal path avoiding the banned nodes/edges.
+    The backward tree gives exact distances on the full graph, which stay a
+    consistent lower bound once edges are removed. A* guided by them can
+    stop at the first popped city whose tree path to goal avoids every ban:
+    its f-value is then the real cost of a complete path and nothing left
+    in the frontier can beat it. Usually that city is the spur itself or one
+    of its neighbours, so most candidates cost a handful of expansions.
+    """
+    dist, next_hop = tree
+    if spur not in dist:
+        return None
+    
+    blocked = banned_nodes | {spur}
+    tail_ok: Dict[str, bool] = {goal: True}
+    
+    def tree_tail_allowed(city: str) -> bool:
+        chain = []
+        while city not in tail_ok:
+            following = next_hop[city]
+            if following in blocked or (city, following) in banned_edges:
+                tail_ok[city] = False
+                break
+            chain.append(city)
+            city = following
+        ok = tail_ok[city]
+        for c in chain:
+            tail_ok[c] = ok
+        return ok
+    
+    frontier = [(dist[spur], spur)]
+    came_from: Dict[str, Optional[str]] = {spur: None}
+    cost_so_far: Dict[str, float] = {spur: 0}
+    closed = set()
+    
+    while frontier:
+        _, current = heapq.heappop(frontier)
+        if current in closed:
+            continue
+        closed.add(current)
+        stats['expanded'] += 1
+        
+        if tree_tail_allowed(current):
+            meeting = current
+            break
+        
+        for neighbor, distance in CITY_GRAPH[current]['neighbors'].items():
+            if neighbor in blocked or (current, neighbor) in banned_edges or neighbor not in dist:
+                continue
+            new_cost = cost_so_far[current] + distance
+            if new_cost < cost_so_far.get(neighbor, float('inf')):
+                cost_so_far[neighbor] = new_cost
+                came_from[neighbor] = current
+                heapq.heappush(frontier, (new_cost + dist[neighbor], neighbor))
+    else:
+        return None
+    
+    path = []
+    current = meeting
+    while current is not None:
+        path.append(current)
+        current = came_from[current]
+    path.reverse()
+    while path[-1] != goal:
+        path.append(next_hop[path[-1]])
+    return path
+
+def _path_edges(path: List[str]) -> set:
+    return set(zip(path, path[1:]))
+
+def find_k_paths(start: str, goal: str, k: int = 3, max_overlap: Optional[float] = None,
+                 stats: Optional[Dict] = None, deadline: Optional[float] = None,
+                 max_expansions: Optional[int] = None) -> List[Tuple[List[str], float]]:
+    """
+    Up to k loopless routes from start to goal, shortest first (Yen's algorithm).
+    max_overlap (0..1) skips candidates that share more than that fraction of
+    their length with a route already returned, giving more diverse options.
+    deadline and max_expansions bound the whole search like in find_path;
+    when they run out the routes found so far are returned (stats['approximate']).
+    Returns: [(path, distance), ...], empty if no route exists
+    """
+    search_stats = stats if stats is not None else {}
+    search_stats['expanded'] = 0
+    search_stats['candidates'] = 0
+    search_stats['approximate'] = False
+    
+    if start not in CITY_GRAPH or goal not in CITY_GRAPH or k < 1:
+        return []
+    if start == goal:
+        return [([start], 0.0)]
+    
+    budget = _SearchBudget(ROUTE_DEADLINE if deadline is None else deadline,
+                           ROUTE_MAX_EXPANSIONS if max_expansions is None else max_expansions)
+    backward = _backward_tree(goal, search_stats, budget)
+    dist, next_hop = backward['dist'], backward['next_hop']
+    if start not in backward['settled']:
+        return []
+    if search_stats['approximate']:
+        # Spur searches need exact distances from the whole tree
+        return [(_tree_path(start, goal, next_hop), float(dist[start]))]
+    tree = (dist, next_hop)
+    
+    shortest = _tree_path(start, goal, next_hop)
+    found = [shortest]                 # every path Yen has produced, in order
+    found_set = {tuple(shortest)}
+    routes = [(shortest, float(dist[start]))]
+    candidates: List[Tuple[float, List[str]]] = []
+    max_generated = k * 10 if max_overlap is not None else k
+    
+    while len(routes) < k and len(found) < max_generated:
+        previous = found[-1]
+        
+        for i in range(len(previous) - 1):
+            if budget.exhausted(search_stats['expanded']) or budget.expired():
+                search_stats['approximate'] = True
+                break
+            spur = previous[i]
+            root = previous[:i + 1]
+            banned_edges = {(p[i], p[i + 1]) for p in found if len(p) > i + 1 and p[:i + 1] == root}
+            banned_nodes = set(root[:-1])
+            
+            spur_path = _spur_search(spur, goal, banned_nodes, banned_edges, tree, search_stats)
+            if not spur_path:
+                continue
+            candidate = root[:-1] + spur_path
+            if tuple(candidate) in found_set:
+                continue
+            found_set.add(tuple(candidate))
+            search_stats['candidates'] += 1
+            heapq.heappush(candidates, (calculate_route_distance(candidate), candidate))
+        
+        if not candidates or search_stats['approximate']:
+            break
+        
+        cost, path = heapq.heappop(candidates)
+        found.append(path)
+        
+        if max_overlap is not None and cost > 0:
+            edges = _path_edges(path)
+            too_similar = False
+            for route, _ in routes:
+                shared = sum(CITY_GRAPH[a]['neighbors'][b] for a, b in edges & _path_edges(route))
+                if shared / cost > max_overlap:
+                    too_similar = True
+                    break
+            if too_similar:
+                continue
+        routes.append((path, cost))
+    
+    return routes
+
 def get_all_cities() -> List[str]:
-    """Return sorted list of all available cities"""
-    return sorted(CITY_GRAPH.keys())
+    """
+    Return sorted list of all available cities (cached, do not modify).
+    Partitioned graphs list their named places only, not every junction.
+    """
+    global _sorted_cities
+    if _sorted_cities is None:
+        if hasattr(CITY_GRAPH, 'places'):
+            _sorted_cities = sorted(CITY_GRAPH.places())
+        else:
+            _sorted_cities = sorted(CITY_GRAPH.keys())
+    return _sorted_cities
 
 def get_city_info(city: str) -> Optional[Dict]:
     """Get information about a specific city"""
@@ -391,13 +916,61 @@ def calculate_route_distance(path: List[str]) -> float:
     
     return total_distance
 
+def connected_components(graph) -> Dict[str, int]:
+    """
+    Weakly connected component label per city (roads followed either way).
+    Cities with different labels have no route between them.
+    """
+    linked: Dict[str, set] = {city: set(data['neighbors']) for city, data in graph.items()}
+    for city, data in graph.items():
+        for neighbor in data['neighbors']:
+            linked.setdefault(neighbor, set()).add(city)
+    
+    labels: Dict[str, int] = {}
+    count = 0
+    for root in linked:
+        if root in labels:
+            continue
+        labels[root] = count
+        stack = [root]
+        while stack:
+            for other in linked[stack.pop()]:
+                if other not in labels:
+                    labels[other] = count
+                    stack.append(other)
+        count += 1
+    return labels
+
+def component_of(city: str) -> Optional[int]:
+    """Connected component label of city, None if unknown"""
+    global _component_labels
+    if hasattr(CITY_GRAPH, 'component'):
+        return CITY_GRAPH.component(city)
+    if _component_labels is None:
+        _component_labels = connected_components(CITY_GRAPH)
+    return _component_labels.get(city)
+
+def same_component(city1: str, city2: str) -> bool:
+    """False only when no route between the cities can exist (O(1))"""
+    label = component_of(city1)
+    return label is None or label == component_of(city2)
+
+def iter_city_coords():
+    """(city, coords) pairs, streaming partitions one at a time"""
+    if hasattr(CITY_GRAPH, 'iter_coords'):
+        return CITY_GRAPH.iter_coords()
+    return ((city, data['coords']) for city, data in CITY_GRAPH.items())
+
 def get_nearest_city(lat: float, lon: float) -> str:
     """Find the nearest city to given coordinates"""
+    if hasattr(CITY_GRAPH, 'nearest'):
+        nearest = CITY_GRAPH.nearest(lat, lon, haversine_distance)
+        if nearest is not None:
+            return nearest
     min_distance = float('inf')
-    nearest = list(CITY_GRAPH.keys())[0]
+    nearest = next(iter(CITY_GRAPH))
     
-    for city, data in CITY_GRAPH.items():
-        city_lat, city_lon = data['coords']
+    for city, (city_lat, city_lon) in iter_city_coords():
         distance = haversine_distance(lat, lon, city_lat, city_lon)
         
         if distance < min_distance:
@@ -406,7 +979,54 @@ def get_nearest_city(lat: float, lon: float) -> str:
     
     return nearest
 
+def use_shared_cache(cache):
+    """Share computed routes with other worker processes through cache"""
+    global _shared_routes
+    _shared_routes = cache
+
+def prepare_graph():
+    """
+    Build the derived graph data searches need (sorted cities, heuristic
+    scale and, for in-memory graphs, predecessor lists and component labels)
+    so the first request does not pay for it. Partitioned graphs stay lazy.
+    """
+    get_all_cities()
+    _admissible_scale()
+    if not hasattr(CITY_GRAPH, 'iter_coords'):
+        _reverse_graph()
+        component_of(next(iter(CITY_GRAPH), ''))
+
 def clear_cache():
-    """Clear the route cache"""
-    global _route_cache
+    """Clear the route cache and derived graph data"""
+    global _route_cache, _reverse_neighbors, _heuristic_scale, _sorted_cities, _component_labels
     _route_cache.clear()
+    with _tree_cache_lock:
+        _tree_cache.clear()
+    _reverse_neighbors = None
+    _heuristic_scale = None
+    _sorted_cities = None
+    _component_labels = None
+
+def cached_routes(mode: str = 'forward', limit: Optional[int] = None) -> List[Tuple[str, str, List[str]]]:
+    """(start, goal, path) for the cached routes of one search mode, newest last"""
+    routes = [(start, goal, result[0]) for (start, goal, key_mode), result in list(_route_cache.items())
+              if key_mode == mode and len(result[0]) > 1]
+    return routes[-limit:] if limit else routes
+
+def seed_routes(routes, mode: str = 'forward') -> int:
+    """Fill the route cache with known (start, goal, path) entries; returns how many were used"""
+    added = 0
+    for start, goal, path in routes:
+        if (start, goal, mode) in _route_cache or not all(city in CITY_GRAPH for city in path):
+            continue
+        _route_cache[(start, goal, mode)] = (path, [CITY_GRAPH[city]['coords'] for city in path])
+        added += 1
+    return added
+
+def graph_fingerprint() -> str:
+    """Identifies the loaded road graph, so cached routes are not reused across graphs"""
+    if GRAPH_DIR:
+        stat = os.stat(os.path.join(GRAPH_DIR, 'index.json'))
+        return f'{os.path.abspath(GRAPH_DIR)}:{stat.st_size}:{int(stat.st_mtime)}'
+    encoded = json.dumps({city: data['neighbors'] for city, data in CITY_GRAPH.items()}, sort_keys=True)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
@@ -0,0 +1,224 @@
+"""
+Admission control for the request threads.
+
+Endpoints belong to one of three classes:
+
+- critical: booking and accepting rides, never shed;
+- poll: the endpoints every open dashboard hits on a timer;
+- normal: everything else.
+
+A long poll (/api/ride_status?wait=...) is a poll that holds its thread
+until something changes. Held long polls have their own cap
+(RIDESHARE_LONG_POLL_LIMIT) and do not count against the poll share,
+so a few waiting clients cannot get every other poller shed.
+
+Before a request runs it must pass, in order:
+
+1. a token bucket per (session, endpoint) for poll endpoints
+   (429 + Retry-After when a client polls faster than allowed);
+2. a per-endpoint concurrency limit (503 + Retry-After);
+3. load shedding: poll requests may only use part of the worker's threads,
+   normal ones a bit more, critical ones all of them. The poll share
+   shrinks while critical requests are slower than their latency target
+   and grows back when they recover, or as time passes without any
+   critical request (503 + Retry-After).
+
+Rejections are short responses without touching the database: JSON for
+/api/ endpoints and JSON requests, plain text for pages. Counts go to
+/metrics as rideshare_admission_total{endpoint,result}. Streamed responses
+hold their slot until the last chunk is sent.
+"""
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+import metrics
+from auth import TokenBuckets
+
+CRITICAL, NORMAL, POLL = 'critical', 'normal', 'poll'
+
+# Flask endpoint name -> class
+ENDPOINT_CLASSES = {
+    'book_ride': CRITICAL,
+    'accept_ride': CRITICAL,
+    'accept_multiple_rides': CRITICAL,
+    'insert_into_pool': CRITICAL,
+    'get_notifications': POLL,
+    'check_ride_status': POLL,
+    'get_my_rides': POLL,
+}
+
+# Endpoint -> query argument that turns a request into a long poll
+LONG_POLL_ARGS = {
+    'check_ride_status': 'wait',
+}
+
+# Share of the threads each class may fill before its requests are shed
+NORMAL_SHARE = 0.9
+MIN_POLL_SHARE = 0.1
+# Each second without a finished critical request counts as a fast one
+RECOVERY_INTERVAL = 1.0
+
+
+class AdmissionController:
+    def __init__(self, capacity: int = 4, poll_share: float = 0.5, poll_rate: float = 1.0,
+                 poll_burst: float = 5.0, endpoint_limit: int = 4, critical_target: float = 0.5,
+                 long_poll_limit: int = 2):
+        self.capacity = capacity
+        self.max_poll_share = poll_share
+        self.poll_share = poll_share
+        self.endpoint_limit = endpoint_limit
+        self.critical_target = critical_target
+        self.long_poll_limit = long_poll_limit
+        self.buckets = TokenBuckets(poll_rate, poll_burst)
+        self._critical_latency = 0.0  # EWMA in seconds
+        self._last_adapt = time.monotonic()
+        self._inflight = 0
+        self._long_polls = 0
+        self._by_endpoint: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def classify(self, endpoint: Optional[str]) -> str:
+        return ENDPOINT_CLASSES.get(endpoint, NORMAL)
+
+    def _allowed(self, priority: str) -> int:
+        """How many requests may be in flight when a non-critical one of this class arrives"""
+        share = self.poll_share if priority == POLL else NORMAL_SHARE
+        return max(1, int(self.capacity * share))
+
+    def admit(self, endpoint: str, client: str, long_poll: bool = False):
+        """None if admitted (call release() when done), else (status, retry_after)"""
+        priority = self.classify(endpoint)
+        if priority == POLL:
+            wait = self.buckets.take((client, endpoint))
+            if wait:
+                metrics.inc('rideshare_admission_total', {'endpoint': endpoint, 'result': 'rate_limited'})
+                return 429, wait
+
+        with self._lock:
+            self._recover(time.monotonic())
+            if long_poll:
+                if self._long_polls >= self.long_poll_limit:
+                    result = 'concurrency'
+                else:
+                    self._long_polls += 1
+                    result = 'admitted'
+            elif priority == CRITICAL:
+                # Never shed: a queued booking is better than a lost one
+                self._inflight += 1
+                result = 'admitted'
+            elif self._by_endpoint[endpoint] >= self.endpoint_limit:
+                result = 'concurrency'
+            elif self._inflight >= self._allowed(priority):
+                result = 'shed'
+            else:
+                self._inflight += 1
+                self._by_endpoint[endpoint] += 1
+                result = 'admitted'
+            inflight = self._inflight + self._long_polls
+
+        metrics.inc('rideshare_admission_total', {'endpoint': endpoint, 'result': result})
+        metrics.set_gauge('rideshare_inflight_requests', inflight)
+        if result != 'admitted':
+            return 503, 1.0
+        return None
+
+    def release(self, endpoint: str, seconds: float, long_poll: bool = False):
+        with self._lock:
+            if long_poll:
+                self._long_polls -= 1
+                return
+            self._inflight -= 1
+            if self.classify(endpoint) == CRITICAL:
+                self._adapt(seconds)
+            else:
+                self._by_endpoint[endpoint] -= 1
+
+    def _recover(self, now: float):
+        """Regrow the poll share in quiet periods, when no critical request finishes to do it"""
+        idle = int((now - self._last_adapt) / RECOVERY_INTERVAL)
+        if idle <= 0 or self.poll_share >= self.max_poll_share:
+            return
+        for _ in range(min(idle, 100)):
+            self._adapt(0.0)
+        self._last_adapt = now
+
+    def _adapt(self, seconds: float):
+        """Shrink the poll share while critical requests miss their target, regrow it after"""
+        self._last_adapt = time.monotonic()
+        self._critical_latency = 0.8 * self._critical_latency + 0.2 * seconds
+        if self._critical_latency > self.critical_target:
+            self.poll_share = max(MIN_POLL_SHARE, self.poll_share * 0.5)
+        else:
+            self.poll_share = min(self.max_poll_share, self.poll_share + 0.05)
+        metrics.set_gauge('rideshare_admission_poll_share', self.poll_share)
+
+    def init_app(self, app):
+        """Register the admission hooks (after metrics.init_app, so rejections are timed too)"""
+        from flask import Response, g, jsonify, request, session
+
+        @app.before_request
+        def _admit():
+            endpoint = request.endpoint or 'unknown'
+            if endpoint in ('static', 'prometheus_metrics'):
+                return None
+            client = str(session.get('user_id') or request.remote_addr or '')
+            wait_arg = LONG_POLL_ARGS.get(endpoint)
+            long_poll = bool(wait_arg and request.args.get(wait_arg, 0, type=float) > 0)
+            rejected = self.admit(endpoint, client, long_poll)
+            if rejected is None:
+                g._admission = (endpoint, time.perf_counter(), long_poll)
+                return None
+            status, retry_after = rejected
+            message = 'Too many requests' if status == 429 else 'Server busy'
+            if request.path.startswith('/api/') or request.is_json:
+                response = jsonify({'error': message})
+            else:
+                response = Response(f'{message}, please try again in a moment.\n', mimetype='text/plain')
+            response.status_code = status
+            response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+            return response
+
+        @app.after_request
+        def _release_after_stream(response):
+            # A streamed body is produced after the request context is gone,
+            # so its slot is kept until the last chunk is sent (or the client leaves)
+            if not response.is_streamed or '_admission' not in g:
+                return response
+            endpoint, started, long_poll = g.pop('_admission')
+            released = []
+
+            def release_once():
+                if not released:
+                    released.append(True)
+                    self.release(endpoint, time.perf_counter() - started, long_poll)
+
+            def stream(body):
+                try:
+                    yield from body
+                finally:
+                    release_once()
+
+            response.response = stream(response.response)
+            response.call_on_close(release_once)  # closed before the first chunk
+            return response
+
+        @app.teardown_request
+        def _release(exc):
+            admitted = g.pop('_admission', None)
+            if admitted is not None:
+                self.release(admitted[0], time.perf_counter() - admitted[1], admitted[2])
+
+
+def from_env() -> AdmissionController:
+    return AdmissionController(
+        capacity=int(os.environ.get('RIDESHARE_THREADS', '4')),
+        poll_share=float(os.environ.get('RIDESHARE_POLL_SHARE', '0.5')),
+        poll_rate=float(os.environ.get('RIDESHARE_POLL_RATE', '1')),
+        poll_burst=float(os.environ.get('RIDESHARE_POLL_BURST', '5')),
+        endpoint_limit=int(os.environ.get('RIDESHARE_ENDPOINT_CONCURRENCY', '4')),
+        critical_target=float(os.environ.get('RIDESHARE_CRITICAL_TARGET', '0.5')),
+        long_poll_limit=int(os.environ.get('RIDESHARE_LONG_POLL_LIMIT', '2')))
@@ -1,84 +1,114 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
-import sqlite3
+import time
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
 import random
 import math
 import socket
-from a_star import find_path, get_all_cities
+import hashlib
+import json
+import traceback
+import uuid
+from a_star import (find_path, find_k_paths, find_paths_to, get_nearest_city, calculate_route_distance,
+                    heuristic, prepare_graph, use_shared_cache, CITY_GRAPH)
+import metrics
+from notifications import NotificationQueue
+from ride_feed import RideChangeFeed
+from archive import RideArchiver
+import city_catalog
+from shared_state import open_shared_state
+from storage import encode_cursor, decode_cursor, encode_coords, decode_coords
+from config import ARCHIVE_DB_PATH, PROXY_HOPS, ROUTE_SNAPSHOT_PATH, open_configured_storage
+from eta_cache import EtaCache
+from pool_insertion import PoolPlanner, Stop
+from pool_index import PoolIndex
+from geometry import encode_polyline, route_geometry
+import auth
+import admission
+from route_warmup import RouteRefiner, RouteWarmer
+import models
+from models import PoolWaypoint
+import atexit
 import os
 
-# Detect Render
-IS_RENDER = os.environ.get('RENDER') == 'true'
-
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
+if PROXY_HOPS:
+    # remote_addr is the client, not the proxy, so login rate limits are per client
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+metrics.init_app(app)
+models.install_json(app)
+admission_control = admission.from_env()
+admission_control.init_app(app)
+
+storage = open_configured_storage()
 
 def get_db():
-    """Get database connection with Row factory"""
-    db_path = '/tmp/rideshare.db' if IS_RENDER else 'rideshare.db'
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a database connection with the user/ride/notification repositories"""
+    return storage.connect()
+
+notification_queue = NotificationQueue(get_db)
+eta_cache = EtaCache()
+pool_planner = PoolPlanner(get_db, max_detour=float(os.environ.get('RIDESHARE_POOL_MAX_DETOUR', '0.5')),
+                           detour_allowance_km=float(os.environ.get('RIDESHARE_POOL_DETOUR_KM', '5')),
+                           capacity=int(os.environ.get('RIDESHARE_POOL_CAPACITY', '4')))
+ride_feed = RideChangeFeed(get_db)
+pool_index = PoolIndex(get_db, ride_feed)
+password_hasher, login_guard = auth.from_env()
+route_warmer = RouteWarmer(get_db, ROUTE_SNAPSHOT_PATH,
+                           max_pairs=int(os.environ.get('RIDESHARE_WARMUP_PAIRS', '1000')),
+                           budget_seconds=float(os.environ.get('RIDESHARE_WARMUP_BUDGET', '30')))
+route_refiner = RouteRefiner(get_db, ride_feed,
+                             deadline=float(os.environ.get('RIDESHARE_ROUTE_REFINE_DEADLINE', '60')))
+# Archival moves rows into a second SQLite file; Postgres keeps everything in one database
+ride_archiver = RideArchiver(get_db, ARCHIVE_DB_PATH) if storage.name == 'sqlite' else None
 
 def init_db():
-    """Initialize database with all required tables"""
-    db_path = '/tmp/rideshare.db' if IS_RENDER else 'rideshare.db'
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        role TEXT NOT NULL,
-        current_lat REAL,
-        current_lon REAL
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS rides (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        source TEXT NOT NULL,
-        destination TEXT NOT NULL,
-        path TEXT NOT NULL,
-        coords TEXT NOT NULL,
-        pickup_lat REAL NOT NULL,
-        pickup_lon REAL NOT NULL,
-        status TEXT DEFAULT 'pending',
-        rider_id INTEGER,
-        rider_distance REAL,
-        pickup_time INTEGER,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (rider_id) REFERENCES users(id)
-    )''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS notifications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        ride_id INTEGER NOT NULL,
-        message TEXT NOT NULL,
-        notification_type TEXT NOT NULL,
-        is_read INTEGER DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (ride_id) REFERENCES rides(id)
-    )''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized at:", db_path)
+    """Create/migrate the schema of the configured backend"""
+    storage.init_schema()
+    print(f"✅ Database initialized ({storage.name}):", getattr(storage, 'path', 'DATABASE_URL'))
 
-# Use Flask's before_first_request (runs once before first request)
-_db_initialized = False
+def start_background_jobs():
+    """Start the threads of this process (under gunicorn: once per worker, after fork)"""
+    interval = float(os.environ.get('RIDESHARE_ARCHIVE_INTERVAL', '3600'))
+    if interval > 0 and ride_archiver is not None:
+        ride_archiver.start(interval)
+    route_warmer.start()
 
-@app.before_request
-def initialize_database():
-    global _db_initialized
-    if not _db_initialized:
-        init_db()
-        _db_initialized = True
+def create_app():
+    """
+    Get the app ready before it serves traffic: create/migrate the schema,
+    build the derived graph and city data, start background jobs and
+    report how long the cold start took.
+    
+    Under gunicorn with preload_app this runs once in the master; workers
+    share everything built here copy-on-write (see gunicorn.conf.py).
+    """
+    init_db()
+    if ride_archiver is not None:
+        ride_archiver.ensure_schema()
+    prepare_graph()
+    route_warmer.load_snapshot()
+    city_catalog.get_catalog()
+    
+    shared_dir = os.environ.get('RIDESHARE_SHARED_DIR')
+    if shared_dir:
+        counters, routes = open_shared_state(shared_dir)
+        use_shared_cache(routes)
+        notification_queue.attach_shared(counters)
+        ride_feed.attach_shared(counters)
+    
+    # Threads don't survive fork - gunicorn's post_fork hook starts them per worker
+    if os.environ.get('RIDESHARE_DEFER_JOBS') != '1':
+        start_background_jobs()
+        atexit.register(route_warmer.save_snapshot)
+    
+    cold_start = time.perf_counter() - BOOT_STARTED
+    app.config['COLD_START_SECONDS'] = cold_start
+    metrics.set_gauge('rideshare_cold_start_seconds', cold_start)
+    print(f"🚀 App ready in {cold_start * 1000:.0f} ms")
+    return app
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two points using Haversine formula"""
@@ -91,19 +121,57 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return R * c
 
-def update_rider_location(rider_id):
-    """Update rider's location to a random position"""
+def get_rider_location(rider_id):
+    """
+    Rider's position and location epoch. A rider without a stored position
+    is placed at a random spot around Guntur; after that the position only
+    changes when it is really updated (e.g. on accept), so dashboard
+    refreshes can reuse cached distances.
+    """
+    conn = get_db()
+    rider = conn.users.get(rider_id)
+    if rider['current_lat'] is not None and rider['current_lon'] is not None:
+        conn.close()
+        return rider['current_lat'], rider['current_lon'], rider['location_epoch'] or 0
+    
     base_lat, base_lon = 16.3067, 80.4365
     rider_lat = base_lat + random.uniform(-0.09, 0.09)
     rider_lon = base_lon + random.uniform(-0.09, 0.09)
     
-    conn = get_db()
-    conn.execute('UPDATE users SET current_lat = ?, current_lon = ? WHERE id = ?',
-                (rider_lat, rider_lon, rider_id))
+    epoch = conn.users.set_location(rider_id, rider_lat, rider_lon)
     conn.commit()
     conn.close()
     
-    return rider_lat, rider_lon
+    return rider_lat, rider_lon, epoch
+
+def pickup_distance(ride, rider_id, epoch, rider_lat, rider_lon):
+    """(distance_km, eta_minutes) from the rider to the ride's pickup, memoized per location epoch"""
+    return eta_cache.lookup(rider_id, epoch or 0, ride['id'],
+                            lambda: calculate_distance(rider_lat, rider_lon,
+                                                       ride['pickup_lat'], ride['pickup_lon']))
+
+def booking_idempotency_key(user_id, source, destination):
+    """
+    Key for a booking request. Forms carry a random key rendered with the
+    page; clients that don't send one get a key derived from the request,
+    so the same booking repeated within the same minute is recognised.
+    """
+    key = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+    if key:
+        return key[:128]
+    bucket = int(time.time() // 60)
+    return hashlib.sha256(f'{user_id}|{source}|{destination}|{bucket}'.encode()).hexdigest()
+
+def render_booking_page():
+    """
+    Booking form with a fresh idempotency key. The city list is not in the
+    page: it links the content-hashed list, which browsers keep cached
+    (None on graphs too large to ship whole - the form uses autocomplete).
+    """
+    catalog = city_catalog.get_catalog()
+    cities_url = url_for('city_list', digest=catalog['hash']) if catalog['embed'] else None
+    return render_template('book_ride.html', cities_url=cities_url,
+                           idempotency_key=uuid.uuid4().hex)
 
 def get_local_ip():
     """Get local IP address"""
@@ -125,6 +193,19 @@ def index():
             return redirect(url_for('user_dashboard'))
     return redirect(url_for('login'))
 
+def auth_busy(template, retry_after, status=429):
+    """
+    429 for a login/register attempt turned away by the rate limits,
+    503 (status) when the hashing pool is too busy to take it
+    """
+    if status == 429:
+        flash('Too many attempts, please try again shortly.', 'error')
+    else:
+        flash('We are very busy right now, please try again shortly.', 'error')
+    response = app.make_response((render_template(template), status))
+    response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -133,18 +214,25 @@ def register():
         password = request.form.get('password')
         role = request.form.get('role', 'user')
         
-        hashed_password = generate_password_hash(password)
+        retry_after = login_guard.admit(request.remote_addr)
+        if retry_after:
+            return auth_busy('register.html', retry_after)
+        try:
+            hashed_password = password_hasher.hash(password)
+        except auth.HashingBusy as e:
+            return auth_busy('register.html', e.retry_after, 503)
         
+        conn = get_db()
         try:
-            conn = get_db()
-            conn.execute('INSERT INTO users (name, email, password, role) VALUES (?, ?, ?, ?)',
-                        (name, email, hashed_password, role))
+            conn.users.create(name, email, hashed_password, role)
             conn.commit()
-            conn.close()
             flash('Registration successful!', 'success')
             return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
+        except conn.IntegrityError:
+            conn.rollback()
             flash('Email already exists!', 'error')
+        finally:
+            conn.close()
     
     return render_template('register.html')
 
@@ -154,11 +242,26 @@ def login():
         email = request.form.get('email')
         password = request.form.get('password')
         
+        retry_after = login_guard.admit(request.remote_addr, email)
+        if retry_after:
+            return auth_busy('login.html', retry_after)
+        
         conn = get_db()
-        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-        conn.close()
+        try:
+            user = conn.users.by_email(email)
+            matches = False
+            if user:
+                matches, new_hash = password_hasher.verify(user['password'], password)
+                if new_hash:
+                    # Stored with older KDF parameters: upgrade it now that we know the password
+                    conn.users.set_password(user['id'], new_hash)
+                    conn.commit()
+        except auth.HashingBusy as e:
+            return auth_busy('login.html', e.retry_after, 503)
+        finally:
+            conn.close()
         
-        if user and check_password_hash(user['password'], password):
+        if matches:
             session['user_id'] = user['id']
             session['user'] = user['name']
             session['role'] = user['role']
@@ -177,6 +280,45 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+def create_booking(user_id, source, destination, idempotency_key):
+    """
+    Book a ride for user_id. Returns (ride, created): ride is a dict with
+    id, source, destination, path and coords, or None when there is no route.
+    A repeated idempotency_key gives back the ride stored the first time
+    with created=False. If the route search runs out of budget the best
+    route found so far is stored and route_refiner replaces it later.
+    """
+    search_stats = {}
+    path, coord_list = find_path(source, destination, search_stats)
+    if not path:
+        return None, False
+    
+    path_str = ','.join(path)
+    coords_str = encode_coords(coord_list)
+    pickup_lat, pickup_lon = coord_list[0]
+    
+    conn = get_db()
+    try:
+        with ride_feed.recording(conn) as record:
+            ride_id = conn.rides.create(user_id, source, destination, path_str,
+                                        coords_str, pickup_lat, pickup_lon, idempotency_key)
+            record(ride_id, user_id, None, 'booked')
+        if search_stats['approximate']:
+            route_refiner.refine(ride_id, source, destination, path_str)
+        return {'id': ride_id, 'source': source, 'destination': destination,
+                'path': path, 'coords': coord_list}, True
+    except conn.IntegrityError:
+        # Retry of a booking we already stored - return the existing ride
+        conn.rollback()
+        existing = conn.rides.by_idempotency_key(user_id, idempotency_key)
+        if existing is None:
+            raise
+        return {'id': existing['id'], 'source': existing['source'],
+                'destination': existing['destination'], 'path': existing['path'].split(','),
+                'coords': decode_coords(existing['coords'])}, False
+    finally:
+        conn.close()
+
 @app.route('/book_ride', methods=['GET', 'POST'])
 def book_ride():
     if 'user_id' not in session:
@@ -188,31 +330,22 @@ def book_ride():
         
         if source == destination:
             flash('Source and destination cannot be the same!', 'error')
-            return render_template('book_ride.html', cities=get_all_cities())
+            return render_booking_page()
         
-        path, coord_list = find_path(source, destination)
+        idempotency_key = booking_idempotency_key(session['user_id'], source, destination)
+        ride, created = create_booking(session['user_id'], source, destination, idempotency_key)
         
-        if path:
-            path_str = ','.join(path)
-            coords_str = str(coord_list)
-            pickup_lat, pickup_lon = coord_list[0]
-            
-            conn = get_db()
-            conn.execute('''INSERT INTO rides 
-                (user_id, source, destination, path, coords, pickup_lat, pickup_lon) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (session['user_id'], source, destination, path_str, coords_str, 
-                 pickup_lat, pickup_lon))
-            conn.commit()
-            conn.close()
-            
-            flash('Ride booked successfully!', 'success')
-            return render_template('route_map.html', path=path, coords=coord_list,
-                                 source=source, destination=destination)
+        if ride:
+            if created:
+                flash('Ride booked successfully!', 'success')
+            else:
+                flash('Ride already booked!', 'info')
+            return render_template('route_map.html', path=ride['path'], geometry=route_geometry(ride['coords']),
+                                 source=ride['source'], destination=ride['destination'])
         else:
             flash('Route not found!', 'error')
     
-    return render_template('book_ride.html', cities=get_all_cities())
+    return render_booking_page()
 
 @app.route('/user_dashboard')
 def user_dashboard():
@@ -222,19 +355,7 @@ def user_dashboard():
     conn = get_db()
     
     # Get rides with rider information - NO DUPLICATES
-    rides = conn.execute('''
-        SELECT 
-            rides.*,
-            riders.name as rider_name,
-            riders.email as rider_email,
-            riders.current_lat as rider_lat,
-            riders.current_lon as rider_lon
-        FROM rides
-        LEFT JOIN users as riders ON rides.rider_id = riders.id
-        WHERE rides.user_id = ? 
-        ORDER BY rides.created_at DESC
-        LIMIT 20
-    ''', (session['user_id'],)).fetchall()
+    rides = conn.rides.for_passenger(session['user_id'], limit=20)
     
     # Calculate distance for accepted rides
     rides_with_info = []
@@ -246,19 +367,12 @@ def user_dashboard():
             continue
         seen_ride_ids.add(ride['id'])
         
-        ride_dict = dict(ride)
-        
-        # Calculate distance and ETA for accepted rides
-        if ride['status'] == 'accepted' and ride['rider_lat'] and ride['rider_lon']:
-            distance = calculate_distance(
-                ride['rider_lat'], ride['rider_lon'],
-                ride['pickup_lat'], ride['pickup_lon']
-            )
-            ride_dict['rider_distance'] = round(distance, 2)
-            eta = int((distance / 40) * 60)  # 40 km/h average
-            ride_dict['eta_minutes'] = eta
+        # Calculate distance and ETA for accepted rides (set on the row object, no copy)
+        if ride.status == 'accepted' and ride.rider_lat and ride.rider_lon:
+            ride.rider_distance, ride.eta_minutes = pickup_distance(
+                ride, ride.rider_id, ride.rider_location_epoch, ride.rider_lat, ride.rider_lon)
         
-        rides_with_info.append(ride_dict)
+        rides_with_info.append(ride)
     
     conn.close()
     
@@ -269,85 +383,59 @@ def rider_dashboard():
     if 'user_id' not in session or session.get('role') != 'rider':
         return redirect(url_for('login'))
     
-    rider_lat, rider_lon = update_rider_location(session['user_id'])
+    rider_lat, rider_lon, epoch = get_rider_location(session['user_id'])
     
     conn = get_db()
-    rides = conn.execute('''
-        SELECT rides.*, users.name as user_name, users.email as user_email
-        FROM rides
-        JOIN users ON rides.user_id = users.id
-        ORDER BY rides.created_at DESC
-    ''').fetchall()
-    
-    rides_with_distance = []
+    rides = conn.rides.all_with_users()
+    
     for ride in rides:
-        ride_dict = dict(ride)
-        distance = calculate_distance(rider_lat, rider_lon, ride['pickup_lat'], ride['pickup_lon'])
-        pickup_time = int((distance / 40) * 60)
-        
-        ride_dict['rider_distance'] = round(distance, 2)
-        ride_dict['pickup_time'] = pickup_time
-        rides_with_distance.append(ride_dict)
+        ride.rider_distance, ride.pickup_time = pickup_distance(
+            ride, session['user_id'], epoch, rider_lat, rider_lon)
     
     conn.close()
     
     return render_template('rider_dashboard.html', 
-                         rides=rides_with_distance, 
+                         rides=rides, 
                          rider=session['user'],
                          rider_lat=rider_lat,
                          rider_lon=rider_lon)
-@app.route('/accept_ride/<int:ride_id>')
-def accept_ride(ride_id):
-    if 'user_id' not in session or session.get('role') != 'rider':
-        flash('Please login as a rider first', 'error')
-        return redirect(url_for('login'))
-    
-    from a_star import CITY_GRAPH
+class RideUnavailable(Exception):
+    """The ride to accept does not exist or is no longer pending"""
     
+    def __init__(self, message, category):
+        super().__init__(message)
+        self.category = category
+
+def accept_pending_ride(rider_id, ride_id, rider_position=None):
+    """
+    Accept ride_id for rider_id: move the rider to rider_position (default:
+    a spot near the pickup), route them to the pickup, mark the ride accepted
+    and notify the passenger. Returns a dict with the pickup city, ETA and
+    rider -> pickup route; raises RideUnavailable if the ride can't be taken.
+    """
     conn = get_db()
     
     try:
-        ride = conn.execute('''
-            SELECT rides.*, users.name as user_name 
-            FROM rides 
-            JOIN users ON rides.user_id = users.id 
-            WHERE rides.id = ?
-        ''', (ride_id,)).fetchone()
+        ride = conn.rides.get_with_user(ride_id)
         
         if not ride:
-            flash('Ride not found!', 'error')
-            conn.close()
-            return redirect(url_for('rider_dashboard'))
+            raise RideUnavailable('Ride not found!', 'error')
         
         if ride['status'] != 'pending':
-            flash('This ride has already been accepted!', 'warning')
-            conn.close()
-            return redirect(url_for('rider_dashboard'))
+            raise RideUnavailable('This ride has already been accepted!', 'warning')
         
-        rider = conn.execute('SELECT name FROM users WHERE id = ?', 
-                            (session['user_id'],)).fetchone()
+        rider = conn.users.get(rider_id)
         rider_name = rider['name'] if rider else 'A rider'
         
         pickup_city = ride['source']
         pickup_coords = CITY_GRAPH[pickup_city]['coords']
         pickup_lat, pickup_lon = pickup_coords
         
-        rider_lat = pickup_lat + random.uniform(-0.02, 0.02)
-        rider_lon = pickup_lon + random.uniform(-0.02, 0.02)
-        
-        conn.execute('UPDATE users SET current_lat = ?, current_lon = ? WHERE id = ?',
-                    (rider_lat, rider_lon, session['user_id']))
-        
-        def get_nearest_city(lat, lon):
-            min_dist = float('inf')
-            nearest = pickup_city
-            for city, data in CITY_GRAPH.items():
-                city_lat, city_lon = data['coords']
-                dist = math.sqrt((lat - city_lat)**2 + (lon - city_lon)**2)
-                if dist < min_dist:
-                    min_dist = dist
-                    nearest = city
-            return nearest
+        if rider_position is None:
+            rider_lat = pickup_lat + random.uniform(-0.02, 0.02)
+            rider_lon = pickup_lon + random.uniform(-0.02, 0.02)
+        else:
+            rider_lat, rider_lon = rider_position
         
         rider_city = get_nearest_city(rider_lat, rider_lon)
         
@@ -365,36 +453,54 @@ def accept_ride(ride_id):
                 rider_to_pickup_path = [rider_city, pickup_city]
                 rider_to_pickup_coords = [(rider_lat, rider_lon), pickup_coords]
         
-        user_path = ride['path'].split(',') if ride['path'] else []
-        user_coords = eval(ride['coords']) if ride['coords'] else []
-        
-        # Update ride status
-        conn.execute('UPDATE rides SET status = ?, rider_id = ? WHERE id = ?',
-                    ('accepted', session['user_id'], ride_id))
-        
-        notification_message = f"🎉 {rider_name} accepted your ride! Arriving in {estimated_time} min"
-        
-        conn.execute('''INSERT INTO notifications 
-                        (user_id, ride_id, message, notification_type) 
-                        VALUES (?, ?, ?, ?)''',
-                    (ride['user_id'], ride_id, notification_message, 'success'))
-        
-        conn.commit()
-        
-        flash(f'Ride accepted! Navigate to {pickup_city}. ETA: {estimated_time} min', 'success')
-        return redirect(url_for('show_route', ride_id=ride_id))
+        # All writes happen here, after the route search, so the write
+        # transaction is only open for these few statements
+        with ride_feed.recording(conn) as record:
+            if not conn.rides.accept(ride_id, rider_id):
+                raise RideUnavailable('This ride has already been accepted!', 'warning')
+            conn.users.set_location(rider_id, rider_lat, rider_lon)
+            if rider_city != pickup_city:
+                # Counted so the next deploy can pre-compute the common approach routes
+                conn.route_demand.record(rider_city, pickup_city)
+            record(ride_id, ride['user_id'], rider_id, 'accepted')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    notification_message = f"🎉 {rider_name} accepted your ride! Arriving in {estimated_time} min"
+    notification_queue.enqueue(ride['user_id'], ride_id, notification_message, 'success')
+    
+    return {
+        'ride_id': ride_id,
+        'user_id': ride['user_id'],
+        'pickup_city': pickup_city,
+        'estimated_time': estimated_time,
+        'rider_to_pickup_path': rider_to_pickup_path,
+        'rider_to_pickup_coords': rider_to_pickup_coords,
+        'user_path': ride['path'].split(',') if ride['path'] else [],
+    }
 
+@app.route('/accept_ride/<int:ride_id>')
+def accept_ride(ride_id):
+    if 'user_id' not in session or session.get('role') != 'rider':
+        flash('Please login as a rider first', 'error')
+        return redirect(url_for('login'))
     
+    try:
+        result = accept_pending_ride(session['user_id'], ride_id)
+    except RideUnavailable as e:
+        flash(str(e), e.category)
+        return redirect(url_for('rider_dashboard'))
     except Exception as e:
-        conn.rollback()
         print(f"❌ Error: {e}")
-        import traceback
         traceback.print_exc()
         flash(f'Error accepting ride: {str(e)}', 'error')
         return redirect(url_for('rider_dashboard'))
     
-    finally:
-        conn.close()
+    flash(f"Ride accepted! Navigate to {result['pickup_city']}. ETA: {result['estimated_time']} min", 'success')
+    return redirect(url_for('show_route', ride_id=ride_id))
 
 @app.route('/route/<int:ride_id>')
 def show_route(ride_id):
@@ -405,16 +511,7 @@ def show_route(ride_id):
     conn = get_db()
     
     # Get ride details with rider information
-    ride = conn.execute('''
-        SELECT 
-            rides.*,
-            riders.name as rider_name,
-            riders.current_lat as rider_lat,
-            riders.current_lon as rider_lon
-        FROM rides
-        LEFT JOIN users as riders ON rides.rider_id = riders.id
-        WHERE rides.id = ?
-    ''', (ride_id,)).fetchone()
+    ride = conn.rides.get_with_rider(ride_id)
     
     conn.close()
     
@@ -424,29 +521,20 @@ def show_route(ride_id):
     
     # Parse path and coordinates
     path = ride['path'].split(',') if ride['path'] else []
-    coords = eval(ride['coords']) if ride['coords'] else []
+    coords = decode_coords(ride['coords'])
     
     # Prepare rider data if ride is accepted
     rider_data = None
     if ride['status'] == 'accepted' and ride['rider_lat'] and ride['rider_lon']:
-        from math import radians, sin, cos, sqrt, atan2
-        
         # Calculate distance to pickup
-        R = 6371  # Earth radius in km
-        lat1, lon1 = radians(ride['rider_lat']), radians(ride['rider_lon'])
-        lat2, lon2 = radians(ride['pickup_lat']), radians(ride['pickup_lon'])
-        
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        distance = R * c
+        distance, _ = pickup_distance(ride, ride['rider_id'], ride['rider_location_epoch'],
+                                      ride['rider_lat'], ride['rider_lon'])
         
         rider_data = {
             'name': ride['rider_name'],
             'lat': ride['rider_lat'],
             'lon': ride['rider_lon'],
-            'distance_to_pickup': round(distance, 2)
+            'distance_to_pickup': distance
         }
     
     return render_template('route_map.html',
@@ -454,7 +542,7 @@ def show_route(ride_id):
                          source=ride['source'],
                          destination=ride['destination'],
                          path=path,
-                         coords=coords,
+                         geometry=route_geometry(coords),
                          status=ride['status'],
                          rider=rider_data)
 
@@ -464,20 +552,9 @@ def get_notifications():
         return jsonify({'notifications': []})
     
     try:
-        conn = get_db()
-        notifications = conn.execute('''
-            SELECT n.*, r.source, r.destination 
-            FROM notifications n
-            LEFT JOIN rides r ON n.ride_id = r.id
-            WHERE n.user_id = ? AND n.is_read = 0
-            ORDER BY n.created_at DESC
-            LIMIT 10
-        ''', (session['user_id'],)).fetchall()
-        
-        result = [dict(n) for n in notifications]
-        conn.close()
-        
-        return jsonify({'notifications': result})
+        result = notification_queue.fetch_unread(session['user_id'])
+        return jsonify({'notifications': result,
+                        'unread_count': notification_queue.unread_count(session['user_id'])})
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'notifications': [], 'error': str(e)})
@@ -488,92 +565,336 @@ def mark_notification_read(notif_id):
         return jsonify({'success': False}), 403
     
     try:
-        conn = get_db()
-        conn.execute('UPDATE notifications SET is_read = 1 WHERE id = ? AND user_id = ?',
-                    (notif_id, session['user_id']))
-        conn.commit()
-        conn.close()
+        notification_queue.mark_read(session['user_id'], notif_id)
         return jsonify({'success': True})
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'success': False}), 500
 
+@app.route('/api/notifications/mark_all_read', methods=['POST'])
+def mark_all_notifications_read():
+    """Mark every notification up to up_to_id (inclusive) as read"""
+    if 'user_id' not in session:
+        return jsonify({'success': False}), 403
+    
+    data = request.get_json(silent=True) or request.form
+    try:
+        up_to_id = int(data.get('up_to_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'up_to_id is required'}), 400
+    
+    try:
+        cleared = notification_queue.mark_all_read(session['user_id'], up_to_id)
+        return jsonify({'success': True, 'marked': cleared})
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return jsonify({'success': False}), 500
+
 @app.route('/api/ride_status')
 def check_ride_status():
-    """Check if any rides have been recently updated"""
+    """
+    Change feed for the current user's rides.
+    ?since=<seq> returns changes after that sequence number together with the
+    cursor to use next time; ?wait=<seconds> (max 25) long-polls for a change.
+    Without since only the current cursor is returned.
+    """
     if 'user_id' not in session:
         return jsonify({'has_updates': False})
     
     try:
-        conn = get_db()
-        
-        # Get timestamp of last check from session
-        last_check = session.get('last_ride_check', '2000-01-01 00:00:00')
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({'has_updates': False, 'changes': [], 'seq': ride_feed.latest_seq})
         
-        # Check if any rides were updated after last check
-        updated_rides = conn.execute('''
-            SELECT COUNT(*) as count 
-            FROM rides 
-            WHERE user_id = ? 
-            AND status = 'accepted' 
-            AND created_at > ?
-        ''', (session['user_id'], last_check)).fetchone()
+        wait = min(max(request.args.get('wait', 0, type=float), 0), 25)
+        changes, cursor = ride_feed.changes_since(session['user_id'], since, wait=wait)
         
-        conn.close()
-        
-        # Update last check time
-        from datetime import datetime
-        session['last_ride_check'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        has_updates = updated_rides['count'] > 0
-        
-        return jsonify({'has_updates': has_updates})
+        return jsonify({'has_updates': bool(changes), 'changes': changes, 'seq': cursor})
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'has_updates': False})
 
+MY_RIDES_PAGE_SIZE = 500
+MY_RIDES_CHUNK = 200
+
 @app.route('/api/my_rides')
 def get_my_rides():
-    """Get current user's rides with rider info"""
+    """
+    Current user's rides with rider info, newest first, streamed while they
+    are read from the database.
+    
+    Pages hold ?limit rides (default 500, max 5000); pass the previous
+    page's next_cursor as ?cursor to continue. The body is
+    {"rides": [...], "next_cursor": ...}, or with ?format=ndjson (or
+    Accept: application/x-ndjson) one ride per line followed by a
+    {"next_cursor": ...} line. next_cursor is null on the last page.
+    """
     if 'user_id' not in session:
         return jsonify({'rides': []})
     
     try:
+        limit = min(max(request.args.get('limit', MY_RIDES_PAGE_SIZE, type=int), 1), 5000)
+        before = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'rides': [], 'error': str(e)}), 400
+    
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    user_id = session['user_id']
+    
+    def generate():
         conn = get_db()
-        
-        rides = conn.execute('''
-            SELECT 
-                rides.*,
-                riders.name as rider_name,
-                riders.current_lat as rider_lat,
-                riders.current_lon as rider_lon
-            FROM rides
-            LEFT JOIN users as riders ON rides.rider_id = riders.id
-            WHERE rides.user_id = ? 
-            ORDER BY rides.created_at DESC
-        ''', (session['user_id'],)).fetchall()
-        
-        result = []
-        for ride in rides:
-            ride_dict = dict(ride)
-            
-            # Calculate rider distance if ride is accepted
-            if ride['status'] == 'accepted' and ride['rider_lat'] and ride['rider_lon']:
-                distance = calculate_distance(
-                    ride['rider_lat'], ride['rider_lon'],
-                    ride['pickup_lat'], ride['pickup_lon']
-                )
-                ride_dict['rider_distance'] = round(distance, 2)
+        try:
+            parts = [] if ndjson else ['{"rides":[']
+            last_key, more = None, False
+            # One extra row tells whether another page follows
+            for i, ride in enumerate(conn.rides.iter_for_passenger(user_id, before, limit + 1,
+                                                                   chunk_size=MY_RIDES_CHUNK)):
+                if i == limit:
+                    more = True
+                    break
+                
+                # Calculate rider distance if ride is accepted
+                if ride.status == 'accepted' and ride.rider_lat and ride.rider_lon:
+                    ride.rider_distance, _ = pickup_distance(
+                        ride, ride.rider_id, ride.rider_location_epoch, ride.rider_lat, ride.rider_lon)
+                
+                last_key = (ride.created_at, ride.id)
+                encoded = json.dumps(ride, default=models.json_default)
+                parts.append(encoded + '\n' if ndjson else (',' if i else '') + encoded)
+                if len(parts) >= MY_RIDES_CHUNK:
+                    yield ''.join(parts)
+                    parts = []
             
-            result.append(ride_dict)
+            next_cursor = json.dumps(encode_cursor(last_key) if more else None)
+            parts.append(f'{{"next_cursor":{next_cursor}}}\n' if ndjson else f'],"next_cursor":{next_cursor}}}')
+            yield ''.join(parts)
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated body
+            print(f"❌ Error streaming rides: {e}")
+        finally:
+            conn.close()
+    
+    return Response(generate(), mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+@app.route('/api/rides/nearby')
+def get_nearby_rides():
+    """Pending rides with a pickup within ?radius_km (default 10) of the rider, nearest first"""
+    if 'user_id' not in session or session.get('role') != 'rider':
+        return jsonify({'rides': []}), 403
+    
+    try:
+        radius_km = min(max(request.args.get('radius_km', 10, type=float), 0.1), 200)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
         
-        conn.close()
+        conn = get_db()
+        try:
+            if lat is None or lon is None:
+                rider = conn.users.get(session['user_id'])
+                lat, lon = rider['current_lat'], rider['current_lon']
+            if lat is None or lon is None:
+                return jsonify({'rides': [], 'error': 'Rider location unknown'}), 400
+            rides = conn.rides.pending_near(lat, lon, radius_km, limit)
+        finally:
+            conn.close()
         
-        return jsonify({'rides': result})
+        for ride in rides:
+            ride['distance_km'] = round(ride['distance_km'], 2)
+            ride['pickup_time'] = int((ride['distance_km'] / 40) * 60)  # 40 km/h average
+        return jsonify({'rides': rides})
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'rides': [], 'error': str(e)})
 
+@app.route('/api/ride_history')
+def get_ride_history():
+    """Archived rides of the current user, newest first (?before=<id>&limit=20)"""
+    if 'user_id' not in session:
+        return jsonify({'rides': []})
+    
+    try:
+        if ride_archiver is None:
+            return jsonify({'rides': [], 'next_before': None})
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        rides, next_before = ride_archiver.history(session['user_id'],
+                                                   request.args.get('before', type=int), limit)
+        return jsonify({'rides': rides, 'next_before': next_before})
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return jsonify({'rides': [], 'error': str(e)})
+
+@app.route('/cities.<digest>.json')
+def city_list(digest):
+    """Sorted city names; the URL carries a content hash so it can be cached forever"""
+    catalog = city_catalog.get_catalog()
+    if digest != catalog['hash']:
+        return redirect(url_for('city_list', digest=catalog['hash']))
+    
+    response = Response(catalog['cities_json'], mimetype='application/json')
+    response.set_etag(catalog['hash'])
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@app.route('/api/cities/autocomplete')
+def autocomplete_cities():
+    """City names starting with ?q=, for graphs too large to ship whole"""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify({'cities': city_catalog.autocomplete(request.args.get('q', ''), limit)})
+
+@app.route('/api/alternatives')
+def get_alternative_routes():
+    """Up to k alternative routes between two cities, shortest first"""
+    if 'user_id' not in session:
+        return jsonify({'routes': []}), 403
+    
+    source = request.args.get('source')
+    destination = request.args.get('destination')
+    if source not in CITY_GRAPH or destination not in CITY_GRAPH:
+        return jsonify({'routes': [], 'error': 'Unknown source or destination'}), 400
+    
+    try:
+        k = min(max(int(request.args.get('k', 3)), 1), 10)
+        max_overlap = request.args.get('max_overlap', type=float)
+    except ValueError:
+        return jsonify({'routes': [], 'error': 'Invalid k'}), 400
+    
+    routes = find_k_paths(source, destination, k, max_overlap=max_overlap)
+    # ?geometry=polyline sends each route as an encoded polyline instead of a coords array
+    polyline = request.args.get('geometry') == 'polyline'
+    result = []
+    for path, distance in routes:
+        coords = [CITY_GRAPH[city]['coords'] for city in path]
+        route = {'path': path, 'distance': distance}
+        if polyline:
+            route['polyline'] = encode_polyline(coords)
+        else:
+            route['coords'] = coords
+        result.append(route)
+    return jsonify({'routes': result})
+
+def pool_stops_json(stops):
+    return [{'city': stop.city, 'ride_id': stop.ride_id, 'type': stop.kind,
+             'coords': CITY_GRAPH[stop.city]['coords']} for stop in stops]
+
+@app.route('/api/pool/candidates')
+def get_pool_candidates():
+    """Pending rides sharing the most road with ?ride_id, best first (?k=10)"""
+    if 'user_id' not in session or session.get('role') != 'rider':
+        return jsonify({'rides': []}), 403
+    
+    ride_id = request.args.get('ride_id', type=int)
+    k = min(max(request.args.get('k', 10, type=int), 1), 50)
+    if ride_id is None:
+        return jsonify({'rides': [], 'error': 'ride_id is required'}), 400
+    
+    conn = get_db()
+    try:
+        ride = conn.rides.get(ride_id)
+        if not ride:
+            return jsonify({'rides': [], 'error': 'Ride not found'}), 404
+        path = ride['path'].split(',')
+        matches = pool_index.candidates(path, k, exclude=ride_id)
+        rows = {row['id']: row for row in conn.rides.get_many_with_users([m[0] for m in matches])}
+    finally:
+        conn.close()
+    
+    length = calculate_route_distance(path) or 1.0
+    result = []
+    for candidate_id, shared_km in matches:
+        row = rows.get(candidate_id)
+        if row is None or row['status'] != 'pending':
+            continue
+        candidate_length = calculate_route_distance(row['path'].split(',')) or 1.0
+        result.append({
+            'id': candidate_id,
+            'user_name': row['user_name'],
+            'source': row['source'],
+            'destination': row['destination'],
+            'shared_km': round(shared_km, 2),
+            'overlap': round(shared_km / length, 3),
+            'candidate_overlap': round(shared_km / candidate_length, 3)
+        })
+    return jsonify({'ride_id': ride_id, 'rides': result})
+
+@app.route('/api/pool/insert', methods=['POST'])
+def insert_into_pool():
+    """
+    Cheapest feasible insertion of a pending ride into the rider's active
+    pool. {"ride_id": 12} only plans; {"ride_id": 12, "commit": true} also
+    accepts the ride and updates the pool.
+    """
+    if 'user_id' not in session or session.get('role') != 'rider':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        ride_id = int(data.get('ride_id'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ride_id is required'}), 400
+    
+    route = pool_planner.get(session['user_id'])
+    if route is None:
+        return jsonify({'error': 'No active pool'}), 404
+    
+    conn = get_db()
+    ride = conn.rides.get(ride_id)
+    conn.close()
+    if not ride or ride['status'] != 'pending':
+        return jsonify({'error': 'Ride is not pending'}), 409
+    
+    started = time.perf_counter()
+    insertion = pool_planner.plan_insertion(session['user_id'], ride_id, ride['source'], ride['destination'])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if insertion is None:
+        return jsonify({'feasible': False, 'elapsed_ms': round(elapsed_ms, 3)}), 409
+    
+    committed = bool(data.get('commit'))
+    if committed:
+        # The plan is updated first, so a pool that ended or filled up
+        # meanwhile is noticed before the ride is accepted
+        insertion = pool_planner.apply(session['user_id'], ride_id, ride['source'], ride['destination'],
+                                       insertion)
+        if insertion is None:
+            return jsonify({'feasible': False, 'error': 'The pool changed, the ride no longer fits'}), 409
+        try:
+            accept_pending_ride(session['user_id'], ride_id,
+                                rider_position=CITY_GRAPH[route.start]['coords'])
+        except RideUnavailable as e:
+            pool_planner.withdraw(session['user_id'], ride_id)
+            return jsonify({'feasible': True, 'error': str(e)}), 409
+    
+    return jsonify({
+        'feasible': True,
+        'committed': committed,
+        'added_km': round(insertion.added_km, 2),
+        'stops': pool_stops_json(insertion.stops),
+        'elapsed_ms': round(elapsed_ms, 3)
+    })
+
+@app.route('/api/pool/advance', methods=['POST'])
+def advance_pool():
+    """The rider reached the next stop of their pool"""
+    if 'user_id' not in session or session.get('role') != 'rider':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    stop = pool_planner.advance(session['user_id'])
+    if stop is None:
+        return jsonify({'error': 'No active pool'}), 404
+    route = pool_planner.get(session['user_id'])
+    return jsonify({'reached': pool_stops_json([stop])[0],
+                    'remaining': pool_stops_json(route.stops) if route else []})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    if not metrics.scrape_allowed(request):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/accept_multiple_rides', methods=['POST'])
 def accept_multiple_rides():
     """Accept multiple rides for pool/share mode"""
@@ -587,28 +908,25 @@ def accept_multiple_rides():
             return jsonify({'error': 'No rides selected'}), 400
         
         conn = get_db()
+        accepted = []
         
         # Update all selected rides to accepted
-        for ride_id in ride_ids:
-            conn.execute('''
-                UPDATE rides 
-                SET status = 'accepted', rider_id = ? 
-                WHERE id = ? AND status = 'pending'
-            ''', (session['user_id'], ride_id))
-            
-            # Get ride details for notification
-            ride = conn.execute('SELECT * FROM rides WHERE id = ?', (ride_id,)).fetchone()
-            if ride:
-                notification_message = f"🎉 Your ride has been accepted! Driver will pick up multiple passengers."
-                conn.execute('''
-                    INSERT INTO notifications 
-                    (user_id, ride_id, message, notification_type) 
-                    VALUES (?, ?, ?, ?)
-                ''', (ride['user_id'], ride_id, notification_message, 'success'))
-        
-        conn.commit()
+        with ride_feed.recording(conn) as record:
+            for ride_id in ride_ids:
+                if not conn.rides.accept(ride_id, session['user_id']):
+                    continue  # already taken by another rider
+                
+                # Get ride details for notification
+                ride = conn.rides.get(ride_id)
+                if ride:
+                    accepted.append((ride['user_id'], ride_id))
+                    record(ride_id, ride['user_id'], session['user_id'], 'accepted')
         conn.close()
         
+        for user_id, ride_id in accepted:
+            notification_message = f"🎉 Your ride has been accepted! Driver will pick up multiple passengers."
+            notification_queue.enqueue(user_id, ride_id, notification_message, 'success')
+        
         return jsonify({
             'success': True,
             'message': f'Accepted {len(ride_ids)} rides'
@@ -633,15 +951,10 @@ def multi_route_view(ride_ids):
         # Get all selected rides
         rides = []
         for ride_id in ride_id_list:
-            ride = conn.execute('''
-                SELECT rides.*, users.name as user_name 
-                FROM rides 
-                JOIN users ON rides.user_id = users.id 
-                WHERE rides.id = ?
-            ''', (ride_id,)).fetchone()
+            ride = conn.rides.get_with_user(ride_id)
             
             if ride:
-                rides.append(dict(ride))
+                rides.append(ride)
         
         conn.close()
         
@@ -656,6 +969,11 @@ def multi_route_view(ride_ids):
             flash('Could not generate route!', 'error')
             return redirect(url_for('rider_dashboard'))
         
+        # Remember the plan so new passengers can be inserted into it (/api/pool/insert)
+        pool_planner.start(session['user_id'], route_data['start_city'],
+                           [Stop(p['city'], p['ride_id'], 'pickup') for p in route_data['pickups']] +
+                           [Stop(d['city'], d['ride_id'], 'dropoff') for d in route_data['dropoffs']])
+        
         # Set rider location at first pickup point
         start_coords = route_data['pickups'][0]['coords']
         rider_location = {
@@ -674,7 +992,6 @@ def multi_route_view(ride_ids):
         
     except Exception as e:
         print(f"❌ Error in multi_route_view: {e}")
-        import traceback
         traceback.print_exc()
         flash(f'Error loading route: {str(e)}', 'error')
         return redirect(url_for('rider_dashboard'))
@@ -684,8 +1001,6 @@ def optimize_pool_route(rides):
     Intelligent pool route optimizer - picks up passengers optimally and drops them efficiently
     Uses A* to find shortest combined path considering all pickups and dropoffs
     """
-    from a_star import find_path, calculate_route_distance, haversine_distance
-    
     if not rides:
         return None
     
@@ -694,28 +1009,28 @@ def optimize_pool_route(rides):
     dropoffs = []
     
     for ride in rides:
-        pickup = {
-            'ride_id': ride['id'],
-            'user_name': ride.get('user_name', 'User'),
-            'city': ride['source'],
-            'coords': (ride['pickup_lat'], ride['pickup_lon']),
-            'type': 'pickup',
-            'passenger_id': ride['user_id']
-        }
+        pickup = PoolWaypoint.create(
+            ride_id=ride['id'],
+            user_name=ride.get('user_name', 'User'),
+            city=ride['source'],
+            coords=(ride['pickup_lat'], ride['pickup_lon']),
+            type='pickup',
+            passenger_id=ride['user_id']
+        )
         pickups.append(pickup)
         
         # Get destination
         try:
-            coords_list = eval(ride['coords'])
+            coords_list = decode_coords(ride['coords'])
             dest_coords = coords_list[-1]
-            dropoff = {
-                'ride_id': ride['id'],
-                'user_name': ride.get('user_name', 'User'),
-                'city': ride['destination'],
-                'coords': dest_coords,
-                'type': 'dropoff',
-                'passenger_id': ride['user_id']
-            }
+            dropoff = PoolWaypoint.create(
+                ride_id=ride['id'],
+                user_name=ride.get('user_name', 'User'),
+                city=ride['destination'],
+                coords=dest_coords,
+                type='dropoff',
+                passenger_id=ride['user_id']
+            )
             dropoffs.append(dropoff)
         except:
             pass
@@ -740,10 +1055,16 @@ def optimize_pool_route(rides):
     # Check if dropoffs share path or diverge
     dropoff_cities = [d['city'] for d in dropoffs]
     
+    # Routes from every pickup to a shared destination (one backward search)
+    passenger_routes = {}
+    
     # If multiple passengers going to same destination
     if len(set(dropoff_cities)) == 1:
         # All going to same place - drop all at once
         ordered_dropoffs = dropoffs
+        passenger_routes = find_paths_to([p['city'] for p in pickups], dropoff_cities[0])
+        for pickup in pickups:
+            pickup['direct_distance'] = passenger_routes[pickup['city']][1]
     else:
         # Different destinations - optimize order
         ordered_dropoffs = []
@@ -787,16 +1108,28 @@ def optimize_pool_route(rides):
         from_city = route_sequence[i]
         to_city = route_sequence[i + 1]
         
-        segment_path, segment_coords = find_path(from_city, to_city)
+        search_stats = {}
+        if from_city in passenger_routes and to_city == dropoff_cities[0] and passenger_routes[from_city][0]:
+            segment_path = passenger_routes[from_city][0]
+            segment_coords = [CITY_GRAPH[city]['coords'] for city in segment_path]
+        else:
+            # A search that runs out of time still gives the map a (straight) line
+            segment_path, segment_coords = find_path(from_city, to_city, search_stats, fallback=True)
         
         if segment_path and segment_coords:
-            # Record segment with action (pickup/dropoff)
+            # Segments point into the full path ([start, end] indexes) instead of repeating it
+            joined = bool(full_path) and segment_path[0] == full_path[-1]
+            start = len(full_path) - 1 if joined else len(full_path)
             segment_info = {
                 'from': from_city,
                 'to': to_city,
-                'path': segment_path,
+                'start': start,
+                'end': start + len(segment_path) - 1,
                 'distance': calculate_route_distance(segment_path)
             }
+            if search_stats.get('estimated'):
+                segment_info['estimated'] = True
+                segment_info['distance'] = heuristic(from_city, to_city)
             
             # Check if this segment includes pickup or dropoff
             for waypoint in all_waypoints:
@@ -807,10 +1140,7 @@ def optimize_pool_route(rides):
             route_segments.append(segment_info)
             
             # Add to full path (avoid duplicates at junction points)
-            if not full_path or segment_path[0] != full_path[-1]:
-                full_path.extend(segment_path)
-            else:
-                full_path.extend(segment_path[1:])
+            full_path.extend(segment_path[1:] if joined else segment_path)
             
             if not full_coords or segment_coords[0] != full_coords[-1]:
                 full_coords.extend(segment_coords)
@@ -822,17 +1152,19 @@ def optimize_pool_route(rides):
     
     return {
         'path': full_path,
-        'coords': full_coords,
+        'geometry': route_geometry(full_coords),
         'pickups': ordered_pickups,
         'dropoffs': ordered_dropoffs,
         'start_city': ordered_pickups[0]['city'],
         'route_segments': route_segments,
         'total_distance': round(total_distance, 2),
-        'waypoints': all_waypoints
+        # Stops are listed in full under pickups/dropoffs
+        'waypoints': [{'type': w['type'], 'ride_id': w['ride_id'], 'city': w['city']} for w in all_waypoints]
     }
 
+app = create_app()
+
 if __name__ == '__main__':
-    init_db()
     local_ip = get_local_ip()
     print("\n" + "="*60)
     print("🚗 Flask RideShare Application Starting...")
@@ -0,0 +1,186 @@
+"""
+Ride archival.
+
+Accepted rides older than a day and pending rides nobody took within a week
+are moved from the hot `rides` table into `rides_archive` in a separate
+SQLite file. The move runs in small chunks with a pause in between, so the
+hot table is never locked for long. Archived history stays available
+through a paginated query.
+
+SQLite cannot commit a transaction atomically across attached databases
+when the main one is in WAL mode, so each chunk is copied into the archive
+and committed first, and only the rows found in the archive are then
+deleted from `rides` in a second transaction. A crash in between leaves a
+ride in both files, and the next run finishes the move.
+
+Run once from the shell (waits for a running archiver to finish first):
+    python archive.py
+"""
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from shared_state import FileLock
+
+ACCEPTED_AFTER_DAYS = float(os.environ.get('RIDESHARE_ARCHIVE_ACCEPTED_DAYS', '1'))
+PENDING_AFTER_DAYS = float(os.environ.get('RIDESHARE_ARCHIVE_PENDING_DAYS', '7'))
+
+
+class RideArchiver:
+    """connect must return a new sqlite3 connection to the main database"""
+
+    def __init__(self, connect: Callable, archive_path: str, chunk_size: int = 500,
+                 pause: float = 0.05):
+        self.connect = connect
+        self.archive_path = archive_path
+        self.chunk_size = chunk_size
+        self.pause = pause
+        # Held while archiving, so only one worker (or the CLI) moves rows at a time
+        self._lock = FileLock(archive_path + '.lock')
+        self._thread: Optional[threading.Thread] = None
+
+    def _open(self):
+        conn = self.connect()
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        return conn
+
+    def ensure_schema(self):
+        """Create the archive (at boot); run_once also calls this to follow new rides columns"""
+        conn = self._open()
+        try:
+            self._ensure_schema(conn)
+        finally:
+            conn.close()
+
+    def _ensure_schema(self, conn):
+        """Create/extend rides_archive so it has every column rides has"""
+        columns = conn.execute('PRAGMA main.table_info(rides)').fetchall()
+        existing = {row[1] for row in conn.execute('PRAGMA archive.table_info(rides_archive)')}
+        if not existing:
+            defs = ['id INTEGER PRIMARY KEY']
+            defs += [f'{col[1]} {col[2]}' for col in columns if col[1] != 'id']
+            defs.append('archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+            conn.execute(f'CREATE TABLE archive.rides_archive ({", ".join(defs)})')
+            conn.execute('CREATE INDEX archive.idx_archive_user ON rides_archive (user_id, id)')
+            conn.execute('CREATE INDEX archive.idx_archive_rider ON rides_archive (rider_id, id)')
+        else:
+            for col in columns:
+                if col[1] not in existing:
+                    conn.execute(f'ALTER TABLE archive.rides_archive ADD COLUMN {col[1]} {col[2]}')
+        conn.commit()
+
+    def run_once(self) -> int:
+        """Archive every eligible ride, one chunk per transaction. Returns rows moved."""
+        conn = self._open()
+        moved = 0
+        try:
+            self._ensure_schema(conn)
+            columns = ', '.join(row[1] for row in conn.execute('PRAGMA main.table_info(rides)'))
+            while True:
+                ids = [row[0] for row in conn.execute('''
+                    SELECT id FROM rides
+                    WHERE (status = 'accepted' AND created_at < datetime('now', ?))
+                       OR (status = 'pending' AND created_at < datetime('now', ?))
+                    LIMIT ?
+                ''', (f'-{ACCEPTED_AFTER_DAYS} days', f'-{PENDING_AFTER_DAYS} days', self.chunk_size))]
+                if not ids:
+                    break
+
+                placeholders = ','.join('?' * len(ids))
+                # Replace, not ignore: a copy left by an interrupted run may be outdated
+                conn.execute(f'''INSERT OR REPLACE INTO archive.rides_archive ({columns})
+                                 SELECT {columns} FROM rides WHERE id IN ({placeholders})''', ids)
+                conn.commit()
+
+                # Only delete what the archive holds, as it was copied; a ride
+                # accepted in between stays and is archived again later
+                cur = conn.execute(f'''
+                    DELETE FROM rides WHERE id IN ({placeholders}) AND EXISTS (
+                        SELECT 1 FROM archive.rides_archive copy
+                        WHERE copy.id = rides.id AND copy.status = rides.status
+                          AND copy.rider_id IS rides.rider_id AND copy.path = rides.path)
+                ''', ids)
+                conn.commit()
+                if cur.rowcount < len(ids):
+                    print(f"⚠️ {len(ids) - cur.rowcount} rides changed while being archived, keeping them")
+                moved += cur.rowcount
+
+                if len(ids) < self.chunk_size:
+                    break
+                time.sleep(self.pause)  # let request writers in between chunks
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        metrics.inc('rideshare_rides_archived_total', value=moved)
+        return moved
+
+    def run_locked(self, blocking: bool = False) -> Optional[int]:
+        """run_once under the archive lock; None if another process holds it (blocking=False)"""
+        if not self._lock.acquire(blocking):
+            return None
+        try:
+            return self.run_once()
+        finally:
+            self._lock.release()
+
+    def start(self, interval: float):
+        """
+        Run run_once every interval seconds in a daemon thread. Every worker
+        process may start this; a lock file next to the archive makes sure
+        only one of them archives at a time.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    moved = self.run_locked()
+                    if moved:
+                        print(f"📦 Archived {moved} rides")
+                except Exception as e:
+                    print(f"❌ Error archiving rides: {e}")
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name='ride-archiver', daemon=True)
+        self._thread.start()
+
+    def history(self, user_id: int, before_id: Optional[int] = None,
+                limit: int = 20) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Archived rides where user_id was passenger or rider, newest first.
+        Returns (rides, next_before_id); next_before_id is None on the last page.
+        """
+        conn = self._open()
+        try:
+            rows = conn.execute('''
+                SELECT * FROM archive.rides_archive
+                WHERE (user_id = ? OR rider_id = ?) AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (user_id, user_id, before_id if before_id is not None else sys.maxsize, limit + 1)).fetchall()
+        finally:
+            conn.close()
+        rides = [dict(row) for row in rows[:limit]]
+        next_before = rides[-1]['id'] if len(rows) > limit else None
+        return rides, next_before
+
+
+if __name__ == '__main__':
+    from config import ARCHIVE_DB_PATH, open_configured_storage
+    storage = open_configured_storage()
+    if storage.name != 'sqlite':
+        print("⚠️ Archival only applies to the SQLite backend")
+        sys.exit(0)
+    ride_archiver = RideArchiver(storage.connect, ARCHIVE_DB_PATH)
+    try:
+        print(f"📦 Archived {ride_archiver.run_locked(blocking=True)} rides into {ride_archiver.archive_path}")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        sys.exit(1)
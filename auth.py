@@ -0,0 +1,180 @@
+"""
+Password hashing and login admission control.
+
+Password KDFs are slow on purpose. Instead of running them on whichever
+request thread happens to handle /login or /register, they run on a small
+fixed pool (RIDESHARE_HASH_WORKERS threads; hashlib's scrypt and pbkdf2
+release the GIL). The request thread still waits for its hash, so at most
+RIDESHARE_HASH_QUEUE hashes (default: one less than RIDESHARE_THREADS) may
+be waiting or running at once, and a hash that would wait longer than the
+timeout in the queue is not started either. Both are refused with
+HashingBusy straight away, so a login storm always leaves a request thread
+free for rides.
+
+The KDF is a werkzeug method string (RIDESHARE_PASSWORD_METHOD, e.g.
+"scrypt:32768:8:1" or "pbkdf2:sha256:600000"). A stored hash made with
+different parameters still verifies, and verify() hands back a fresh hash
+so the caller can store it: users migrate as they log in.
+
+TokenBuckets limits attempts per client IP and per email before any
+hashing happens.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Hashable, Optional, Tuple
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class HashingBusy(Exception):
+    """The hashing pool is full or did not answer in time; retry later"""
+
+    def __init__(self, retry_after: float = 1.0):
+        super().__init__('Password hashing is busy')
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    def __init__(self, method: str = DEFAULT_METHOD, workers: int = 2,
+                 max_pending: int = 3, timeout: float = 2.0):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._average = 0.0  # moving average of one hash, in seconds
+
+    def _admit(self):
+        """Take a pending slot, or raise HashingBusy if the hash would not finish in time"""
+        with self._lock:
+            # Hashes run `workers` at a time: ours starts after the rounds ahead of it
+            expected = (self._pending // self.workers + 1) * self._average
+            if self._pending >= self.max_pending:
+                reason = 'hash_queue_full'
+            elif expected > self.timeout:
+                reason = 'hash_queue_slow'
+            else:
+                self._pending += 1
+                return
+        metrics.inc('rideshare_auth_rejected_total', {'reason': reason})
+        raise HashingBusy(max(1.0, expected))
+
+    def _done(self, seconds: Optional[float] = None):
+        with self._lock:
+            self._pending -= 1
+            if seconds is not None:
+                self._average = seconds if not self._average else 0.8 * self._average + 0.2 * seconds
+
+    def _run(self, operation: str, fn, *args):
+        self._admit()
+        started = time.perf_counter()
+
+        def timed():
+            run_started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self._done(time.perf_counter() - run_started)
+
+        try:
+            future = self._pool.submit(timed)
+        except BaseException:
+            self._done()
+            raise
+        # The slot is held until the hash really finishes, even if we stop waiting
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            metrics.inc('rideshare_auth_rejected_total', {'reason': 'hash_timeout'})
+            raise HashingBusy()
+        finally:
+            metrics.observe('rideshare_auth_hash_seconds', time.perf_counter() - started,
+                            {'operation': operation})
+
+    def hash(self, password: str) -> str:
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def needs_rehash(self, stored: str) -> bool:
+        return stored.split('$', 1)[0] != self.method
+
+    def verify(self, stored: str, password: str) -> Tuple[bool, Optional[str]]:
+        """(matches, new_hash); new_hash is set when stored used other KDF parameters"""
+        if not self.needs_rehash(stored):
+            return self._run('verify', check_password_hash, stored, password), None
+
+        def verify_and_rehash():
+            if not check_password_hash(stored, password):
+                return False, None
+            return True, generate_password_hash(password, self.method)
+        return self._run('verify', verify_and_rehash)
+
+
+class TokenBuckets:
+    """
+    One token bucket per key: `burst` attempts at once, refilled at `rate`
+    per second. The least recently used keys are forgotten past max_keys.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[Hashable, Tuple[float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: Hashable, cost: float = 1.0) -> float:
+        """Spend cost tokens; returns 0 on success, else seconds until it would succeed"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class LoginGuard:
+    """Per-IP and per-email attempt limits in front of the password hasher"""
+
+    def __init__(self, per_ip_per_minute: float = 30, per_email_per_minute: float = 10):
+        self.by_ip = TokenBuckets(per_ip_per_minute / 60.0, per_ip_per_minute)
+        self.by_email = TokenBuckets(per_email_per_minute / 60.0, per_email_per_minute)
+
+    def admit(self, ip: Optional[str], email: Optional[str] = None) -> float:
+        """0 if the attempt may go ahead, else the Retry-After in seconds"""
+        wait = self.by_ip.take(ip or '')
+        if wait:
+            metrics.inc('rideshare_auth_rejected_total', {'reason': 'ip_rate'})
+            return wait
+        if email:
+            wait = self.by_email.take(email.strip().lower())
+            if wait:
+                metrics.inc('rideshare_auth_rejected_total', {'reason': 'email_rate'})
+        return wait
+
+
+def from_env() -> Tuple[PasswordHasher, LoginGuard]:
+    # Each waiting hash holds a request thread; keep one free for everything else
+    threads = int(os.environ.get('RIDESHARE_THREADS', '4'))
+    hasher = PasswordHasher(method=os.environ.get('RIDESHARE_PASSWORD_METHOD', DEFAULT_METHOD),
+                            workers=int(os.environ.get('RIDESHARE_HASH_WORKERS', '2')),
+                            max_pending=int(os.environ.get('RIDESHARE_HASH_QUEUE', str(max(1, threads - 1)))),
+                            timeout=float(os.environ.get('RIDESHARE_HASH_TIMEOUT', '2')))
+    guard = LoginGuard(per_ip_per_minute=float(os.environ.get('RIDESHARE_LOGIN_IP_PER_MIN', '30')),
+                       per_email_per_minute=float(os.environ.get('RIDESHARE_LOGIN_EMAIL_PER_MIN', '10')))
+    return hasher, guard
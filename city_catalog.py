@@ -0,0 +1,57 @@
+"""
+Static city data for the booking page.
+
+Everything here is derived from the routing graph once and reused by every
+request: the sorted city list, the same list as a JSON blob with a content
+hash (served under /cities.<hash>.json with long-lived, immutable cache
+headers, so the booking page does not send the list again on every visit),
+and a sorted prefix index for autocomplete.
+"""
+import hashlib
+import json
+import os
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+from a_star import get_all_cities
+
+# Above this many cities the booking page stops loading the full list and
+# the dropdowns query the autocomplete endpoint instead
+EMBED_LIMIT = int(os.environ.get('RIDESHARE_CITY_EMBED_LIMIT', '1000'))
+
+_catalog: Optional[Dict] = None
+
+
+def get_catalog() -> Dict:
+    """Build (once) and return the cached city data"""
+    global _catalog
+    if _catalog is None:
+        cities = get_all_cities()
+        cities_json = json.dumps(cities, separators=(',', ':')).encode()
+
+        _catalog = {
+            'cities': cities,
+            'cities_json': cities_json,
+            'hash': hashlib.sha256(cities_json).hexdigest()[:16],
+            'embed': len(cities) <= EMBED_LIMIT,
+            'prefix_index': sorted((city.lower(), city) for city in cities),
+        }
+    return _catalog
+
+
+def autocomplete(prefix: str, limit: int = 10) -> List[str]:
+    """Cities whose name starts with prefix (case-insensitive), alphabetical"""
+    index = get_catalog()['prefix_index']
+    prefix = prefix.strip().lower()
+    matches = []
+    for key, city in index[bisect_left(index, (prefix,)):]:
+        if not key.startswith(prefix) or len(matches) >= limit:
+            break
+        matches.append(city)
+    return matches
+
+
+def reset():
+    """Drop the cached data, e.g. after the graph changed"""
+    global _catalog
+    _catalog = None
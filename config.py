@@ -0,0 +1,25 @@
+"""
+Paths and backend settings shared by the app and the command line tools.
+
+Kept out of app.py so the CLIs (db.py, archive.py, storage.py check) can
+open the database without importing the app, which would create the
+schema, load the route snapshot and start the background threads.
+"""
+import os
+
+from storage import open_storage
+
+# Detect Render
+IS_RENDER = os.environ.get('RENDER') == 'true'
+DB_PATH = '/tmp/rideshare.db' if IS_RENDER else 'rideshare.db'
+ARCHIVE_DB_PATH = os.environ.get('RIDESHARE_ARCHIVE_DB',
+                                 '/tmp/rideshare_archive.db' if IS_RENDER else 'rideshare_archive.db')
+ROUTE_SNAPSHOT_PATH = os.environ.get('RIDESHARE_ROUTE_SNAPSHOT',
+                                     '/tmp/route_cache.json' if IS_RENDER else 'route_cache.json')
+# Proxies in front of the app whose X-Forwarded-For/-Proto are trusted (Render has one)
+PROXY_HOPS = int(os.environ.get('RIDESHARE_PROXY_HOPS', '1' if IS_RENDER else '0'))
+
+
+def open_configured_storage():
+    """SQLite at DB_PATH unless DATABASE_URL points elsewhere (see storage.py)"""
+    return open_storage(os.environ.get('DATABASE_URL'), DB_PATH)
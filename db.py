@@ -1,19 +1,75 @@
-# In Python shell or add to app.py temporarily
-import sqlite3
-
-conn = sqlite3.connect('rideshare.db')
-c = conn.cursor()
-
-# Find and remove duplicate rides (keep only the latest one for each user-source-dest combo)
-c.execute('''
-    DELETE FROM rides 
-    WHERE id NOT IN (
-        SELECT MAX(id) 
-        FROM rides 
-        GROUP BY user_id, source, destination, created_at
-    )
-''')
-
-conn.commit()
-print(f"Removed {c.rowcount} duplicate rides")
-conn.close()
+# Online dedupe for rides created by double-submitted bookings.
+# Bookings are idempotent now (see booking_idempotency_key in app.py); this
+# cleans up rows from before that. It walks the table in id order in small
+# batches and looks each ride's newer twin up through idx_rides_user_created
+# (user_id, created_at, id), so it can run against a live database without a
+# whole-table anti-join or building an index of its own. --dry-run walks the
+# same batches and only counts.
+#
+#   python db.py [--batch-size 500] [--dry-run]
+import sys
+import time
+
+from config import open_configured_storage
+
+
+def has_newer_twin(conn, ride_id, user_id, source, destination, created_at):
+    """True if a later ride has the same user, source, destination and created_at"""
+    # `= NULL` never matches, and `IS ?` is SQLite-only
+    created = 'created_at IS NULL' if created_at is None else 'created_at = ?'
+    params = [user_id] + ([] if created_at is None else [created_at]) + [ride_id, source, destination]
+    return conn.execute(f'''
+        SELECT 1 FROM rides
+        WHERE user_id = ? AND {created} AND id > ?
+          AND source = ? AND destination = ?
+        LIMIT 1
+    ''', params).fetchone() is not None
+
+
+def dedupe_rides(conn, batch_size=500, pause=0.05, dry_run=False):
+    """
+    Remove duplicate rides (same user, source, destination and created_at),
+    keeping the latest one. Returns the number of rides removed, or with
+    dry_run the number a real run would remove.
+    """
+    removed = 0
+    last_id = 0
+    while True:
+        batch = conn.execute('''
+            SELECT id, user_id, source, destination, created_at
+            FROM rides WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        duplicates = [(ride[0],) for ride in batch if has_newer_twin(conn, *ride)]
+        if duplicates and not dry_run:
+            conn.executemany('DELETE FROM rides WHERE id = ?', duplicates)
+            conn.commit()
+        removed += len(duplicates)
+        time.sleep(pause)  # keep the database free for live requests
+
+    return removed
+
+
+if __name__ == '__main__':
+    batch_size = 500
+    if '--batch-size' in sys.argv:
+        batch_size = int(sys.argv[sys.argv.index('--batch-size') + 1])
+    dry_run = '--dry-run' in sys.argv
+
+    storage = open_configured_storage()
+    conn = storage.connect()
+    try:
+        count = dedupe_rides(conn, batch_size=batch_size, dry_run=dry_run)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    if dry_run:
+        print(f"Found {count} duplicate rides (dry run, nothing removed)")
+    else:
+        print(f"Removed {count} duplicate rides")
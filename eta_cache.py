@@ -0,0 +1,58 @@
+"""
+Memoized rider -> pickup distances.
+
+A ride's pickup point never changes, and a rider's position only changes
+through UserRepository.set_location, which bumps users.location_epoch. So
+(rider, location epoch, ride) identifies a distance for good: dashboards
+and /api/my_rides look it up instead of redoing the haversine on every
+refresh. A rider's entries are dropped as soon as a newer epoch shows up.
+"""
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+import metrics
+
+AVERAGE_SPEED_KMH = 40
+
+
+class EtaCache:
+    """(rider_id, epoch, ride_id) -> (distance_km, eta_minutes), LRU over riders"""
+
+    def __init__(self, max_riders: int = 10000):
+        self.max_riders = max_riders
+        # rider_id -> (epoch, {ride_id: (distance_km, eta_minutes)})
+        self._riders: 'OrderedDict[int, Tuple[int, Dict[int, Tuple[float, int]]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, rider_id: int, epoch: int, ride_id: int,
+               compute: Callable[[], float]) -> Tuple[float, int]:
+        """Cached (distance_km, eta_minutes); compute() returns the distance on a miss"""
+        with self._lock:
+            entry = self._riders.get(rider_id)
+            if entry is not None and entry[0] == epoch:
+                self._riders.move_to_end(rider_id)
+                cached = entry[1].get(ride_id)
+                if cached is not None:
+                    metrics.inc('rideshare_eta_cache_total', {'result': 'hit'})
+                    return cached
+
+        distance = compute()
+        value = (round(distance, 2), int((distance / AVERAGE_SPEED_KMH) * 60))
+        metrics.inc('rideshare_eta_cache_total', {'result': 'miss'})
+
+        with self._lock:
+            entry = self._riders.get(rider_id)
+            if entry is None or entry[0] < epoch:
+                entry = (epoch, {})
+                self._riders[rider_id] = entry
+            if entry[0] == epoch:
+                entry[1][ride_id] = value
+            self._riders.move_to_end(rider_id)
+            while len(self._riders) > self.max_riders:
+                self._riders.popitem(last=False)
+        return value
+
+    def invalidate(self, rider_id: int):
+        with self._lock:
+            self._riders.pop(rider_id, None)
@@ -0,0 +1,120 @@
+"""
+Compact route geometry for maps and API payloads.
+
+Routes are lists of (lat, lon) points. Pages and APIs ship them as encoded
+polylines (the Google/OSRM format, precision 5) instead of JSON arrays, plus
+a few Douglas-Peucker simplified copies for low zoom levels, where the
+extra points are smaller than a pixel anyway. The map picks the coarsest
+level that still looks exact at its current zoom.
+"""
+import math
+from typing import Dict, List, Sequence, Tuple
+
+Point = Tuple[float, float]
+
+# Zoom levels that get a simplified copy; above the last one the full line is used
+ZOOM_LEVELS = (6, 9, 12)
+# Allowed deviation in screen pixels at each level's zoom
+PIXEL_TOLERANCE = 1.0
+EARTH_CIRCUMFERENCE_M = 40075016.686
+TILE_SIZE = 256
+
+
+def tolerance_m(zoom: float, lat: float, pixels: float = PIXEL_TOLERANCE) -> float:
+    """Ground distance covered by `pixels` screen pixels at zoom (web mercator)"""
+    return pixels * EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (TILE_SIZE * 2 ** zoom)
+
+
+def _project(points: Sequence[Point]) -> List[Tuple[float, float]]:
+    """Local equirectangular projection to metres, good enough for tolerance checks"""
+    lat0 = math.radians(sum(p[0] for p in points) / len(points))
+    scale = EARTH_CIRCUMFERENCE_M / 360.0
+    return [(p[1] * scale * math.cos(lat0), p[0] * scale) for p in points]
+
+
+def _segment_distance(p, a, b) -> float:
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length2))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def simplify(points: Sequence[Point], tolerance: float) -> List[Point]:
+    """Douglas-Peucker: drop points closer than tolerance metres to the simplified line"""
+    if len(points) < 3:
+        return list(points)
+    xy = _project(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, worst = None, tolerance
+        for i in range(first + 1, last):
+            d = _segment_distance(xy[i], xy[first], xy[last])
+            if d > worst:
+                farthest, worst = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, kept in zip(points, keep) if kept]
+
+
+def encode_polyline(points: Sequence[Point], precision: int = 5) -> str:
+    factor = 10 ** precision
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        ilat, ilon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (ilat - prev_lat, ilon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lon = ilat, ilon
+    return ''.join(chunks)
+
+
+def decode_polyline(text: str, precision: int = 5) -> List[Point]:
+    factor = 10 ** precision
+    points = []
+    index = lat = lon = 0
+    while index < len(text):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(text[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def route_geometry(points: Sequence[Point]) -> Dict:
+    """
+    {'polyline': full line, 'levels': [{'zoom': z, 'polyline': ...}, ...]}.
+    A level is only listed when it drops points compared to the next finer one.
+    """
+    points = [tuple(p) for p in points]
+    levels = []
+    if len(points) > 2:
+        lat = sum(p[0] for p in points) / len(points)
+        finer = len(points)
+        for zoom in reversed(ZOOM_LEVELS):
+            simplified = simplify(points, tolerance_m(zoom, lat))
+            if len(simplified) < finer:
+                levels.append({'zoom': zoom, 'polyline': encode_polyline(simplified)})
+                finer = len(simplified)
+        levels.reverse()
+    return {'polyline': encode_polyline(points), 'levels': levels}
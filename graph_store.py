@@ -0,0 +1,278 @@
+"""
+Partitioned on-disk road graph.
+
+The graph is split into lat/lon grid tiles. A directory holds:
+    index.json         tile list (city count and boundary cities per tile)
+                       and the named places, nothing per node
+    tiles/<id>.json    adjacency, coordinates and component of the tile's cities
+    nodes/<n>.json     city -> [tile, component], cities hashed into buckets
+                       of about NODES_PER_BUCKET
+Tiles and buckets are loaded on first use and kept in LRU caches, so a
+worker only holds the regions it actually routes through and never the
+full node list.
+
+Build a store from the built-in graph:
+    python graph_store.py build graph_tiles/ --tile-size 1.0
+and point the app at it with RIDESHARE_GRAPH_DIR=graph_tiles.
+"""
+import json
+import math
+import os
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Tuple
+
+import metrics
+
+FORMAT_VERSION = 2
+# 0 sizes the tile cache from the store: enough tiles to cover
+# CACHED_DEGREES x CACHED_DEGREES, whatever tile size it was built with
+DEFAULT_CACHED_TILES = int(os.environ.get('RIDESHARE_GRAPH_CACHE_TILES', '0'))
+CACHED_DEGREES = 8.0
+CACHED_BUCKETS = 64
+NODES_PER_BUCKET = 4096
+
+
+def tile_for(lat: float, lon: float, tile_size: float) -> str:
+    """Grid tile id for a coordinate, e.g. '16_80' for 1 degree tiles"""
+    return f"{math.floor(lat / tile_size)}_{math.floor(lon / tile_size)}"
+
+
+def bucket_for(city: str, buckets: int) -> int:
+    """Node bucket of a city name (stable across processes, unlike hash())"""
+    return zlib.crc32(city.encode()) % buckets
+
+
+def _cache_get(cache: 'OrderedDict', key, load, limit: int):
+    """LRU lookup; caller holds the lock"""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+        return value
+    value = cache[key] = load(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+    return value
+
+
+class PartitionedGraph(Mapping):
+    """
+    Read-only mapping with the same shape as CITY_GRAPH
+    ({city: {'coords': (lat, lon), 'neighbors': {...}}}) backed by tiles
+    on disk. Every node also carries 'predecessors' so backward searches
+    never need the whole graph.
+    """
+
+    def __init__(self, directory: str, max_tiles: int = DEFAULT_CACHED_TILES):
+        self.directory = directory
+        self._max_tiles = max_tiles
+        self._index: Optional[Dict] = None
+        self._tiles: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._buckets: 'OrderedDict[int, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def index(self) -> Dict:
+        if self._index is None:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                index = json.load(f)
+            if index.get('version') != FORMAT_VERSION:
+                raise ValueError(f"Unsupported graph store version in {self.directory}")
+            self._index = index
+        return self._index
+
+    @property
+    def heuristic_scale(self) -> float:
+        """Admissible heuristic scale computed when the store was built"""
+        return self.index['heuristic_scale']
+
+    @property
+    def max_tiles(self) -> int:
+        if self._max_tiles > 0:
+            return self._max_tiles
+        index = self.index
+        covering = math.ceil((CACHED_DEGREES / index['tile_size']) ** 2)
+        return max(1, min(covering, len(index['tiles'])))
+
+    def _read_tile(self, tile_id: str) -> Dict:
+        with open(os.path.join(self.directory, 'tiles', f'{tile_id}.json')) as f:
+            raw = json.load(f)
+        return {city: {
+            'coords': tuple(data['coords']),
+            'neighbors': data['neighbors'],
+            'predecessors': data['predecessors'],
+        } for city, data in raw.items()}
+
+    def _read_bucket(self, bucket: int) -> Dict:
+        with open(os.path.join(self.directory, 'nodes', f'{bucket}.json')) as f:
+            return json.load(f)
+
+    def _tile(self, tile_id: str) -> Dict:
+        with self._lock:
+            cached = tile_id in self._tiles
+            tile = _cache_get(self._tiles, tile_id, self._read_tile, self.max_tiles)
+            if not cached:
+                metrics.inc('rideshare_graph_tile_loads_total')
+                metrics.set_gauge('rideshare_graph_tiles_loaded', len(self._tiles))
+            return tile
+
+    def _entry(self, city) -> Optional[list]:
+        """[tile, component] for city, or None if it is not in the graph"""
+        if not isinstance(city, str):
+            return None
+        index = self.index
+        with self._lock:
+            bucket = _cache_get(self._buckets, bucket_for(city, index['buckets']),
+                                self._read_bucket, CACHED_BUCKETS)
+        return bucket.get(city)
+
+    def __getitem__(self, city: str) -> Dict:
+        entry = self._entry(city)
+        if entry is None:
+            raise KeyError(city)
+        return self._tile(entry[0])[city]
+
+    def __contains__(self, city) -> bool:
+        return self._entry(city) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        # Streams the buckets without caching them
+        for bucket in range(self.index['buckets']):
+            yield from self._read_bucket(bucket)
+
+    def __len__(self) -> int:
+        return self.index['node_count']
+
+    def places(self) -> Dict[str, str]:
+        """Named places (city -> tile): what users pick from, unlike bare junctions"""
+        return self.index['places']
+
+    def iter_coords(self) -> Iterator[Tuple[str, Tuple[float, float]]]:
+        """(city, coords) for every city, streaming one tile file at a time"""
+        for tile_id in self.index['tiles']:
+            for city, data in self._read_tile(tile_id).items():
+                yield city, data['coords']
+
+    def nearest(self, lat: float, lon: float, distance) -> Optional[str]:
+        """
+        Closest city to (lat, lon) by distance(lat1, lon1, lat2, lon2) in km.
+        Searches rings of tiles around the coordinate and stops once no
+        unsearched tile can hold anything closer.
+        """
+        index = self.index
+        size = index['tile_size']
+        row, col = math.floor(lat / size), math.floor(lon / size)
+        cells = [tuple(map(int, tile_id.split('_'))) for tile_id in index['tiles']]
+        if not cells:
+            return None
+        furthest = max(max(abs(r - row), abs(c - col)) for r, c in cells)
+
+        best, best_distance = None, float('inf')
+        for ring in range(furthest + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring or f'{r}_{c}' not in index['tiles']:
+                        continue
+                    for city, data in self._tile(f'{r}_{c}').items():
+                        d = distance(lat, lon, *data['coords'])
+                        if d < best_distance:
+                            best, best_distance = city, d
+            # Anything outside this ring is at least ring tiles away in
+            # latitude or longitude; a degree of longitude is shortest at
+            # the highest latitude those tiles can reach
+            reach = min(89.0, abs(lat) + (ring + 1) * size)
+            if best_distance <= ring * size * 111.0 * math.cos(math.radians(reach)):
+                break
+        return best
+
+    def component(self, city: str) -> Optional[int]:
+        """Connected component label, None if city is not in the graph"""
+        entry = self._entry(city)
+        return entry[1] if entry is not None else None
+
+    def loaded_tiles(self):
+        return list(self._tiles)
+
+
+def write_partitions(graph: Dict, directory: str, tile_size: float = 1.0,
+                     places=None) -> Dict:
+    """
+    Split a CITY_GRAPH-shaped dict into tiles under directory. places are
+    the user-facing city names (default: every city). Returns the written index.
+    """
+    from a_star import connected_components, haversine_distance
+
+    predecessors: Dict[str, Dict[str, float]] = {city: {} for city in graph}
+    scale = 1.0
+    for city, data in graph.items():
+        lat, lon = data['coords']
+        for neighbor, distance in data['neighbors'].items():
+            predecessors.setdefault(neighbor, {})[city] = distance
+            n_lat, n_lon = graph[neighbor]['coords']
+            straight = haversine_distance(lat, lon, n_lat, n_lon)
+            if straight > 0:
+                scale = min(scale, distance / straight)
+
+    components = connected_components(graph)
+    buckets = max(1, math.ceil(len(graph) / NODES_PER_BUCKET))
+    nodes: Dict[int, Dict[str, list]] = {bucket: {} for bucket in range(buckets)}
+    tile_of: Dict[str, str] = {}
+    tiles: Dict[str, Dict] = {}
+    for city, data in graph.items():
+        lat, lon = data['coords']
+        tile_id = tile_of[city] = tile_for(lat, lon, tile_size)
+        nodes[bucket_for(city, buckets)][city] = [tile_id, components[city]]
+        tiles.setdefault(tile_id, {})[city] = {
+            'coords': [lat, lon],
+            'neighbors': data['neighbors'],
+            'predecessors': predecessors[city],
+        }
+
+    # Boundary cities have at least one road into another tile
+    boundary: Dict[str, list] = {tile_id: [] for tile_id in tiles}
+    for city, data in graph.items():
+        tile_id = tile_of[city]
+        linked = list(data['neighbors']) + list(predecessors[city])
+        if any(tile_of[other] != tile_id for other in linked):
+            boundary[tile_id].append(city)
+
+    os.makedirs(os.path.join(directory, 'tiles'), exist_ok=True)
+    for tile_id, tile in tiles.items():
+        with open(os.path.join(directory, 'tiles', f'{tile_id}.json'), 'w') as f:
+            json.dump(tile, f, separators=(',', ':'))
+    os.makedirs(os.path.join(directory, 'nodes'), exist_ok=True)
+    for bucket, entries in nodes.items():
+        with open(os.path.join(directory, 'nodes', f'{bucket}.json'), 'w') as f:
+            json.dump(entries, f, separators=(',', ':'))
+
+    index = {
+        'version': FORMAT_VERSION,
+        'tile_size': tile_size,
+        'heuristic_scale': scale,
+        'node_count': len(graph),
+        'buckets': buckets,
+        'places': {city: tile_of[city] for city in (graph if places is None else places)
+                   if city in tile_of},
+        'tiles': {tile_id: {'cities': len(tile), 'boundary': boundary[tile_id]}
+                  for tile_id, tile in tiles.items()},
+    }
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'build':
+        print("Usage: python graph_store.py build <output_dir> [--tile-size DEGREES]")
+        sys.exit(1)
+
+    tile_size = 1.0
+    if '--tile-size' in sys.argv:
+        tile_size = float(sys.argv[sys.argv.index('--tile-size') + 1])
+
+    from a_star import BUILTIN_CITY_GRAPH
+    index = write_partitions(BUILTIN_CITY_GRAPH, sys.argv[2], tile_size)
+    print(f"✅ Wrote {index['node_count']} cities in {len(index['tiles'])} tiles to {sys.argv[2]}")
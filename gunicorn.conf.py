@@ -0,0 +1,43 @@
+"""
+Gunicorn settings for production.
+
+The app is imported once in the master (preload_app) so the graph, route
+structures and city catalog are built a single time and shared with the
+forked workers copy-on-write. Runtime caches that must agree across
+workers live in mmap'd files under RIDESHARE_SHARED_DIR (see
+shared_state.py). Background threads are started per worker after fork.
+
+    gunicorn app:app -c gunicorn.conf.py
+"""
+import multiprocessing
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Threads keep long-polling /api/ride_status from tying up a whole worker
+worker_class = 'gthread'
+threads = int(os.environ.get('RIDESHARE_THREADS', '4'))
+preload_app = True
+timeout = 120
+
+# Must be set before the app is imported by the master
+_own_shared_dir = 'RIDESHARE_SHARED_DIR' not in os.environ
+os.environ.setdefault('RIDESHARE_SHARED_DIR', f'/tmp/rideshare-shared-{os.getpid()}')
+os.environ['RIDESHARE_DEFER_JOBS'] = '1'
+
+
+def post_fork(server, worker):
+    import app
+    app.start_background_jobs()
+
+
+def worker_exit(server, worker):
+    # Each worker leaves its warm routes for the next start (last one wins)
+    import app
+    app.route_warmer.save_snapshot()
+
+
+def on_exit(server):
+    if _own_shared_dir:
+        shutil.rmtree(os.environ['RIDESHARE_SHARED_DIR'], ignore_errors=True)
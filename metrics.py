@@ -0,0 +1,337 @@
+"""
+Request instrumentation for the RideShare app.
+
+Collects timings for SQL statements, find_path searches, template renders
+and whole requests, and renders them in the Prometheus text format served
+by /metrics (to loopback clients, or to any client presenting
+RIDESHARE_METRICS_TOKEN as a bearer token). An opt-in sampling profiler (RIDESHARE_PROFILE=1) writes
+folded stacks for the slowest requests, ready for flamegraph.pl/speedscope.
+"""
+import heapq
+import hmac
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Latency buckets in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for "how many nodes did A* expand"
+NODE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 1000, 5000, 25000, 100000)
+
+# Without a token, /metrics only answers scrapes from the same host
+SCRAPE_TOKEN = os.environ.get('RIDESHARE_METRICS_TOKEN')
+LOOPBACK = ('127.0.0.1', '::1')
+
+_HELP = {
+    'rideshare_http_request_seconds': 'Total request time by endpoint and status',
+    'rideshare_sql_statement_seconds': 'SQL statement execution time by verb',
+    'rideshare_sql_statements_total': 'SQL statements run, by verb',
+    'rideshare_find_path_seconds': 'find_path call time by cache result',
+    'rideshare_find_path_expanded_nodes': 'Nodes expanded per uncached find_path search',
+    'rideshare_find_path_cutoff_total': 'find_path searches skipped (unreachable) or cut short (budget)',
+    'rideshare_template_render_seconds': 'Jinja template render time',
+    'rideshare_admission_total': 'Admission decisions by endpoint and result (admitted, rate_limited, concurrency, shed)',
+    'rideshare_admission_poll_share': 'Share of request threads polling endpoints may currently use',
+}
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+_gauges: Dict[Tuple[str, Tuple], float] = {}
+_histograms: Dict[Tuple[str, Tuple], 'Histogram'] = {}
+
+# Per-thread request accumulators (SQL count/time for the current request)
+_local = threading.local()
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _key(name: str, labels: Optional[Dict[str, str]]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def inc(name: str, labels: Optional[Dict[str, str]] = None, value: float = 1):
+    """Increase a counter"""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, labels: Optional[Dict[str, str]] = None):
+    """Set a gauge to an absolute value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, labels: Optional[Dict[str, str]] = None,
+            buckets=TIME_BUCKETS):
+    """Record one observation in a histogram"""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+
+def record_find_path(seconds: float, cache_hit: bool, expanded: int = 0):
+    """Called by a_star.find_path after every call"""
+    observe('rideshare_find_path_seconds', seconds, {'cache': 'hit' if cache_hit else 'miss'})
+    if not cache_hit:
+        observe('rideshare_find_path_expanded_nodes', expanded, buckets=NODE_BUCKETS)
+
+
+def _format_labels(labels: Tuple, extra: Optional[Tuple] = None) -> str:
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ''
+    parts = []
+    for k, v in items:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text exposition format"""
+    lines: List[str] = []
+    with _lock:
+        by_name = defaultdict(list)
+        for (name, labels), value in _counters.items():
+            by_name[(name, 'counter')].append((labels, value))
+        for (name, labels), value in _gauges.items():
+            by_name[(name, 'gauge')].append((labels, value))
+        for (name, labels), hist in _histograms.items():
+            by_name[(name, 'histogram')].append((labels, hist))
+
+        for (name, kind), series in sorted(by_name.items()):
+            if name in _HELP:
+                lines.append(f'# HELP {name} {_HELP[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series, key=lambda s: s[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {value.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value.count}')
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# SQL instrumentation
+# ---------------------------------------------------------------------------
+
+def scrape_allowed(request) -> bool:
+    """True if request may read /metrics"""
+    if SCRAPE_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), SCRAPE_TOKEN.encode())
+    return request.remote_addr in LOOPBACK
+
+
+def _verb(sql: str) -> str:
+    words = sql.split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+def trace_sql(statement: str):
+    """sqlite3 trace callback - counts every statement SQLite actually runs"""
+    inc('rideshare_sql_statements_total', {'verb': _verb(statement)})
+    acc = getattr(_local, 'request', None)
+    if acc is not None:
+        acc['sql_count'] += 1
+
+
+def timed_sql(method, sql, *args):
+    """Call method(sql, *args) and record how long the statement took"""
+    started = time.perf_counter()
+    try:
+        return method(sql, *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('rideshare_sql_statement_seconds', elapsed, {'verb': _verb(sql)})
+        acc = getattr(_local, 'request', None)
+        if acc is not None:
+            acc['sql_seconds'] += elapsed
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that times execute()/executemany() calls"""
+
+    def execute(self, sql, *args):
+        return timed_sql(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return timed_sql(super().executemany, sql, *args)
+
+
+def instrument_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Attach the trace callback to a connection"""
+    conn.set_trace_callback(trace_sql)
+    return conn
+
+
+# ---------------------------------------------------------------------------
+# Sampling profiler
+# ---------------------------------------------------------------------------
+
+class SamplingProfiler:
+    """
+    Samples the stacks of in-flight request threads and keeps the folded
+    stacks of the N slowest requests on disk
+    """
+
+    def __init__(self, output_dir: str, interval: float = 0.005, keep: int = 10):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.keep = keep
+        self._active: Dict[int, Counter] = {}
+        self._slowest: List[Tuple[float, str]] = []  # min-heap of (seconds, file)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_thread(self):
+        # Started lazily so a preloaded app gets a sampler in every forked worker
+        if self._thread is None or not self._thread.is_alive():
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='rideshare-profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None or ident == own_ident:
+                        continue
+                    stacks[_fold(frame)] += 1
+
+    def begin(self):
+        with self._lock:
+            self._ensure_thread()
+            self._active[threading.get_ident()] = Counter()
+
+    def end(self, label: str, seconds: float):
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+            if not stacks:
+                return
+            if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]:
+                return
+            safe_label = ''.join(ch if ch.isalnum() else '_' for ch in label)
+            filename = os.path.join(
+                self.output_dir, f'{int(seconds * 1000):06d}ms_{safe_label}_{int(time.time() * 1000)}.folded')
+            with open(filename, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            heapq.heappush(self._slowest, (seconds, filename))
+            if len(self._slowest) > self.keep:
+                _, evicted = heapq.heappop(self._slowest)
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+
+def _fold(frame) -> str:
+    """Collapse a frame chain into 'outer;...;inner' (flamegraph folded format)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+profiler: Optional[SamplingProfiler] = None
+
+
+# ---------------------------------------------------------------------------
+# Flask integration
+# ---------------------------------------------------------------------------
+
+def init_app(app):
+    """Register request/template hooks on a Flask app"""
+    global profiler
+    from flask import before_render_template, g, request, template_rendered
+
+    if os.environ.get('RIDESHARE_PROFILE') == '1' and profiler is None:
+        profiler = SamplingProfiler(
+            os.environ.get('RIDESHARE_PROFILE_DIR', 'profiles'),
+            interval=float(os.environ.get('RIDESHARE_PROFILE_INTERVAL_MS', '5')) / 1000,
+            keep=int(os.environ.get('RIDESHARE_PROFILE_KEEP', '10')))
+        print(f"📈 Sampling profiler enabled, writing to {profiler.output_dir}/")
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started = time.perf_counter()
+        _local.request = {'sql_count': 0, 'sql_seconds': 0.0}
+        _local.templates = []
+        if profiler is not None:
+            profiler.begin()
+
+    @app.after_request
+    def _stop_request_timer(response):
+        started = g.get('_metrics_started')
+        if started is not None:
+            elapsed = time.perf_counter() - started
+            endpoint = request.endpoint or 'unknown'
+            observe('rideshare_http_request_seconds', elapsed,
+                    {'endpoint': endpoint, 'status': str(response.status_code)})
+            acc = getattr(_local, 'request', None) or {}
+            response.headers['Server-Timing'] = (
+                f'total;dur={elapsed * 1000:.1f}, '
+                f'sql;dur={acc.get("sql_seconds", 0) * 1000:.1f};desc="{acc.get("sql_count", 0)} stmts"')
+        return response
+
+    @app.teardown_request
+    def _finish_request(exc):
+        # Runs even when the view or an after_request hook raised, so the
+        # profiler always stops sampling this thread
+        started = g.pop('_metrics_started', None)
+        if started is not None and profiler is not None:
+            profiler.end(request.endpoint or 'unknown', time.perf_counter() - started)
+        _local.request = None
+
+    def _template_started(sender, template, context, **extra):
+        stack = getattr(_local, 'templates', None)
+        if stack is None:
+            stack = _local.templates = []
+        stack.append(time.perf_counter())
+
+    def _template_finished(sender, template, context, **extra):
+        stack = getattr(_local, 'templates', None)
+        if stack:
+            observe('rideshare_template_render_seconds', time.perf_counter() - stack.pop(),
+                    {'template': template.name or 'inline'})
+
+    before_render_template.connect(_template_started, app, weak=False)
+    template_rendered.connect(_template_finished, app, weak=False)
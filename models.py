@@ -0,0 +1,186 @@
+"""
+Slotted row objects.
+
+SQLite connections use row_factory so every fetched row becomes a Ride or
+User (queries returning every column of that table, plus joined columns
+the model knows) or, for other shapes, a per-column-set Record class,
+filled through the slot descriptors with no dict per row. Views set computed values
+(rider_distance, eta_minutes, ...) on the row itself instead of copying it
+into a dict first.
+
+Rows still behave like sqlite3.Row for existing code: row['name'],
+row[0], row.keys(), dict(row) and unpacking all work. Jinja reads them as
+attributes, and the app's JSON provider (install_json) serialises them, so
+they can go straight to jsonify and |tojson.
+"""
+import keyword
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+_MISSING = object()
+
+
+class Model:
+    """Base for slotted rows; _columns is the query's column order (for row[0])"""
+    __slots__ = ('_columns',)
+    FIELDS: Tuple[str, ...] = ()
+    # Columns of the model's table; a query must return all of them to get this model
+    TABLE: Tuple[str, ...] = ()
+    # Readable as row['name'] but never serialised (to_dict, jsonify, |tojson, repr)
+    PRIVATE: Tuple[str, ...] = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self._columns[key]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [name for name in self.FIELDS if getattr(self, name, _MISSING) is not _MISSING]
+
+    def to_dict(self) -> Dict:
+        result = {}
+        for name in self.FIELDS:
+            if name in self.PRIVATE:
+                continue
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                result[name] = value
+        return result
+
+    # Like sqlite3.Row: iterating (and unpacking) gives the query's values in order
+    def __len__(self) -> int:
+        return len(self._columns)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._columns)
+
+    @classmethod
+    def create(cls, **values):
+        obj = cls.__new__(cls)
+        obj._columns = tuple(values)
+        for name, value in values.items():
+            setattr(obj, name, value)
+        return obj
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+def _slotted(name: str, fields: Tuple[str, ...], private: Tuple[str, ...] = (),
+             table: Tuple[str, ...] = ()):
+    return type(name, (Model,), {'__slots__': fields, 'FIELDS': fields, 'PRIVATE': private,
+                                 'TABLE': table})
+
+
+_RIDE_COLUMNS = (
+    'id', 'user_id', 'source', 'destination', 'path', 'coords', 'pickup_lat', 'pickup_lon',
+    'status', 'rider_id', 'rider_distance', 'pickup_time', 'created_at', 'idempotency_key',
+)
+_USER_COLUMNS = (
+    'id', 'name', 'email', 'password', 'role', 'current_lat', 'current_lon', 'location_epoch',
+)
+
+# Every column a ride query may return (rides.* plus joined user/rider
+# columns), then values the views compute per request
+Ride = _slotted('Ride', _RIDE_COLUMNS + (
+    'user_name', 'user_email',
+    'rider_name', 'rider_lat', 'rider_lon', 'rider_location_epoch',
+    'eta_minutes', 'distance_km',
+), table=_RIDE_COLUMNS)
+
+User = _slotted('User', _USER_COLUMNS, private=('password',), table=_USER_COLUMNS)
+
+# One stop of an optimized pool route (optimize_pool_route)
+PoolWaypoint = _slotted('PoolWaypoint', (
+    'ride_id', 'user_name', 'city', 'coords', 'type', 'passenger_id', 'direct_distance',
+))
+
+_MODELS = (Ride, User)
+_records: Dict[Tuple[str, ...], type] = {}
+_loaders: Dict[Tuple[type, Tuple[str, ...]], object] = {}
+# Last (cursor.description, loader): consecutive rows of a query share the description object
+_last: Tuple[Optional[tuple], object] = (None, None)
+
+
+def _model_for(columns: Tuple[str, ...]) -> type:
+    # A partial SELECT (e.g. "id, path" of rides, or any table sharing
+    # column names) gets a Record rather than a model with unset slots
+    names = set(columns)
+    for model in _MODELS:
+        if set(model.TABLE) <= names <= set(model.FIELDS):
+            return model
+    record = _records.get(columns)
+    if record is None:
+        private = tuple(name for name in columns if name in User.PRIVATE)
+        record = _records[columns] = _slotted('Record', columns, private)
+    return record
+
+
+def _make_loader(model: type, columns: Tuple[str, ...]):
+    """load(row) -> model instance, filled through the class's slot descriptors"""
+    new = object.__new__
+    setters = tuple(getattr(model, name).__set__ for name in columns)
+
+    def load(row):
+        obj = new(model)
+        obj._columns = columns
+        for set_value, value in zip(setters, row):
+            set_value(obj, value)
+        return obj
+    return load
+
+
+def loader_for(columns: Tuple[str, ...]):
+    """Row loader for a column list, or None when the names can't be slots"""
+    if len(set(columns)) != len(columns) or \
+            not all(name.isidentifier() and not keyword.iskeyword(name) for name in columns):
+        return None
+    model = _model_for(columns)
+    key = (model, columns)
+    loader = _loaders.get(key)
+    if loader is None:
+        loader = _loaders[key] = _make_loader(model, columns)
+    return loader
+
+
+def sqlite_row_factory(cursor: sqlite3.Cursor, row: tuple):
+    """sqlite3 row_factory; falls back to sqlite3.Row for e.g. SELECT COUNT(*)"""
+    global _last
+    description = cursor.description
+    last_description, loader = _last
+    if description is not last_description:
+        loader = loader_for(tuple(column[0] for column in description))
+        _last = (description, loader)
+    if loader is None:
+        return sqlite3.Row(cursor, row)
+    return loader(row)
+
+
+def json_default(value):
+    """json.dumps default= hook for models; everything else becomes a string"""
+    if isinstance(value, Model):
+        return value.to_dict()
+    return str(value)
+
+
+def install_json(app):
+    """Make jsonify and |tojson serialise models"""
+    from flask.json.provider import DefaultJSONProvider
+
+    class ModelJSONProvider(DefaultJSONProvider):
+        @staticmethod
+        def default(value):
+            if isinstance(value, Model):
+                return value.to_dict()
+            return DefaultJSONProvider.default(value)
+
+    app.json = ModelJSONProvider(app)
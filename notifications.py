@@ -0,0 +1,328 @@
+"""
+Notification fan-out for the RideShare app.
+
+Writes go through an in-process write-behind queue: new notifications and
+read-state changes are flushed to the database in batches by a background thread
+instead of inside the request that produced them. Each user's unread
+notifications are tracked in memory as a bitmap of ids, so a poll from a
+user with nothing unread is answered without touching the database.
+When several worker processes run, a shared per-user generation counter
+tells a worker that another one changed that user's notifications.
+
+A batch that fails to write is retried as a whole a few times; after that
+its rows are written one by one and the ones that still fail are logged and
+dropped, so one bad row cannot hold up everything queued behind it. At most
+max_queued notifications wait at once; more are dropped.
+"""
+import atexit
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+# Widest id range the bitmap int may span (4 KB); older unread ids go to a set
+MAX_SPAN = 1 << 15
+
+
+class UnreadBitmap:
+    """
+    Set of unread notification ids stored as bits of an int, offset by base.
+    Ids too far below the newest ones (a single old unread notification)
+    are kept in a small set instead, so the int never spans more than
+    MAX_SPAN ids.
+    """
+
+    __slots__ = ('base', 'bits', 'old')
+
+    def __init__(self, ids=()):
+        self.base = 0
+        self.bits = 0
+        self.old = set()
+        for notif_id in sorted(ids):
+            self.add(notif_id)
+
+    def add(self, notif_id: int):
+        if not self.bits:
+            self.base = notif_id
+        elif notif_id < self.base:
+            if self.base + self.bits.bit_length() - notif_id > MAX_SPAN:
+                self.old.add(notif_id)
+                return
+            self.bits <<= self.base - notif_id
+            self.base = notif_id
+        self.bits |= 1 << (notif_id - self.base)
+        # Move the oldest ids out until the span fits again
+        while self.bits.bit_length() > MAX_SPAN:
+            lowest = (self.bits & -self.bits).bit_length() - 1
+            self.old.add(self.base + lowest)
+            self.bits >>= lowest + 1
+            self.base += lowest + 1
+            self._trim()
+
+    def _trim(self):
+        """Drop the read (zero) bits below the oldest unread id"""
+        if self.bits:
+            lowest = (self.bits & -self.bits).bit_length() - 1
+            self.bits >>= lowest
+            self.base += lowest
+
+    def discard(self, notif_id: int) -> bool:
+        """Clear one id, returns True if it was unread"""
+        if notif_id in self.old:
+            self.old.discard(notif_id)
+            return True
+        offset = notif_id - self.base
+        if offset < 0 or not (self.bits >> offset) & 1:
+            return False
+        self.bits &= ~(1 << offset)
+        self._trim()
+        return True
+
+    def clear_upto(self, notif_id: int) -> int:
+        """Clear every id <= notif_id, returns how many were unread"""
+        old = {old_id for old_id in self.old if old_id <= notif_id}
+        self.old -= old
+        offset = notif_id - self.base + 1
+        if offset <= 0:
+            return len(old)
+        cleared = self.bits & ((1 << offset) - 1)
+        self.bits ^= cleared
+        self._trim()
+        return bin(cleared).count('1') + len(old)
+
+    def __len__(self) -> int:
+        return bin(self.bits).count('1') + len(self.old)
+
+
+class NotificationQueue:
+    """
+    Write-behind queue plus in-memory unread state.
+    connect must return a new storage.Database (app.get_db).
+    """
+
+    def __init__(self, connect: Callable, batch_size: int = 100, flush_interval: float = 0.25,
+                 max_queued: int = 10000, max_retries: int = 3):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self._failures = 0  # failed flushes in a row
+        self._inserts: List[Tuple[int, int, str, str]] = []
+        self._queued_at: List[str] = []  # created_at shown for each queued insert
+        self._reads: List[Tuple[int, int]] = []       # (user_id, notif_id)
+        self._read_upto: List[Tuple[int, int]] = []   # (user_id, max notif_id)
+        self._unread: Dict[int, UnreadBitmap] = {}
+        self._generations: Dict[int, int] = {}  # shared generation seen at load time
+        self._shared = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        atexit.register(self.flush)
+
+    def attach_shared(self, counters):
+        """Use shared_state.SharedCounters to stay in sync with other workers"""
+        self._shared = counters
+
+    def _generation_slot(self, user_id: int) -> int:
+        # Slot 0 belongs to the ride change feed
+        return 1 + user_id % (self._shared.size - 1)
+
+    # -- writes -------------------------------------------------------------
+
+    def enqueue(self, user_id: int, ride_id: int, message: str, notification_type: str):
+        """Queue a notification; it is written with the next batch"""
+        with self._lock:
+            if len(self._inserts) >= self.max_queued:
+                metrics.inc('rideshare_notifications_dropped_total', {'reason': 'queue_full'})
+                return
+            self._inserts.append((user_id, ride_id, message, notification_type))
+            self._queued_at.append(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+            backlog = len(self._inserts)
+        self._ensure_thread()
+        if backlog >= self.batch_size:
+            self._wakeup.set()
+
+    def mark_read(self, user_id: int, notif_id: int):
+        self._load_user(user_id)
+        with self._lock:
+            if self._unread[user_id].discard(notif_id):
+                self._reads.append((user_id, notif_id))
+        self._ensure_thread()
+
+    def mark_all_read(self, user_id: int, up_to_id: int) -> int:
+        """Mark every notification of user_id with id <= up_to_id as read"""
+        self._load_user(user_id)
+        with self._lock:
+            cleared = self._unread[user_id].clear_upto(up_to_id)
+            if cleared:
+                self._read_upto.append((user_id, up_to_id))
+        self._ensure_thread()
+        return cleared
+
+    def _write(self, inserts, reads, read_upto) -> List[Tuple[int, int]]:
+        """One transaction; returns (user_id, new notification id) per insert"""
+        conn = self.connect()
+        try:
+            new_ids = []
+            for row in inserts:
+                new_ids.append((row[0], conn.notifications.create(*row)))
+            if reads:
+                conn.notifications.mark_read(reads)
+            if read_upto:
+                conn.notifications.mark_read_upto(read_upto)
+            conn.commit()
+            return new_ids
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _write_each(self, inserts, reads, read_upto) -> List[Tuple[int, int]]:
+        """Write every row in its own transaction; rows that still fail are logged and dropped"""
+        new_ids = []
+        writes = ([(row, ([row], [], [])) for row in inserts] + [(row, ([], [row], [])) for row in reads]
+                  + [(row, ([], [], [row])) for row in read_upto])
+        for row, write in writes:
+            try:
+                new_ids += self._write(*write)
+            except Exception as e:
+                metrics.inc('rideshare_notifications_dropped_total', {'reason': 'write_failed'})
+                print(f"❌ Error: dropping notification write {row}: {e}")
+        return new_ids
+
+    def flush(self):
+        """
+        Write everything queued so far in one transaction. After max_retries
+        failed flushes in a row the rows are written one at a time instead.
+        """
+        with self._flush_lock:
+            with self._lock:
+                inserts, self._inserts = self._inserts, []
+                queued_at, self._queued_at = self._queued_at, []
+                reads, self._reads = self._reads, []
+                read_upto, self._read_upto = self._read_upto, []
+            if not (inserts or reads or read_upto):
+                return
+
+            if self._failures >= self.max_retries:
+                # The batch keeps failing: find the bad rows instead of retrying it again
+                new_ids = self._write_each(inserts, reads, read_upto)
+            else:
+                try:
+                    new_ids = self._write(inserts, reads, read_upto)
+                except Exception as e:
+                    self._failures += 1
+                    print(f"❌ Error flushing notifications (attempt {self._failures}): {e}")
+                    with self._lock:
+                        self._inserts[:0] = inserts
+                        self._queued_at[:0] = queued_at
+                        self._reads[:0] = reads
+                        self._read_upto[:0] = read_upto
+                    return
+            self._failures = 0
+
+            with self._lock:
+                for user_id, notif_id in new_ids:
+                    if user_id in self._unread:
+                        self._unread[user_id].add(notif_id)
+
+            if self._shared is not None:
+                touched = {row[0] for row in inserts} | {row[0] for row in reads} | {row[0] for row in read_upto}
+                for user_id in touched:
+                    generation = self._shared.incr(self._generation_slot(user_id))
+                    with self._lock:
+                        # Still current if nobody else wrote in between, else reload next time
+                        if self._generations.get(user_id) == generation - 1:
+                            self._generations[user_id] = generation
+                        else:
+                            self._unread.pop(user_id, None)
+            metrics.inc('rideshare_notification_flushes_total')
+            metrics.inc('rideshare_notifications_written_total', value=len(new_ids))
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='notification-flusher', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    # -- reads --------------------------------------------------------------
+
+    def _is_current(self, user_id: int) -> bool:
+        if user_id not in self._unread:
+            return False
+        if self._shared is None:
+            return True
+        return self._shared.get(self._generation_slot(user_id)) == self._generations.get(user_id)
+
+    def _load_user(self, user_id: int):
+        if self._is_current(user_id):
+            return
+        # Hold the flush lock so a batch committed meanwhile is not missed
+        with self._flush_lock:
+            if self._is_current(user_id):
+                return
+            if self._shared is not None:
+                self._generations[user_id] = self._shared.get(self._generation_slot(user_id))
+            conn = self.connect()
+            try:
+                ids = conn.notifications.unread_ids(user_id)
+            finally:
+                conn.close()
+            with self._lock:
+                self._unread[user_id] = UnreadBitmap(ids)
+
+    def _pending(self, user_id: int) -> List[Tuple[Tuple[int, int, str, str], str]]:
+        """This user's queued inserts (not written yet) with their queue time"""
+        with self._lock:
+            return [(row, queued_at) for row, queued_at in zip(self._inserts, self._queued_at)
+                    if row[0] == user_id]
+
+    def unread_count(self, user_id: int) -> int:
+        self._load_user(user_id)
+        with self._lock:
+            unread = len(self._unread[user_id])
+        return unread + len(self._pending(user_id))
+
+    def fetch_unread(self, user_id: int, limit: int = 10) -> List[Dict]:
+        """
+        Latest unread notifications, without a query if there are none.
+        Queued ones are read from the queue (they have no id yet) rather
+        than flushed from this request.
+        """
+        self._load_user(user_id)
+        with self._lock:
+            stored = len(self._unread[user_id])
+        if not stored and not self._pending(user_id):
+            metrics.inc('rideshare_notification_polls_total', {'source': 'memory'})
+            return []
+
+        metrics.inc('rideshare_notification_polls_total', {'source': 'db'})
+        conn = self.connect()
+        try:
+            rows = [dict(row) for row in conn.notifications.unread(user_id, limit)] if stored else []
+            # Read after the query, so a row flushed meanwhile is never listed
+            # twice (at worst it shows up on the next poll)
+            pending = self._pending(user_id)[-limit:]
+            queued = []
+            for (_, ride_id, message, notification_type), queued_at in reversed(pending):
+                ride = conn.rides.get(ride_id) if ride_id else None
+                queued.append({
+                    'id': None, 'user_id': user_id, 'ride_id': ride_id, 'message': message,
+                    'notification_type': notification_type, 'is_read': 0, 'created_at': queued_at,
+                    'source': ride['source'] if ride else None,
+                    'destination': ride['destination'] if ride else None,
+                })
+        finally:
+            conn.close()
+        return (queued + rows)[:limit]
@@ -0,0 +1,402 @@
+"""
+Build the routing graph from an OpenStreetMap extract.
+
+    python osm_import.py andhra-pradesh.osm.pbf graph_tiles/ [--major-only] [--tile-size 0.25]
+
+Reads .osm / .osm.gz / .osm.bz2 XML with a streaming parser, or .osm.pbf
+when pyosmium is installed. The file is read twice:
+
+1. ways: keep drivable highways (their node refs and direction, in flat
+   arrays) and count how many ways use each node;
+2. nodes: store coordinates for just those nodes.
+
+Per-node data (use counts, coordinates, names) is spilled to a scratch
+SQLite file under TMPDIR rather than held in dicts, so memory grows with
+the drivable ways and the junctions, not with every node of the extract.
+
+Ways are cut at junctions (nodes shared by several ways) and at their
+ends, then chains of degree-2 nodes that are left where ways meet end to
+end are contracted. Edge lengths are summed haversine_distance over the
+original geometry, in km. Only the largest connected road network is kept,
+and the result is written with graph_store.write_partitions, ready for
+RIDESHARE_GRAPH_DIR. Node names are "n<osm id>"; OSM node names are used
+instead when present and unique.
+"""
+import bz2
+import gzip
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from a_star import haversine_distance
+from graph_store import write_partitions
+
+try:
+    import osmium
+except ImportError:  # only needed for .pbf input
+    osmium = None
+
+MAJOR_HIGHWAYS = {
+    'motorway', 'trunk', 'primary', 'secondary', 'tertiary',
+    'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link',
+}
+DRIVABLE_HIGHWAYS = MAJOR_HIGHWAYS | {'unclassified', 'residential', 'living_street', 'road', 'service'}
+NO_ACCESS = {'no', 'private'}
+
+FORWARD, BACKWARD, BOTH = 1, -1, 0
+
+
+def is_drivable(tags: Dict[str, str], highways: Set[str]) -> bool:
+    if tags.get('highway') not in highways or tags.get('area') == 'yes':
+        return False
+    return tags.get('motor_vehicle', tags.get('access')) not in NO_ACCESS
+
+
+def direction(tags: Dict[str, str]) -> int:
+    oneway = tags.get('oneway')
+    if oneway in ('yes', 'true', '1'):
+        return FORWARD
+    if oneway == '-1':
+        return BACKWARD
+    if oneway is None and (tags.get('highway') in ('motorway', 'motorway_link') or tags.get('junction') == 'roundabout'):
+        return FORWARD
+    return BOTH
+
+
+def _open(path: str):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _iter_xml(path: str, tag: str) -> Iterator[ET.Element]:
+    """Yield <node> or <way> elements, clearing everything already seen"""
+    with _open(path) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag in ('node', 'way', 'relation'):
+                if element.tag == tag:
+                    yield element
+                root.clear()
+
+
+def iter_ways(path: str) -> Iterator[Tuple[int, List[int], Dict[str, str]]]:
+    """(way id, node refs, tags) for every way in the file"""
+    if path.endswith('.pbf'):
+        yield from _iter_pbf(path, ways=True)
+        return
+    for element in _iter_xml(path, 'way'):
+        refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+        tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+        yield int(element.get('id')), refs, tags
+
+
+def iter_nodes(path: str) -> Iterator[Tuple[int, float, float, Optional[str]]]:
+    """(node id, lat, lon, name) for every node in the file"""
+    if path.endswith('.pbf'):
+        yield from _iter_pbf(path, ways=False)
+        return
+    for element in _iter_xml(path, 'node'):
+        name = None
+        for tag in element.iter('tag'):
+            if tag.get('k') == 'name':
+                name = tag.get('v')
+        yield int(element.get('id')), float(element.get('lat')), float(element.get('lon')), name
+
+
+def _iter_pbf(path: str, ways: bool) -> Iterator:
+    if osmium is None:
+        raise RuntimeError('Reading .pbf files needs pyosmium (pip install osmium); '
+                           'or convert the extract to .osm.bz2 with osmium cat')
+    if ways:
+        reader = osmium.FileProcessor(path, osmium.osm.WAY)
+        for way in reader:
+            yield way.id, [n.ref for n in way.nodes], {t.k: t.v for t in way.tags}
+    else:
+        reader = osmium.FileProcessor(path, osmium.osm.NODE)
+        for node in reader:
+            yield node.id, node.location.lat, node.location.lon, node.tags.get('name')
+
+
+# Rows buffered in memory before they are written to the scratch database
+SPILL_BATCH = 50000
+# Bound variables per lookup query (older SQLite builds allow 999)
+LOOKUP_BATCH = 500
+
+
+class RoadNetwork:
+    """
+    Drivable ways of one extract, compacted into flat arrays. Per-node
+    data lives in a scratch SQLite file; call close() to remove it.
+    """
+
+    def __init__(self):
+        self.refs = array('q')        # node refs of all kept ways, back to back
+        self.way_starts = array('q')  # offset of each way in refs
+        self.way_directions = array('b')
+        self.names: Dict[int, str] = {}  # named junctions, filled by finish_nodes
+        fd, self._path = tempfile.mkstemp(prefix='osm_import_', suffix='.sqlite')
+        os.close(fd)
+        self._db = sqlite3.connect(self._path)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        # uses: ways (and way ends) using the node; lat/lon stay NULL for
+        # nodes clipped at the extract boundary
+        self._db.execute('CREATE TABLE nodes (id INTEGER PRIMARY KEY, uses INTEGER NOT NULL, '
+                         'lat REAL, lon REAL, name TEXT)')
+        self._uses: Dict[int, int] = defaultdict(int)
+        self._coords: List[Tuple] = []
+
+    def add_way(self, refs: List[int], way_direction: int):
+        self.way_starts.append(len(self.refs))
+        self.way_directions.append(way_direction)
+        self.refs.extend(refs)
+        for ref in refs:
+            self._uses[ref] += 1
+        # Way ends are always kept, even if no other way touches them
+        self._uses[refs[0]] += 1
+        self._uses[refs[-1]] += 1
+        if len(self._uses) >= SPILL_BATCH:
+            self._flush_uses()
+
+    def _flush_uses(self):
+        self._db.executemany('INSERT INTO nodes (id, uses) VALUES (?, ?) '
+                             'ON CONFLICT (id) DO UPDATE SET uses = uses + excluded.uses',
+                             self._uses.items())
+        self._uses.clear()
+
+    def ways(self) -> Iterator[Tuple[array, int]]:
+        starts = list(self.way_starts) + [len(self.refs)]
+        for i, direction_ in enumerate(self.way_directions):
+            yield self.refs[starts[i]:starts[i + 1]], direction_
+
+    def set_node(self, node_id: int, lat: float, lon: float, name: Optional[str]):
+        """Coordinates for any node in the file; nodes no kept way uses are ignored"""
+        self._coords.append((lat, lon, name, node_id))
+        if len(self._coords) >= SPILL_BATCH:
+            self._flush_coords()
+
+    def _flush_coords(self):
+        self._db.executemany('UPDATE nodes SET lat = ?, lon = ?, '
+                             'name = CASE WHEN uses > 1 THEN ? END WHERE id = ?', self._coords)
+        self._coords.clear()
+
+    def finish_ways(self):
+        self._flush_uses()
+        self._db.commit()
+
+    def finish_nodes(self):
+        self._flush_coords()
+        self._db.commit()
+        self.names = dict(self._db.execute('SELECT id, name FROM nodes WHERE name IS NOT NULL'))
+
+    def node_count(self) -> int:
+        """Nodes of kept ways that have coordinates"""
+        return self._db.execute('SELECT COUNT(*) FROM nodes WHERE lat IS NOT NULL').fetchone()[0]
+
+    def lookup(self, node_ids) -> Dict[int, Tuple[int, float, float]]:
+        """node id -> (uses, lat, lon) for the given nodes that have coordinates"""
+        node_ids = list(set(node_ids))
+        found = {}
+        for i in range(0, len(node_ids), LOOKUP_BATCH):
+            chunk = node_ids[i:i + LOOKUP_BATCH]
+            rows = self._db.execute(
+                f"SELECT id, uses, lat, lon FROM nodes WHERE id IN ({','.join('?' * len(chunk))}) "
+                f"AND lat IS NOT NULL", chunk)
+            for node_id, uses, lat, lon in rows:
+                found[node_id] = (uses, lat, lon)
+        return found
+
+    def close(self):
+        self._db.close()
+        os.remove(self._path)
+
+
+def read_network(path: str, highways: Set[str]) -> RoadNetwork:
+    network = RoadNetwork()
+    try:
+        for _, refs, tags in iter_ways(path):
+            if len(refs) >= 2 and is_drivable(tags, highways):
+                network.add_way(refs, direction(tags))
+        network.finish_ways()
+        for node_id, lat, lon, name in iter_nodes(path):
+            network.set_node(node_id, lat, lon, name)
+        network.finish_nodes()
+    except BaseException:
+        network.close()
+        raise
+    return network
+
+
+def build_junction_graph(network: RoadNetwork) -> Dict[int, Dict[int, float]]:
+    """Directed edges between junctions/way ends, lengths in km"""
+    edges: Dict[int, Dict[int, float]] = defaultdict(dict)
+    for refs, way_direction in network.ways():
+        nodes = network.lookup(refs)
+        start, length, prev = None, 0.0, None
+        for ref in refs:
+            if ref not in nodes:  # clipped at the extract boundary
+                start, length, prev = None, 0.0, None
+                continue
+            uses, lat, lon = nodes[ref]
+            here = (lat, lon)
+            if start is None:
+                start, prev = ref, here
+                continue
+            length += haversine_distance(prev[0], prev[1], here[0], here[1])
+            prev = here
+            if uses > 1 and ref != start:
+                if way_direction != BACKWARD:
+                    _add_edge(edges, start, ref, length)
+                if way_direction != FORWARD:
+                    _add_edge(edges, ref, start, length)
+                start, length = ref, 0.0
+    return edges
+
+
+def _add_edge(edges, a: int, b: int, km: float):
+    if km < edges[a].get(b, float('inf')):
+        edges[a][b] = km
+    edges.setdefault(b, {})
+
+
+def contract_chains(edges: Dict[int, Dict[int, float]], keep: Set[int] = frozenset()) -> int:
+    """
+    Remove nodes that only link two others (a - v - b, one way or both ways)
+    by joining a and b directly. Returns how many nodes were removed.
+    """
+    incoming: Dict[int, Dict[int, float]] = defaultdict(dict)
+    for a, out in edges.items():
+        for b, km in out.items():
+            incoming[b][a] = km
+
+    removed = 0
+    for v in list(edges):
+        if v in keep:
+            continue
+        out, inc = edges[v], incoming[v]
+        linked = set(out) | set(inc)
+        if len(linked) != 2 or v in linked:
+            continue
+        a, b = linked
+        if set(out) == linked and set(inc) == linked:
+            pairs = [(a, b), (b, a)]
+        elif len(out) == 1 and len(inc) == 1 and set(out) != set(inc):
+            pairs = [(next(iter(inc)), next(iter(out)))]
+        else:
+            continue
+        for x, y in pairs:
+            km = inc[x] + out[y]
+            if km < edges[x].get(y, float('inf')):
+                edges[x][y] = km
+                incoming[y][x] = km
+        for x in inc:
+            del edges[x][v]
+        for y in out:
+            del incoming[y][v]
+        del edges[v]
+        del incoming[v]
+        removed += 1
+    return removed
+
+
+def largest_component(edges: Dict[int, Dict[int, float]]) -> Set[int]:
+    """Nodes of the largest weakly connected component"""
+    undirected: Dict[int, Set[int]] = defaultdict(set)
+    for a, out in edges.items():
+        for b in out:
+            undirected[a].add(b)
+            undirected[b].add(a)
+    seen: Set[int] = set()
+    best: Set[int] = set()
+    for start in edges:
+        if start in seen:
+            continue
+        component = {start}
+        stack = [start]
+        while stack:
+            for other in undirected[stack.pop()]:
+                if other not in component:
+                    component.add(other)
+                    stack.append(other)
+        seen |= component
+        if len(component) > len(best):
+            best = component
+    return best
+
+
+def to_city_graph(network: RoadNetwork, edges: Dict[int, Dict[int, float]],
+                  nodes: Set[int]) -> Dict[str, Dict]:
+    name_counts = defaultdict(int)
+    for node_id in nodes:
+        if node_id in network.names:
+            name_counts[network.names[node_id]] += 1
+
+    def label(node_id: int) -> str:
+        name = network.names.get(node_id)
+        return name if name and name_counts[name] == 1 else f'n{node_id}'
+
+    coords = {node_id: (lat, lon) for node_id, (_, lat, lon) in network.lookup(nodes).items()}
+    graph = {}
+    for node_id in nodes:
+        graph[label(node_id)] = {
+            'coords': coords[node_id],
+            'neighbors': {label(b): round(km, 3) for b, km in edges[node_id].items() if b in nodes},
+        }
+    return graph
+
+
+def import_osm(path: str, output_dir: str, major_only: bool = False,
+               tile_size: float = 0.25) -> Dict:
+    started = time.perf_counter()
+    highways = MAJOR_HIGHWAYS if major_only else DRIVABLE_HIGHWAYS
+    network = read_network(path, highways)
+    try:
+        print(f"📥 {len(network.way_directions)} drivable ways, {network.node_count()} nodes "
+              f"({time.perf_counter() - started:.1f}s)")
+
+        edges = build_junction_graph(network)
+        junctions = len(edges)
+        # Named nodes are kept so they stay addressable as places
+        removed = contract_chains(edges, keep=set(network.names))
+        nodes = largest_component(edges)
+        print(f"🔗 {junctions} junctions, {removed} contracted, {len(nodes)} in the largest network")
+
+        graph = to_city_graph(network, edges, nodes)
+    finally:
+        network.close()
+    del network, edges
+    places = [city for city in graph if not (city[0] == 'n' and city[1:].isdigit())]
+    index = write_partitions(graph, output_dir, tile_size, places)
+    print(f"✅ Wrote {index['node_count']} nodes in {len(index['tiles'])} tiles to {output_dir} "
+          f"({time.perf_counter() - started:.1f}s)")
+    return index
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) < 2:
+        print("Usage: python osm_import.py <extract.osm[.bz2|.gz]|extract.osm.pbf> <output_dir> "
+              "[--major-only] [--tile-size DEGREES]")
+        sys.exit(1)
+
+    tile_size = 0.25
+    if '--tile-size' in sys.argv:
+        value = sys.argv[sys.argv.index('--tile-size') + 1]
+        tile_size = float(value)
+        args.remove(value)
+
+    try:
+        import_osm(args[0], args[1], major_only='--major-only' in sys.argv, tile_size=tile_size)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        sys.exit(1)
@@ -0,0 +1,114 @@
+"""
+Pool candidates by route overlap.
+
+An inverted index from directed road edge (a, b) to the pending rides whose
+stored path uses that edge. The rides that share the most kilometres with a
+given ride are found by walking only the posting lists of that ride's own
+edges, so the cost depends on how busy its roads are, not on how many rides
+are pending.
+
+The index follows the ride change feed: a 'booked' change adds the ride,
+'rerouted' re-adds it with its new path, any other change (accepted, ...)
+removes it. Changes committed by other
+worker processes reach it through the same feed.
+"""
+import heapq
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from a_star import calculate_route_distance
+
+Edge = Tuple[str, str]
+
+
+def path_edges(path: List[str]) -> List[Edge]:
+    return list(zip(path, path[1:]))
+
+
+class PoolIndex:
+    """connect must return a new storage.Database (app.get_db); feed is the app's RideChangeFeed"""
+
+    def __init__(self, connect: Callable, feed):
+        self.connect = connect
+        self.feed = feed
+        self._postings: Dict[Edge, Set[int]] = defaultdict(set)
+        self._rides: Dict[int, List[Edge]] = {}
+        self._cursor: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _add(self, ride_id: int, path: List[str]):
+        if ride_id in self._rides:
+            return
+        edges = path_edges(path)
+        self._rides[ride_id] = edges
+        for edge in edges:
+            self._postings[edge].add(ride_id)
+
+    def _remove(self, ride_id: int):
+        for edge in self._rides.pop(ride_id, ()):
+            riders = self._postings.get(edge)
+            if riders is not None:
+                riders.discard(ride_id)
+                if not riders:
+                    del self._postings[edge]
+
+    def sync(self):
+        """Load the pending rides once, then apply feed changes since the last sync"""
+        with self._lock:
+            if self._cursor is None:
+                # Take the cursor first: changes racing the load are replayed, and add/remove are idempotent
+                self._cursor = self.feed.latest_seq
+                conn = self.connect()
+                try:
+                    for row in conn.rides.pending_paths():
+                        self._add(row['id'], row['path'].split(','))
+                finally:
+                    conn.close()
+
+            while True:
+                changes, cursor = self.feed.all_changes_since(self._cursor)
+                booked = [c['ride_id'] for c in changes if c['change_type'] in ('booked', 'rerouted')]
+                paths = {}
+                if booked:
+                    conn = self.connect()
+                    try:
+                        paths = {row['id']: row for row in conn.rides.get_many_with_users(booked)}
+                    finally:
+                        conn.close()
+                for change in changes:
+                    ride = paths.get(change['ride_id'])
+                    if change['change_type'] == 'rerouted':
+                        self._remove(change['ride_id'])
+                    if (change['change_type'] in ('booked', 'rerouted') and ride is not None
+                            and ride['status'] == 'pending'):
+                        self._add(change['ride_id'], ride['path'].split(','))
+                    else:
+                        self._remove(change['ride_id'])
+                metrics.inc('rideshare_pool_index_changes_total', value=len(changes))
+                self._cursor = cursor
+                if not changes or cursor >= self.feed.latest_seq:
+                    break
+            metrics.set_gauge('rideshare_pool_index_rides', len(self._rides))
+
+    def candidates(self, path: List[str], k: int = 10, exclude: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Pending rides sharing the most road with path, as (ride_id, shared_km)
+        sorted by shared_km, best first
+        """
+        self.sync()
+        shared: Dict[int, float] = defaultdict(float)
+        with self._lock:
+            for edge in path_edges(path):
+                riders = self._postings.get(edge)
+                if not riders:
+                    continue
+                km = calculate_route_distance(list(edge))
+                for ride_id in riders:
+                    shared[ride_id] += km
+        shared.pop(exclude, None)
+        return heapq.nlargest(k, shared.items(), key=lambda item: (item[1], -item[0]))
+
+    def __len__(self) -> int:
+        return len(self._rides)
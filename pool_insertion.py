@@ -0,0 +1,371 @@
+"""
+Online insertion of new passengers into a pooled route.
+
+A pooled route is the rider's current city followed by the remaining
+pickup/dropoff stops. A new request is placed with cheapest insertion: every
+(pickup after stop i, dropoff after stop j >= i) position is tried against
+cached segment distances and the one adding the fewest kilometres wins,
+as long as
+
+- no passenger's ride exceeds their detour limit
+  (direct * (1 + max_detour) + detour_allowance_km),
+- the car never carries more than `capacity` passengers.
+
+Per-edge slack and load are precomputed once, so each candidate is checked
+in O(1) and a whole insertion is O(n^2) for n stops.
+"""
+import json
+import time
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from a_star import calculate_route_distance, find_path, find_paths_to
+
+INF = float('inf')
+
+Stop = namedtuple('Stop', ['city', 'ride_id', 'kind'])  # kind: 'pickup' or 'dropoff'
+Insertion = namedtuple('Insertion', ['stops', 'added_km', 'pickup_after', 'dropoff_after'])
+
+
+class SegmentDistances:
+    """Memoized shortest road distance between two cities (inf if unreachable)"""
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._cache: Dict[Tuple[str, str], float] = {}
+
+    def _put(self, key: Tuple[str, str], distance: float):
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+        self._cache[key] = distance
+
+    def get(self, a: str, b: str) -> float:
+        if a == b:
+            return 0.0
+        distance = self._cache.get((a, b))
+        if distance is None:
+            stats = {}
+            path, _ = find_path(a, b, stats)
+            distance = calculate_route_distance(path) if path else INF
+            # A search cut short by its budget is only an upper bound; ask again next time
+            if not stats['approximate']:
+                self._put((a, b), distance)
+        return distance
+
+    def prefetch_to(self, sources: List[str], destination: str):
+        """Fill distances from many sources to one city with a single backward search"""
+        missing = [s for s in set(sources) if s != destination and (s, destination) not in self._cache]
+        if missing:
+            stats = {}
+            for source, (_, distance) in find_paths_to(missing, destination, stats).items():
+                # Sources the budget did not reach are unknown, not unreachable
+                if distance is not None or not stats['approximate']:
+                    self._put((source, destination), distance if distance is not None else INF)
+
+
+class PoolRoute:
+    """
+    Remaining plan of one pooled trip. carried[ride_id] is the distance an
+    onboard passenger has already ridden; limits[ride_id] the most they may
+    ride in total.
+    """
+
+    def __init__(self, start: str, stops: List[Stop], limits: Dict[int, float],
+                 carried: Optional[Dict[int, float]] = None, capacity: int = 4, version: int = 0):
+        self.start = start
+        self.stops = stops
+        self.limits = limits
+        self.carried = carried or {}
+        self.capacity = capacity
+        self.version = version  # of the stored plan this was loaded from
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'start': self.start,
+            'stops': [list(stop) for stop in self.stops],
+            'limits': self.limits,
+            'carried': self.carried,
+            'capacity': self.capacity,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text: str, version: int = 0) -> 'PoolRoute':
+        data = json.loads(text)
+        return cls(data['start'], [Stop(*stop) for stop in data['stops']],
+                   {int(ride): km for ride, km in data['limits'].items()},
+                   {int(ride): km for ride, km in data['carried'].items()},
+                   data['capacity'], version)
+
+    def positions(self) -> List[str]:
+        """s_0 (rider's city) followed by the stop cities"""
+        return [self.start] + [stop.city for stop in self.stops]
+
+    def length(self, distances: SegmentDistances) -> float:
+        cities = self.positions()
+        return sum(distances.get(a, b) for a, b in zip(cities, cities[1:]))
+
+
+def ride_limit(direct_km: float, max_detour: float, detour_allowance_km: float) -> float:
+    return direct_km * (1 + max_detour) + detour_allowance_km
+
+
+def cheapest_insertion(route: PoolRoute, ride_id: int, pickup: str, dropoff: str,
+                       distances: SegmentDistances, max_detour: float = 0.5,
+                       detour_allowance_km: float = 5.0) -> Optional[Insertion]:
+    """Best feasible way to add ride_id (pickup -> dropoff) to route, or None"""
+    cities = route.positions()
+    n = len(route.stops)
+
+    distances.prefetch_to(cities, pickup)
+    distances.prefetch_to(cities + [pickup], dropoff)
+    to_p = [distances.get(c, pickup) for c in cities]
+    from_p = [distances.get(pickup, c) for c in cities]
+    to_d = [distances.get(c, dropoff) for c in cities]
+    from_d = [distances.get(dropoff, c) for c in cities]
+    edge = [distances.get(cities[t], cities[t + 1]) for t in range(n)]
+    direct = distances.get(pickup, dropoff)
+    if direct == INF:
+        return None
+    new_limit = ride_limit(direct, max_detour, detour_allowance_km)
+
+    # prefix[t]: route distance from s_0 to s_t
+    prefix = [0.0]
+    for km in edge:
+        prefix.append(prefix[-1] + km)
+
+    # Interval [a, b) of edges each passenger rides on, and their slack
+    pickup_at = {ride: 0 for ride in route.carried}  # onboard passengers ride from s_0
+    passengers = []
+    for index, stop in enumerate(route.stops, start=1):
+        if stop.kind == 'pickup':
+            pickup_at[stop.ride_id] = index
+        else:
+            a = pickup_at.get(stop.ride_id, 0)
+            ridden = route.carried.get(stop.ride_id, 0.0) + prefix[index] - prefix[a]
+            passengers.append((a, index, route.limits.get(stop.ride_id, INF) - ridden))
+
+    # Min slack and load per edge t (s_t -> s_t+1); load[n] = 0 after the last stop
+    cover_min = [INF] * (n + 1)
+    load = [0] * (n + 1)
+    for a, b, slack in passengers:
+        for t in range(a, b):
+            cover_min[t] = min(cover_min[t], slack)
+            load[t] += 1
+
+    best = None
+    for i in range(n + 1):
+        if to_p[i] == INF or load[i] + 1 > route.capacity:
+            continue
+
+        # Dropoff right after the pickup
+        delta = to_p[i] + direct + (from_d[i + 1] - edge[i] if i < n else 0.0)
+        if delta <= cover_min[i] and (best is None or delta < best[0]):
+            best = (delta, i, i)
+        if i == n:
+            continue
+
+        delta1 = to_p[i] + from_p[i + 1] - edge[i]
+        if delta1 > cover_min[i]:
+            continue
+
+        # both[j]: min slack of passengers riding over edge i and edge j
+        by_end: Dict[int, float] = {}
+        for a, b, slack in passengers:
+            if a <= i < b:
+                by_end[b] = min(by_end.get(b, INF), slack)
+        both = [INF] * (n + 2)
+        for j in range(n, i, -1):
+            both[j] = min(both[j + 1], by_end.get(j + 1, INF))
+
+        max_load = load[i]
+        for j in range(i + 1, n + 1):
+            max_load = max(max_load, load[j])
+            if max_load + 1 > route.capacity:
+                break
+            if to_d[j] == INF:
+                continue
+            delta2 = to_d[j] + (from_d[j + 1] - edge[j] if j < n else 0.0)
+            total = delta1 + delta2
+            if best is not None and total >= best[0]:
+                continue
+            own_ride = from_p[i + 1] + prefix[j] - prefix[i + 1] + to_d[j]
+            if delta2 <= cover_min[j] and total <= both[j] and own_ride <= new_limit:
+                best = (total, i, j)
+
+    if best is None:
+        return None
+    added, i, j = best
+    stops = list(route.stops)
+    stops.insert(j, Stop(dropoff, ride_id, 'dropoff'))
+    stops.insert(i, Stop(pickup, ride_id, 'pickup'))
+    return Insertion(stops, added, i, j)
+
+
+class PoolPlanner:
+    """
+    Active pooled routes by rider, updated by insertions and stop arrivals.
+    Plans are stored in the pool_plans table so every worker sees the same
+    one; each change re-reads the plan and saves it only if its version has
+    not moved on in the meantime.
+    """
+
+    def __init__(self, connect: Callable, max_detour: float = 0.5, detour_allowance_km: float = 5.0,
+                 capacity: int = 4, max_attempts: int = 5):
+        self.connect = connect
+        self.max_detour = max_detour
+        self.detour_allowance_km = detour_allowance_km
+        self.capacity = capacity
+        self.max_attempts = max_attempts
+        self.distances = SegmentDistances()
+
+    def _limit(self, pickup: str, dropoff: str) -> float:
+        return ride_limit(self.distances.get(pickup, dropoff), self.max_detour, self.detour_allowance_km)
+
+    @staticmethod
+    def _load(db, rider_id: int) -> Optional[PoolRoute]:
+        row = db.pool_plans.get(rider_id)
+        if row is None:
+            return None
+        return PoolRoute.from_json(row['plan'], row['version'])
+
+    def _new_route(self, start: str, stops: List[Stop]) -> PoolRoute:
+        route = PoolRoute(start, stops, {}, capacity=self.capacity)
+        cities = route.positions()
+        prefix = [0.0]
+        for a, b in zip(cities, cities[1:]):
+            prefix.append(prefix[-1] + self.distances.get(a, b))
+
+        picked_at = {}
+        for index, stop in enumerate(stops, start=1):
+            if stop.kind == 'pickup':
+                picked_at[stop.ride_id] = index
+            elif stop.ride_id in picked_at:
+                a = picked_at[stop.ride_id]
+                # The plan was made up front and may already exceed the detour limit
+                route.limits[stop.ride_id] = max(self._limit(stops[a - 1].city, stop.city),
+                                                 prefix[index] - prefix[a])
+        return route
+
+    def start(self, rider_id: int, start: str, stops: List[Stop]) -> PoolRoute:
+        """
+        Register the pool a rider is driving (e.g. from optimize_pool_route).
+        A stored plan that still serves one of these rides is kept, so
+        reloading the map keeps inserted passengers and reached stops.
+        """
+        ride_ids = {stop.ride_id for stop in stops}
+        for _ in range(self.max_attempts):
+            db = self.connect()
+            try:
+                current = self._load(db, rider_id)
+                if current is not None and any(stop.ride_id in ride_ids for stop in current.stops):
+                    return current
+                route = self._new_route(start, stops)
+                if current is None:
+                    saved = db.pool_plans.create(rider_id, route.to_json())
+                else:
+                    saved = db.pool_plans.update(rider_id, route.to_json(), current.version)
+                db.commit()
+                if saved:
+                    route.version = current.version + 1 if current else 1
+                    return route
+            finally:
+                db.close()
+        raise RuntimeError(f'Pool plan of rider {rider_id} keeps changing')
+
+    def get(self, rider_id: int) -> Optional[PoolRoute]:
+        db = self.connect()
+        try:
+            return self._load(db, rider_id)
+        finally:
+            db.close()
+
+    def _change(self, rider_id: int, change: Callable):
+        """
+        Apply change(route) to the stored plan and save it (a plan without
+        stops is deleted). Returns change's result; None, with nothing saved,
+        if there is no plan or change returned None.
+        """
+        for _ in range(self.max_attempts):
+            db = self.connect()
+            try:
+                route = self._load(db, rider_id)
+                if route is None:
+                    return None
+                result = change(route)
+                if result is None:
+                    return None
+                if route.stops:
+                    saved = db.pool_plans.update(rider_id, route.to_json(), route.version)
+                else:
+                    saved = db.pool_plans.delete(rider_id, route.version)
+                db.commit()
+                if saved:
+                    return result
+            finally:
+                db.close()
+        metrics.inc('rideshare_pool_insertions_total', {'result': 'conflict'})
+        return None
+
+    def plan_insertion(self, rider_id: int, ride_id: int, pickup: str, dropoff: str) -> Optional[Insertion]:
+        route = self.get(rider_id)
+        if route is None:
+            return None
+        return self._plan(route, ride_id, pickup, dropoff)
+
+    def _plan(self, route: PoolRoute, ride_id: int, pickup: str, dropoff: str) -> Optional[Insertion]:
+        started = time.perf_counter()
+        insertion = cheapest_insertion(route, ride_id, pickup, dropoff, self.distances,
+                                       self.max_detour, self.detour_allowance_km)
+        metrics.observe('rideshare_pool_insertion_seconds', time.perf_counter() - started)
+        metrics.inc('rideshare_pool_insertions_total',
+                    {'result': 'feasible' if insertion else 'infeasible'})
+        return insertion
+
+    def apply(self, rider_id: int, ride_id: int, pickup: str, dropoff: str,
+              insertion: Insertion) -> Optional[Insertion]:
+        """
+        Save a planned insertion. If the plan changed since (a stop reached,
+        another passenger added) the ride is planned again on the stored
+        route. Returns the insertion saved, or None when the pool has ended
+        or the ride no longer fits.
+        """
+        def insert(route: PoolRoute) -> Optional[Insertion]:
+            if any(stop.ride_id == ride_id for stop in route.stops):
+                return None
+            planned = insertion
+            if [stop for stop in insertion.stops if stop.ride_id != ride_id] != route.stops:
+                planned = self._plan(route, ride_id, pickup, dropoff)
+                if planned is None:
+                    return None
+            route.stops = list(planned.stops)
+            route.limits[ride_id] = self._limit(pickup, dropoff)
+            return planned
+        return self._change(rider_id, insert)
+
+    def withdraw(self, rider_id: int, ride_id: int):
+        """Take a ride back out of the plan (e.g. its acceptance failed)"""
+        def remove(route: PoolRoute) -> bool:
+            route.stops = [stop for stop in route.stops if stop.ride_id != ride_id]
+            route.limits.pop(ride_id, None)
+            route.carried.pop(ride_id, None)
+            return True
+        self._change(rider_id, remove)
+
+    def advance(self, rider_id: int) -> Optional[Stop]:
+        """The rider reached the next stop; returns it (None when the pool is done)"""
+        def reach_next(route: PoolRoute) -> Optional[Stop]:
+            if not route.stops:
+                return None
+            stop = route.stops.pop(0)
+            leg = self.distances.get(route.start, stop.city)
+            for ride in route.carried:
+                route.carried[ride] += leg
+            if stop.kind == 'pickup':
+                route.carried[stop.ride_id] = 0.0
+            else:
+                route.carried.pop(stop.ride_id, None)
+                route.limits.pop(stop.ride_id, None)
+            route.start = stop.city
+            return stop
+        return self._change(rider_id, reach_next)
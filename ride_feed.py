@@ -0,0 +1,196 @@
+"""
+Ride change feed.
+
+Every ride mutation (book, accept, multi-accept) appends a row to the
+ride_changes table inside the same transaction, so each change gets a
+global, monotonically increasing sequence number. Clients ask for "changes
+since seq N" instead of keeping timestamps in their session. Recent changes
+are kept in an in-memory ring buffer, which answers most polls, and a
+long-poll caller can wait on a condition until a new change arrives.
+With several worker processes, the latest seq is also published to a
+shared counter; a worker that sees it ahead of its buffer catches up from
+the table.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+
+class RideChangeFeed:
+    """connect must return a new storage.Database (app.get_db)"""
+
+    SHARED_POLL_INTERVAL = 0.25
+
+    def __init__(self, connect: Callable, capacity: int = 1024):
+        self.connect = connect
+        self.capacity = capacity
+        self._buffer: deque = deque(maxlen=capacity)
+        self._latest = 0
+        self._loaded = False
+        self._condition = threading.Condition()
+        self._shared = None
+
+    def attach_shared(self, counters):
+        """Use slot 0 of shared_state.SharedCounters as the cross-worker latest seq"""
+        self._shared = counters
+
+    def _load(self):
+        """Fill the ring buffer with the most recent changes from the database"""
+        if self._loaded:
+            return
+        conn = self.connect()
+        try:
+            rows = conn.rides.recent_changes(self.capacity)
+        finally:
+            conn.close()
+        with self._condition:
+            if not self._loaded:
+                self._buffer.extend(dict(row) for row in reversed(rows))
+                self._latest = rows[0]['seq'] if rows else 0
+                self._loaded = True
+
+    @contextmanager
+    def recording(self, conn):
+        """
+        Use around a ride mutation:
+
+            with ride_feed.recording(conn) as record:
+                conn.rides.accept(ride_id, rider_id)
+                record(ride_id, user_id, rider_id, 'accepted')
+
+        The transaction is committed when the block exits (rolled back if it
+        raises) and the recorded changes are published to waiting pollers
+        afterwards. There is no lock on our side: the database hands out seq
+        in commit order (SQLite has one writer at a time, Postgres takes an
+        advisory lock in record_change), and _catch_up appends by seq.
+        Keep slow work such as route searches out of the block - the write
+        transaction is open for as long as it runs.
+        """
+        self._load()
+        recorded = []
+
+        def record(ride_id: int, user_id: int, rider_id: Optional[int], change_type: str):
+            recorded.append(conn.rides.record_change(ride_id, user_id, rider_id, change_type))
+
+        try:
+            yield record
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if recorded:
+            metrics.inc('rideshare_ride_changes_total', value=len(recorded))
+            # Also picks up changes other threads and workers committed since our
+            # last look, so the buffer stays gap-free and in seq order
+            self._catch_up(conn)
+            if self._shared is not None:
+                self._shared.set_max(0, self._latest)
+
+    def _catch_up(self, conn=None):
+        """Append every committed change newer than the buffer and wake pollers"""
+        own = conn is None
+        if own:
+            conn = self.connect()
+        try:
+            rows = conn.rides.changes_after(self._latest)
+        finally:
+            if own:
+                conn.close()
+        if not rows:
+            return
+        with self._condition:
+            for row in rows:
+                if row['seq'] > self._latest:
+                    self._buffer.append(dict(row))
+                    self._latest = row['seq']
+            self._condition.notify_all()
+
+    def _sync_shared(self):
+        if self._shared is not None and self._shared.get(0) > self._latest:
+            self._catch_up()
+
+    @property
+    def latest_seq(self) -> int:
+        self._load()
+        self._sync_shared()
+        return self._latest
+
+    def _from_buffer(self, user_id: int, since: int) -> Optional[Tuple[List[Dict], int]]:
+        """Changes for user_id after since, or None if the buffer no longer covers since"""
+        with self._condition:
+            if self._buffer and since < self._buffer[0]['seq'] - 1:
+                return None
+            changes = [c for c in self._buffer
+                       if c['seq'] > since and user_id in (c['user_id'], c['rider_id'])]
+            return changes, max(since, self._latest)
+
+    def _from_db(self, user_id: int, since: int, limit: int) -> Tuple[List[Dict], int]:
+        conn = self.connect()
+        try:
+            rows = conn.rides.changes_for_user(user_id, since, limit)
+            if len(rows) == limit:
+                # More remain - resume after the last returned change
+                return [dict(row) for row in rows], rows[-1]['seq']
+            latest = conn.rides.latest_change_seq()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows], max(since, latest)
+
+    def all_changes_since(self, since: int, limit: int = 1000) -> Tuple[List[Dict], int]:
+        """
+        Every change with seq > since, whoever it concerns - for in-process
+        consumers that follow all rides (pool_index). Returns (changes, cursor).
+        """
+        self._load()
+        self._sync_shared()
+        with self._condition:
+            if not self._buffer or since >= self._buffer[0]['seq'] - 1:
+                changes = [c for c in self._buffer if c['seq'] > since][:limit]
+                if len(changes) == limit:
+                    return changes, changes[-1]['seq']
+                return changes, max(since, self._latest)
+
+        conn = self.connect()
+        try:
+            rows = [dict(row) for row in conn.rides.changes_after(since, limit)]
+        finally:
+            conn.close()
+        return rows, (rows[-1]['seq'] if rows else since)
+
+    def changes_since(self, user_id: int, since: int, wait: float = 0,
+                      limit: int = 500) -> Tuple[List[Dict], int]:
+        """
+        Changes to user_id's rides (as passenger or rider) with seq > since.
+        Returns (changes, cursor); pass cursor as `since` on the next call.
+        With wait > 0 the call blocks up to that many seconds for a change.
+        """
+        self._load()
+        deadline = time.monotonic() + wait
+        while True:
+            self._sync_shared()
+            answer = self._from_buffer(user_id, since)
+            if answer is None:
+                metrics.inc('rideshare_ride_feed_reads_total', {'source': 'db'})
+                return self._from_db(user_id, since, limit)
+
+            changes, cursor = answer
+            if changes or wait <= 0:
+                metrics.inc('rideshare_ride_feed_reads_total', {'source': 'memory'})
+                return changes[:limit], (changes[limit - 1]['seq'] if len(changes) > limit else cursor)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.inc('rideshare_ride_feed_reads_total', {'source': 'memory'})
+                return [], cursor
+            if self._shared is not None:
+                # Changes made by other workers don't notify our condition
+                remaining = min(remaining, self.SHARED_POLL_INTERVAL)
+            with self._condition:
+                if self._latest <= cursor:
+                    self._condition.wait(remaining)
+            since = cursor
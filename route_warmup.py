@@ -0,0 +1,186 @@
+"""
+Route cache warm-up and refinement.
+
+A fresh process starts with an empty route cache, so the first requests
+after a deploy pay for full A* searches. Two things avoid that:
+
+- a snapshot: the cached routes are written to RIDESHARE_ROUTE_SNAPSHOT
+  when a worker exits and loaded back (no searching) when the app is
+  created. It is ignored if the road graph changed in between;
+- demand warm-up: a background thread searches the most booked
+  (source, destination) pairs and the most common rider -> pickup pairs
+  (route_demand table) until everything is cached or the time budget
+  runs out.
+
+RouteRefiner works the other way round: a booking whose route search ran
+out of budget stores the best route found so far, and a background thread
+searches that pair again without the request's deadline and swaps in the
+shortest route.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+import metrics
+from a_star import cached_routes, find_path, graph_fingerprint, seed_routes
+from storage import encode_coords
+
+SNAPSHOT_VERSION = 1
+
+
+class RouteWarmer:
+    def __init__(self, connect: Callable, snapshot_path: Optional[str], max_pairs: int = 1000,
+                 budget_seconds: float = 30.0, max_snapshot_routes: int = 20000):
+        self.connect = connect
+        self.snapshot_path = snapshot_path or None
+        self.max_pairs = max_pairs
+        self.budget_seconds = budget_seconds
+        self.max_snapshot_routes = max_snapshot_routes
+        self._thread: Optional[threading.Thread] = None
+
+    def load_snapshot(self) -> int:
+        """Seed the route cache from the last snapshot; returns how many routes were loaded"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error: could not read route snapshot: {e}")
+            return 0
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('graph') != graph_fingerprint():
+            print("⚠️ Route snapshot is for another graph, ignoring it")
+            return 0
+        loaded = seed_routes(snapshot['routes'])
+        metrics.inc('rideshare_route_warmup_routes_total', {'source': 'snapshot'}, loaded)
+        print(f"🔥 Loaded {loaded} cached routes from {self.snapshot_path}")
+        return loaded
+
+    def save_snapshot(self) -> int:
+        """Write the cached routes out (atomically); returns how many were saved"""
+        if not self.snapshot_path:
+            return 0
+        routes = cached_routes(limit=self.max_snapshot_routes)
+        temp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'version': SNAPSHOT_VERSION, 'graph': graph_fingerprint(), 'routes': routes},
+                          f, separators=(',', ':'))
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"❌ Error: could not save route snapshot: {e}")
+            return 0
+        return len(routes)
+
+    def demand_pairs(self) -> List[Tuple[str, str]]:
+        """Booked routes and rider -> pickup routes, most frequent first"""
+        conn = self.connect()
+        try:
+            rows = list(conn.rides.popular_routes(self.max_pairs)) + list(conn.route_demand.top(self.max_pairs))
+        finally:
+            conn.close()
+        rows.sort(key=lambda row: row['hits'], reverse=True)
+        pairs = []
+        seen = set()
+        for row in rows:
+            pair = (row['source'], row['destination'])
+            if pair not in seen and pair[0] != pair[1]:
+                seen.add(pair)
+                pairs.append(pair)
+        return pairs[:self.max_pairs]
+
+    def warm(self) -> int:
+        """Search demand pairs until done or out of budget; returns how many were searched"""
+        started = time.perf_counter()
+        searched = 0
+        try:
+            pairs = self.demand_pairs()
+        except Exception as e:
+            print(f"❌ Error: route warm-up could not read demand: {e}")
+            return 0
+        for source, destination in pairs:
+            if time.perf_counter() - started > self.budget_seconds:
+                break
+            stats = {}
+            find_path(source, destination, stats)
+            if not stats['cache_hit']:
+                searched += 1
+            time.sleep(0)  # let request threads in between searches
+        metrics.inc('rideshare_route_warmup_routes_total', {'source': 'demand'}, searched)
+        print(f"🔥 Warmed {searched} routes of {len(pairs)} demand pairs "
+              f"in {time.perf_counter() - started:.1f}s")
+        return searched
+
+    def start(self):
+        if self.budget_seconds <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self.warm, name='route-warmup', daemon=True)
+        self._thread.start()
+
+
+class RouteRefiner:
+    """
+    Background re-search of routes booked from a budget-cut search.
+    connect must return a new storage.Database (app.get_db); feed is the
+    app's RideChangeFeed, which gets a 'rerouted' change for every
+    replaced route. At most max_pending rides wait; more are dropped and
+    keep their first route.
+    """
+
+    def __init__(self, connect: Callable, feed, deadline: float = 60.0, max_pending: int = 1000):
+        self.connect = connect
+        self.feed = feed
+        self.deadline = deadline
+        self._pending: deque = deque()
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def refine(self, ride_id: int, source: str, destination: str, path: str):
+        """Queue ride_id, booked with path, for a search without the request budget"""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                metrics.inc('rideshare_route_refine_total', {'result': 'dropped'})
+                return
+            self._pending.append((ride_id, source, destination, path))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='route-refiner', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    job = self._pending.popleft()
+                try:
+                    self.refine_now(*job)
+                except Exception as e:
+                    print(f"❌ Error: could not refine route of ride {job[0]}: {e}")
+
+    def refine_now(self, ride_id: int, source: str, destination: str, path: str) -> bool:
+        """Search the pair again; returns True if a shorter route replaced path"""
+        stats = {}
+        new_path, coords = find_path(source, destination, stats, deadline=self.deadline, max_expansions=0)
+        if not new_path or stats['approximate'] or ','.join(new_path) == path:
+            metrics.inc('rideshare_route_refine_total', {'result': 'kept'})
+            return False
+        conn = self.connect()
+        try:
+            with self.feed.recording(conn) as record:
+                ride = conn.rides.get(ride_id)
+                if ride is None or not conn.rides.set_route(ride_id, path, ','.join(new_path), encode_coords(coords)):
+                    return False
+                record(ride_id, ride['user_id'], ride['rider_id'], 'rerouted')
+        finally:
+            conn.close()
+        metrics.inc('rideshare_route_refine_total', {'result': 'replaced'})
+        return True
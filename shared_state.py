@@ -0,0 +1,196 @@
+"""
+State shared between gunicorn worker processes.
+
+With `preload_app` the master imports the app once and forks the workers.
+Read-only structures (the graph, city catalog) are then shared
+copy-on-write. Anything that changes at runtime lives in mmap'd files under
+RIDESHARE_SHARED_DIR, created before the fork so every worker maps the
+same pages:
+
+- SharedRouteCache: fixed-size hash table of computed routes, so a route
+  found by one worker is a cache hit in all of them.
+- SharedCounters: 64-bit counters the in-memory caches of other modules use
+  to notice writes made by another worker (change feed position,
+  per-user notification generations).
+
+Writers serialize with flock on the backing file, opened separately in
+every process (a flock belongs to the open file, which forked workers and
+threads would otherwise share) behind a per-process thread lock. Readers
+take no lock:
+every route slot carries a version that is odd while it is being written,
+and a reader that sees it change retries or treats the slot as a miss.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows dev server - single process, no sharing needed
+    fcntl = None
+
+import metrics
+
+
+def _map_file(path: str, size: int) -> Tuple[int, mmap.mmap]:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    return fd, mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+
+class _WriterLock:
+    """Exclusive lock on a shared file across the threads of all processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # A forked child must not reuse the parent's descriptor or thread lock
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl is not None:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDWR)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class SharedCounters:
+    """Array of unsigned 64-bit counters in shared memory"""
+
+    def __init__(self, path: str, size: int = 4096):
+        self.size = size
+        self._fd, self._map = _map_file(path, size * 8)
+        self._lock = _WriterLock(path)
+
+    def get(self, slot: int) -> int:
+        return struct.unpack_from('<Q', self._map, (slot % self.size) * 8)[0]
+
+    def incr(self, slot: int) -> int:
+        offset = (slot % self.size) * 8
+        with self._lock:
+            value = struct.unpack_from('<Q', self._map, offset)[0] + 1
+            struct.pack_into('<Q', self._map, offset, value)
+        return value
+
+    def set_max(self, slot: int, value: int) -> int:
+        offset = (slot % self.size) * 8
+        with self._lock:
+            current = struct.unpack_from('<Q', self._map, offset)[0]
+            if value > current:
+                struct.pack_into('<Q', self._map, offset, value)
+                current = value
+        return current
+
+
+# Slot header: version (Q), key digest (8s), payload length (I)
+_SLOT_HEADER = struct.Struct('<Q8sI')
+
+
+class SharedRouteCache:
+    """
+    Direct-mapped cache of (start, goal, mode) -> path. Each slot holds one
+    route; a new route whose key hashes to an occupied slot replaces it.
+    Routes longer than a slot are simply not shared.
+    """
+
+    def __init__(self, path: str, slots: int = 8192, slot_size: int = 1024):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._fd, self._map = _map_file(path, slots * slot_size)
+        self._lock = _WriterLock(path)
+
+    def _locate(self, key) -> Tuple[int, bytes]:
+        digest = hashlib.blake2b(json.dumps(key).encode(), digest_size=8).digest()
+        return (int.from_bytes(digest, 'little') % self.slots) * self.slot_size, digest
+
+    def get(self, key) -> Optional[List[str]]:
+        offset, digest = self._locate(key)
+        for _ in range(3):
+            version, slot_digest, length = _SLOT_HEADER.unpack_from(self._map, offset)
+            if version % 2:
+                continue  # being written right now
+            if slot_digest != digest or length == 0:
+                metrics.inc('rideshare_shared_route_cache_total', {'result': 'miss'})
+                return None
+            start = offset + _SLOT_HEADER.size
+            payload = self._map[start:start + length]
+            if _SLOT_HEADER.unpack_from(self._map, offset)[0] != version:
+                continue  # overwritten while we read it
+            stored_key, path = json.loads(payload)
+            if tuple(stored_key) != tuple(key):
+                break
+            metrics.inc('rideshare_shared_route_cache_total', {'result': 'hit'})
+            return path
+        metrics.inc('rideshare_shared_route_cache_total', {'result': 'miss'})
+        return None
+
+    def put(self, key, path: List[str]):
+        payload = json.dumps([list(key), path], separators=(',', ':')).encode()
+        if _SLOT_HEADER.size + len(payload) > self.slot_size:
+            return
+        offset, digest = self._locate(key)
+        with self._lock:
+            version = _SLOT_HEADER.unpack_from(self._map, offset)[0]
+            _SLOT_HEADER.pack_into(self._map, offset, version + 1, digest, 0)
+            start = offset + _SLOT_HEADER.size
+            self._map[start:start + len(payload)] = payload
+            _SLOT_HEADER.pack_into(self._map, offset, version + 2, digest, len(payload))
+
+
+class FileLock:
+    """Non-blocking inter-process lock, e.g. to run a periodic job in one worker only"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking: bool = False) -> bool:
+        if fcntl is None:
+            return True
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def release(self):
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def open_shared_state(directory: str) -> Tuple[SharedCounters, SharedRouteCache]:
+    """Create/map fresh shared files; call before workers are forked"""
+    os.makedirs(directory, exist_ok=True)
+    for name in ('counters.bin', 'routes.bin'):
+        # Leftovers from a previous run would hold stale counters
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    counters = SharedCounters(os.path.join(directory, 'counters.bin'))
+    routes = SharedRouteCache(
+        os.path.join(directory, 'routes.bin'),
+        slots=int(os.environ.get('RIDESHARE_SHARED_ROUTE_SLOTS', '8192')),
+        slot_size=int(os.environ.get('RIDESHARE_SHARED_ROUTE_SLOT_BYTES', '1024')))
+    return counters, routes
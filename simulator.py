@@ -0,0 +1,400 @@
+"""
+Discrete-event fleet simulator.
+
+Virtual drivers move along find_path routes in simulated time while
+generated demand goes through the app's real booking and acceptance code
+(create_booking, accept_pending_ride) against a scratch database. The
+nearest idle driver is found with one backward search from the pickup
+(find_paths_to). At the end it reports throughput, passenger wait times,
+routing cost and how much faster than real time the run was.
+
+    python simulator.py [--drivers 2000] [--passengers 1000] [--demand 3000]
+                        [--hours 4] [--speed 40] [--max-wait 20]
+                        [--max-pickup-km 60] [--od uniform|gravity|hotspot:<city>]
+                        [--arrivals poisson|constant] [--seed 1] [--database URL]
+
+Demand is requests per simulated hour. OD pairs are drawn uniformly,
+proportional to each city's road degree (gravity), or with half of all
+trips starting at one hotspot city. By default a fresh SQLite file in a
+temp directory is used, so the real database is never touched.
+"""
+import heapq
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+DEFAULTS = {
+    'drivers': 2000,
+    'passengers': 1000,
+    'demand': 3000.0,      # requests per simulated hour
+    'hours': 4.0,
+    'speed': 40.0,         # km/h
+    'max_wait': 20.0,      # minutes before an undispatched passenger gives up
+    'max_pickup_km': 60.0,
+    'od': 'gravity',
+    'arrivals': 'poisson',
+    'seed': 1,
+    'database': None,
+}
+
+# Waiting requests looked at when a driver frees up
+DISPATCH_SCAN = 20
+
+
+class Request:
+    __slots__ = ('ride_id', 'user_id', 'source', 'destination', 'path', 'requested_at',
+                 'accepted_at', 'picked_up_at')
+
+    def __init__(self, ride: Dict, user_id: int, requested_at: float):
+        self.ride_id = ride['id']
+        self.user_id = user_id
+        self.source = ride['source']
+        self.destination = ride['destination']
+        self.path = ride['path']
+        self.requested_at = requested_at
+        self.accepted_at = None
+        self.picked_up_at = None
+
+
+class Driver:
+    __slots__ = ('user_id', 'city', 'route', 'leg', 'phase', 'request', 'busy_since')
+
+    def __init__(self, user_id: int, city: str):
+        self.user_id = user_id
+        self.city = city
+        self.route: List[str] = []
+        self.leg = 0
+        self.phase = 'idle'   # idle -> to_pickup -> on_trip -> idle
+        self.request: Optional[Request] = None
+        self.busy_since = 0.0
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class FleetSimulation:
+    """
+    One run. `app` is the imported app module; the simulation only calls
+    its public booking/acceptance functions and repositories.
+    """
+
+    def __init__(self, app, config: Dict):
+        self.app = app
+        self.graph = app.CITY_GRAPH
+        self.config = config
+        self.rng = random.Random(config['seed'])
+        self.now = 0.0
+        self._events: List[Tuple[float, int, str, object]] = []
+        self._seq = 0
+
+        self.drivers: List[Driver] = []
+        self.idle: Dict[str, List[Driver]] = defaultdict(list)
+        self.waiting: 'OrderedDict[int, Request]' = OrderedDict()
+        self.passengers: List[int] = []
+
+        self.counts = defaultdict(int)
+        self.waits: List[float] = []           # request -> pickup, minutes
+        self.dispatch_delays: List[float] = []  # request -> accept, minutes
+        self.busy_seconds = 0.0
+        self.deadhead_km = 0.0
+        self.revenue_km = 0.0
+        self.call_seconds = defaultdict(float)  # wall time inside app/routing calls
+        self.dispatch_expanded = 0
+
+        cities = sorted(self.graph.keys())
+        self.cities = cities
+        self.origin_weights, self.destination_weights = self._od_weights(config['od'])
+
+    # -- setup --------------------------------------------------------------
+
+    def _od_weights(self, od: str) -> Tuple[List[float], List[float]]:
+        if od == 'uniform':
+            weights = [1.0] * len(self.cities)
+            return weights, weights
+        if od == 'gravity':
+            weights = [float(len(self.graph[city]['neighbors'])) for city in self.cities]
+            return weights, weights
+        if od.startswith('hotspot:'):
+            hotspot = od.split(':', 1)[1]
+            if hotspot not in self.graph:
+                raise ValueError(f'Unknown hotspot city: {hotspot}')
+            # Half of all trips start at the hotspot
+            others = len(self.cities) - 1
+            origins = [others if city == hotspot else 1.0 for city in self.cities]
+            return origins, [1.0] * len(self.cities)
+        raise ValueError(f'Unknown OD distribution: {od}')
+
+    def _create_users(self):
+        # One precomputed hash: hashing thousands of passwords would dominate setup
+        password = self.app.password_hasher.hash(uuid.uuid4().hex)
+        run = uuid.uuid4().hex[:8]
+        conn = self.app.get_db()
+        try:
+            for i in range(self.config['passengers']):
+                self.passengers.append(conn.users.create(f'Sim Passenger {i}', f'sim-{run}-p{i}@example.com',
+                                                         password, 'user'))
+            starts = self.rng.choices(self.cities, weights=self.origin_weights, k=self.config['drivers'])
+            for i, city in enumerate(starts):
+                user_id = conn.users.create(f'Sim Driver {i}', f'sim-{run}-d{i}@example.com', password, 'rider')
+                lat, lon = self.graph[city]['coords']
+                conn.users.set_location(user_id, lat, lon)
+                driver = Driver(user_id, city)
+                self.drivers.append(driver)
+                self.idle[city].append(driver)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # -- event queue --------------------------------------------------------
+
+    def _schedule(self, at: float, kind: str, payload=None):
+        self._seq += 1
+        heapq.heappush(self._events, (at, self._seq, kind, payload))
+
+    def _next_arrival_gap(self) -> float:
+        rate = self.config['demand'] / 3600  # per simulated second
+        if self.config['arrivals'] == 'constant':
+            return 1 / rate
+        return self.rng.expovariate(rate)
+
+    def _timed_call(self, label: str, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.call_seconds[label] += time.perf_counter() - started
+
+    # -- events -------------------------------------------------------------
+
+    def _on_request(self, _):
+        self._schedule(self.now + self._next_arrival_gap(), 'request')
+        self.counts['requests'] += 1
+
+        source = self.rng.choices(self.cities, weights=self.origin_weights)[0]
+        destination = source
+        while destination == source:
+            destination = self.rng.choices(self.cities, weights=self.destination_weights)[0]
+        user_id = self.rng.choice(self.passengers)
+
+        ride, _ = self._timed_call('book', self.app.create_booking, user_id, source, destination,
+                                   uuid.uuid4().hex)
+        if ride is None:
+            self.counts['no_route'] += 1
+            return
+
+        request = Request(ride, user_id, self.now)
+        self.waiting[request.ride_id] = request
+        self._schedule(self.now + self.config['max_wait'] * 60, 'give_up', request)
+        self._dispatch(request)
+
+    def _on_give_up(self, request: Request):
+        if self.waiting.pop(request.ride_id, None) is not None:
+            self.counts['abandoned'] += 1
+
+    def _on_arrive(self, driver: Driver):
+        km = self._edge_km(driver.city, driver.route[driver.leg])
+        if driver.phase == 'to_pickup':
+            self.deadhead_km += km
+        else:
+            self.revenue_km += km
+        driver.city = driver.route[driver.leg]
+        if driver.leg + 1 < len(driver.route):
+            self._drive_next_leg(driver)
+        else:
+            self._route_finished(driver)
+
+    # -- dispatch and driving -----------------------------------------------
+
+    def _dispatch(self, request: Request) -> bool:
+        """Give request to the nearest idle driver by road, if one is close enough"""
+        cities = [city for city, drivers in self.idle.items() if drivers]
+        if not cities:
+            return False
+        stats = {}
+        routes = self._timed_call('dispatch_search', self.app.find_paths_to, cities, request.source, stats)
+        self.dispatch_expanded += stats.get('expanded', 0)
+        self.counts['dispatch_searches'] += 1
+
+        reachable = [(distance, city) for city, (_, distance) in routes.items()
+                     if distance is not None and distance <= self.config['max_pickup_km']]
+        if not reachable:
+            return False
+        _, city = min(reachable)
+        driver = self.idle[city].pop()
+
+        try:
+            result = self._timed_call('accept', self.app.accept_pending_ride, driver.user_id,
+                                      request.ride_id, rider_position=self.graph[city]['coords'])
+        except self.app.RideUnavailable:
+            self.idle[city].append(driver)
+            self.waiting.pop(request.ride_id, None)
+            return False
+
+        self.waiting.pop(request.ride_id, None)
+        request.accepted_at = self.now
+        self.dispatch_delays.append((self.now - request.requested_at) / 60)
+        self.counts['dispatched'] += 1
+
+        driver.phase = 'to_pickup'
+        driver.request = request
+        driver.busy_since = self.now
+        self._start_route(driver, result['rider_to_pickup_path'])
+        return True
+
+    def _dispatch_waiting(self):
+        for request in list(self.waiting.values())[:DISPATCH_SCAN]:
+            if not any(self.idle.values()):
+                return
+            self._dispatch(request)
+
+    def _edge_km(self, a: str, b: str) -> float:
+        distance = self.graph[a]['neighbors'].get(b)
+        if distance is None:
+            # accept_pending_ride falls back to a straight hop when there is no route
+            distance = self.app.calculate_distance(*self.graph[a]['coords'], *self.graph[b]['coords'])
+        return distance
+
+    def _start_route(self, driver: Driver, route: List[str]):
+        driver.route = route
+        driver.leg = 0
+        if len(route) < 2:
+            self._route_finished(driver)
+        else:
+            self._drive_next_leg(driver)
+
+    def _drive_next_leg(self, driver: Driver):
+        km = self._edge_km(driver.route[driver.leg], driver.route[driver.leg + 1])
+        driver.leg += 1
+        self._schedule(self.now + km / self.config['speed'] * 3600, 'arrive', driver)
+
+    def _route_finished(self, driver: Driver):
+        request = driver.request
+        if driver.phase == 'to_pickup':
+            request.picked_up_at = self.now
+            self.waits.append((self.now - request.requested_at) / 60)
+            self.counts['picked_up'] += 1
+            driver.phase = 'on_trip'
+            self._start_route(driver, request.path)
+            return
+
+        self.counts['completed'] += 1
+        self.busy_seconds += self.now - driver.busy_since
+        driver.phase = 'idle'
+        driver.request = None
+        lat, lon = self.graph[driver.city]['coords']
+        conn = self.app.get_db()
+        try:
+            conn.users.set_location(driver.user_id, lat, lon)
+            conn.commit()
+        finally:
+            conn.close()
+        self.idle[driver.city].append(driver)
+        self._dispatch_waiting()
+
+    # -- run ----------------------------------------------------------------
+
+    def run(self) -> Dict:
+        self._create_users()
+        horizon = self.config['hours'] * 3600
+        handlers = {'request': self._on_request, 'give_up': self._on_give_up, 'arrive': self._on_arrive}
+
+        started = time.perf_counter()
+        self._schedule(self._next_arrival_gap(), 'request')
+        while self._events and self._events[0][0] <= horizon:
+            self.now, _, kind, payload = heapq.heappop(self._events)
+            handlers[kind](payload)
+            self.counts['events'] += 1
+        wall = time.perf_counter() - started
+
+        self.app.notification_queue.flush()
+        for driver in self.drivers:
+            if driver.phase != 'idle':
+                self.busy_seconds += horizon - driver.busy_since
+        return self.report(wall, horizon)
+
+    def report(self, wall: float, horizon: float) -> Dict:
+        hours = horizon / 3600
+        searches = max(self.counts['dispatch_searches'], 1)
+        return {
+            'simulated_hours': hours,
+            'wall_seconds': round(wall, 2),
+            'speedup': round(horizon / wall, 1) if wall else None,
+            'events': self.counts['events'],
+            'requests': self.counts['requests'],
+            'no_route': self.counts['no_route'],
+            'dispatched': self.counts['dispatched'],
+            'abandoned': self.counts['abandoned'],
+            'completed': self.counts['completed'],
+            'completed_per_hour': round(self.counts['completed'] / hours, 1),
+            'wait_minutes': {
+                'mean': round(sum(self.waits) / len(self.waits), 1) if self.waits else 0.0,
+                'p50': round(_percentile(self.waits, 50), 1),
+                'p95': round(_percentile(self.waits, 95), 1),
+            },
+            'dispatch_delay_minutes_p95': round(_percentile(self.dispatch_delays, 95), 1),
+            'driver_utilization': round(self.busy_seconds / (len(self.drivers) * horizon), 3)
+            if self.drivers else 0.0,
+            'deadhead_km': round(self.deadhead_km, 1),
+            'revenue_km': round(self.revenue_km, 1),
+            'routing': {
+                'dispatch_searches': self.counts['dispatch_searches'],
+                'dispatch_expanded_per_search': round(self.dispatch_expanded / searches, 1),
+                'dispatch_ms_per_search': round(self.call_seconds['dispatch_search'] * 1000 / searches, 3),
+                'book_ms_per_call': round(self.call_seconds['book'] * 1000 / max(self.counts['requests'], 1), 3),
+                'accept_ms_per_call': round(self.call_seconds['accept'] * 1000
+                                            / max(self.counts['dispatched'], 1), 3),
+            },
+        }
+
+
+def _parse_args(argv: List[str]) -> Dict:
+    config = dict(DEFAULTS)
+    args = iter(argv)
+    for flag in args:
+        key = flag.lstrip('-').replace('-', '_')
+        if not flag.startswith('--') or key not in config:
+            raise SystemExit(__doc__)
+        value = next(args, None)
+        if value is None:
+            raise SystemExit(f'{flag} needs a value')
+        default = DEFAULTS[key]
+        config[key] = type(default)(value) if default is not None else value
+    return config
+
+
+def main(argv: List[str]):
+    config = _parse_args(argv)
+    # Configure the app before importing it: scratch database, no background jobs
+    os.environ['DATABASE_URL'] = config['database'] or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='rideshare-sim-'), 'sim.db')
+    os.environ['RIDESHARE_DEFER_JOBS'] = '1'
+    # Start from a cold route cache every run so results are comparable
+    os.environ['RIDESHARE_ROUTE_SNAPSHOT'] = ''
+    import app
+
+    print(f"🚦 Simulating {config['drivers']} drivers, {config['demand']:.0f} requests/h "
+          f"for {config['hours']} h ({config['od']} demand) on {os.environ['DATABASE_URL']}")
+    report = FleetSimulation(app, config).run()
+
+    print(f"✅ {report['completed']} trips completed ({report['completed_per_hour']}/h), "
+          f"{report['abandoned']} abandoned, {report['requests']} requested")
+    print(f"⏱️  Wait: mean {report['wait_minutes']['mean']} min, p50 {report['wait_minutes']['p50']}, "
+          f"p95 {report['wait_minutes']['p95']}; utilization {report['driver_utilization']:.1%}")
+    print(f"🛣️  Deadhead {report['deadhead_km']} km vs revenue {report['revenue_km']} km; "
+          f"routing {report['routing']}")
+    print(f"🚀 {report['simulated_hours']} simulated hours in {report['wall_seconds']} s "
+          f"({report['speedup']}x real time, {report['events']} events)")
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
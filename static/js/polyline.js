@@ -0,0 +1,45 @@
+// Encoded polyline helpers (Google/OSRM format), matching geometry.py
+
+function decodePolyline(text, precision = 5) {
+    const factor = Math.pow(10, precision);
+    const points = [];
+    let index = 0, lat = 0, lon = 0;
+    while (index < text.length) {
+        const deltas = [];
+        for (let k = 0; k < 2; k++) {
+            let shift = 0, result = 0, byte;
+            do {
+                byte = text.charCodeAt(index++) - 63;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += deltas[0];
+        lon += deltas[1];
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+
+// Coarsest simplified level made for this zoom or closer in, else the full line
+function geometryForZoom(geometry, zoom) {
+    const level = geometry.levels.find(l => zoom <= l.zoom);
+    return decodePolyline(level ? level.polyline : geometry.polyline);
+}
+
+// Redraw a [lat, lon] line feature whenever the zoom crosses a level
+function bindZoomLevels(map, feature, geometry) {
+    let current = null;
+    const update = () => {
+        const zoom = map.getView().getZoom();
+        const level = geometry.levels.find(l => zoom <= l.zoom);
+        const key = level ? level.zoom : 'full';
+        if (key === current) return;
+        current = key;
+        const points = geometryForZoom(geometry, zoom);
+        feature.setGeometry(new ol.geom.LineString(points.map(p => ol.proj.fromLonLat([p[1], p[0]]))));
+    };
+    update();
+    map.getView().on('change:resolution', update);
+}